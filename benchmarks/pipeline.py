@@ -0,0 +1,301 @@
+""" Stage benchmark for the HeatMap Generator pipeline.
+
+Scales data/Sample.json to synthetic surveys of 10^2 to 10^5 points over
+floor plans of configurable sizes, then times every stage of
+HeatMapGenerator.generate separately (survey load, image decode, data
+preparation, interpolation fit and evaluation, rendering, contouring and
+savefig) and tracks the peak memory. Every case runs in a fresh process,
+so the peak RSS is the peak of that case only. tracemalloc slows the
+allocating stages unevenly, so the traced Python memory peak is measured
+by a second, untimed run of the case. The results are written as JSON,
+to be compared across commits with --compare.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SRC = os.path.join(ROOT, 'src')
+SAMPLE = os.path.join(ROOT, 'data', 'Sample.json')
+SAMPLE_IMAGE = os.path.join(ROOT, 'data', 'MapSample.jpg')
+
+# The global rbf backend is O(N^3), larger surveys are skipped
+RBF_MAX_POINTS = 2000
+
+RESULT_KEYS = ('rssi', 'snr', 'rssi_min', 'rssi_max', 'snr_min', 'snr_max',
+               'gateway_rssi', 'gateway_snr')
+
+
+# pylint: disable=too-many-locals
+def synthesize(points, width, height, directory, seed=0):
+    """
+    Scale the sample survey to a synthetic survey and floor plan.
+
+    The points are spread uniformly over the floor plan, their values
+    follow the inverse distance weighting of the sample survey plus a
+    1 dB noise, so the field keeps the shape of the sample.
+
+    Returns:
+    - (survey_path, image_path): The written survey and floor plan.
+
+    """
+    # pylint: disable=import-outside-toplevel
+    from PIL import Image
+    image_path = os.path.join(directory, F"plan_{width}x{height}.png")
+    if not os.path.exists(image_path):
+        with Image.open(SAMPLE_IMAGE) as image:
+            image.convert('RGB').resize((width, height)).save(image_path)
+    survey_path = os.path.join(directory, F"survey_{points}_{width}x{height}.json")
+    if os.path.exists(survey_path):
+        return survey_path, image_path
+
+    with open(SAMPLE, 'r', encoding='utf-8') as fh:
+        sample = json.load(fh)['survey_points']
+    with Image.open(SAMPLE_IMAGE) as image:
+        scale = numpy.array([width / image.width, height / image.height])
+    anchors = numpy.array([(p['x'], p['y']) for p in sample]) * scale
+    rng = numpy.random.default_rng(seed)
+    xy = rng.uniform((0, 0), (width, height), size=(points, 2))
+    distances = numpy.hypot(*(xy[:, None, :] - anchors[None, :, :]).transpose(2, 0, 1))
+    weights = 1 / numpy.maximum(distances, 1) ** 2
+    weights /= weights.sum(axis=1, keepdims=True)
+    survey_points = []
+    values = {}
+    for key in RESULT_KEYS:
+        anchor_values = numpy.array([p['result'][key] for p in sample], dtype=float)
+        values[key] = numpy.round(weights @ anchor_values + rng.normal(0, 1, points), 1)
+    for index in range(points):
+        survey_points.append({
+            'label': sample[index % len(sample)]['label'],
+            'result': {key: float(values[key][index]) for key in RESULT_KEYS},
+            'x': round(float(xy[index, 0]), 3),
+            'y': round(float(xy[index, 1]), 3),
+        })
+    with open(survey_path, 'w', encoding='utf-8') as fh:
+        json.dump({'title': 'Synthetic Survey', 'survey_points': survey_points}, fh)
+    return survey_path, image_path
+
+
+class StageTimer:
+    """Accumulated wall clock seconds of named stages."""
+
+    def __init__(self):
+        self.seconds = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block, adding to the stage when it runs several times."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.seconds[name] = self.seconds.get(name, 0) + elapsed
+
+    def wrap(self, owner, name, stage):
+        """Time every call of owner.name as the stage."""
+        original = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            with self.stage(stage):
+                return original(*args, **kwargs)
+
+        setattr(owner, name, timed)
+
+
+# pylint: disable=protected-access,unused-import
+def run_case(case):
+    """Time the stages of one case, or trace its memory peak, in the current process."""
+    # pylint: disable=import-outside-toplevel,import-error
+    sys.path.insert(0, SRC)
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot
+    from matplotlib.axes import Axes
+
+    import heatmap
+    from heatmap import HeatMapGenerator
+
+    timer = StageTimer()
+    # The heavy modules are imported lazily, on first use; import them
+    # up front so they do not inflate the first stage using them
+    with timer.stage('imports'):
+        import PIL.ImageDraw
+        import scipy.interpolate
+        import scipy.linalg
+        import scipy.spatial
+        from matplotlib import ticker
+    timer.wrap(Axes, 'contour', 'contour')
+    timer.wrap(Axes, 'clabel', 'contour')
+    timer.wrap(pyplot, 'savefig', 'savefig')
+    # The plots are drawn once and encoded by the output variant writer
+    timer.wrap(heatmap, 'write_variants', 'savefig')
+    if case.get('trace'):
+        tracemalloc.start()
+    with timer.stage('load'):
+        generator = HeatMapGenerator(
+            case['image'], case['survey'], 'RdYlBu_r',
+            contours=case['contours'], interpolator=case['interpolator'],
+            renderer=case['renderer'])
+    with timer.stage('decode'):
+        generator._load_image()
+    with timer.stage('prepare'):
+        a = generator._padded_data()
+        gx, gy, num_x, num_y = generator._grid()
+    with timer.stage('fit'):
+        _, evaluate = generator._field(a)
+    with timer.stage('evaluate'):
+        z = evaluate(gx, gy)
+    with timer.stage('render'):
+        for key, (title, unit) in generator.graphs.items():
+            if key in z:
+                generator._plot(a, key, title, unit, z[key].reshape((num_y, num_x)))
+    if case.get('trace'):
+        return {'peak_traced_mb': round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)}
+    stages = timer.seconds
+    # Rendering without its contouring and savefig share
+    stages['render'] -= stages.get('contour', 0) + stages.get('savefig', 0)
+    return {
+        'stages': {name: round(seconds, 4) for name, seconds in stages.items()},
+        'total': round(sum(stages.values()), 4),
+        'grid': [num_x, num_y],
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def run_isolated(case):
+    """Run a case in a fresh interpreter and return its measures."""
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--case', json.dumps(case)],
+        check=False, capture_output=True, text=True)
+    if result.returncode:
+        errors = result.stderr.strip().splitlines() or ['failed']
+        return {'error': errors[-1]}
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def measure(case, survey, image, trace=True):
+    """Time a case, then trace its memory peak in a second run when trace is set."""
+    if case['interpolator'] == 'rbf' and case['points'] > RBF_MAX_POINTS:
+        return {'skipped': F"rbf is limited to {RBF_MAX_POINTS} points"}
+    spec = dict(case, survey=survey, image=image)
+    result = run_isolated(spec)
+    if trace and 'error' not in result:
+        result.update(run_isolated(dict(spec, trace=True)))
+    return result
+
+
+def git_commit():
+    """Return the current commit of the repository, None outside git."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Print the speedup of every stage against a previous result file."""
+    with open(baseline_path, 'r', encoding='utf-8') as fh:
+        baseline = json.load(fh)
+
+    def case_key(case):
+        return (case['points'], case['plan'], case['interpolator'],
+                case['renderer'], case['contours'])
+
+    previous = {case_key(case): case for case in baseline['cases']}
+    print(F"\nCompared to {baseline.get('commit')}:")
+    for case in results['cases']:
+        old = previous.get(case_key(case))
+        if old is None or 'total' not in old or 'total' not in case:
+            continue
+        ratios = ', '.join(
+            F"{name} x{old['stages'][name] / seconds:.2f}"
+            for name, seconds in case['stages'].items()
+            if seconds > 0 and old['stages'].get(name)
+        )
+        print(F"{case['points']:>7} {case['plan']:>11} {case['interpolator']:>15} "
+              F"{case['renderer']:>10} total x{old['total'] / case['total']:.2f} ({ratios})")
+
+
+def parse_args(argv):
+    """
+    parse arguments/options
+
+    this uses the new argparse module instead of optparse
+    see: <https://docs.python.org/2/library/argparse.html>
+    """
+    p = argparse.ArgumentParser(
+        description='LoRa survey heatmap pipeline benchmark'
+    )
+    p.add_argument('--points', dest='points', type=str, default='100,1000,10000,100000',
+                   help='comma separated survey sizes')
+    p.add_argument('--plans', dest='plans', type=str, default='1280x720,4096x2304',
+                   help='comma separated WIDTHxHEIGHT floor plan sizes')
+    p.add_argument('-i', '--interpolators', dest='interpolators', type=str,
+                   default='rbf,idw', help='comma separated interpolators')
+    p.add_argument('-r', '--renderers', dest='renderers', type=str,
+                   default='matplotlib', help='comma separated renderers')
+    p.add_argument('-n', '--contours', dest='contours', type=int, default=None,
+                   help='draw N contour lines')
+    p.add_argument('-o', '--output', dest='output', type=str, default=None,
+                   help='result JSON file, defaults to benchmark-COMMIT.json')
+    p.add_argument('--compare', dest='compare', type=str, default=None,
+                   help='previous result JSON file to compare with')
+    p.add_argument('--no-trace', dest='trace', action='store_false',
+                   help='skip the tracemalloc run measuring the traced memory peak')
+    p.add_argument('--workdir', dest='workdir', type=str, default=None,
+                   help='directory of the synthetic surveys, kept between runs')
+    p.add_argument('--case', dest='case', type=str, default=None,
+                   help=argparse.SUPPRESS)
+    return p.parse_args(argv)
+
+
+def main():
+    """ main entry"""
+    args = parse_args(sys.argv[1:])
+    if args.case is not None:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='heatmap-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    commit = git_commit()
+    results = {'commit': commit, 'python': sys.version.split()[0],
+               'numpy': numpy.__version__, 'cases': []}
+    for plan in args.plans.split(','):
+        width, height = (int(size) for size in plan.split('x'))
+        for points in (int(count) for count in args.points.split(',')):
+            survey, image = synthesize(points, width, height, workdir)
+            for interpolator in args.interpolators.split(','):
+                for renderer in args.renderers.split(','):
+                    case = {'points': points, 'plan': plan, 'interpolator': interpolator,
+                            'renderer': renderer, 'contours': args.contours}
+                    case.update(measure(case, survey, image, trace=args.trace))
+                    results['cases'].append(case)
+                    stages = ' '.join(F"{name}={seconds:.3f}"
+                                      for name, seconds in case.get('stages', {}).items())
+                    print(F"{points:>7} {plan:>11} {interpolator:>15} {renderer:>10} "
+                          F"{case.get('skipped') or case.get('error') or stages} "
+                          F"peak_rss={case.get('peak_rss_mb', '-')}MB", flush=True)
+
+    output = args.output or F"benchmark-{commit or 'local'}.json"
+    with open(output, 'w', encoding='utf-8') as fh:
+        json.dump(results, fh, indent=2)
+    print(F"Wrote {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
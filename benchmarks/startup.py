@@ -0,0 +1,83 @@
+""" Cold start benchmark for the HeatMap Generator entry points. """
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+COMMANDS = {
+    'heatmap --help': [os.path.join(SRC, 'heatmap.py'), '--help'],
+    'thresholds --help': [os.path.join(SRC, 'thresholds.py'), '--help'],
+}
+
+# Modules which must not be imported before a plot or an interpolation
+# actually needs them
+HEAVY_MODULES = ('matplotlib', 'pylab', 'scipy', 'PIL')
+
+IMPORT_CHECK = (
+    "import sys; sys.path.insert(0, {src!r}); import heatmap, thresholds; "
+    "print(' '.join(m for m in {modules!r} if m in sys.modules))"
+)
+
+
+def measure(command, runs):
+    """Return the wall clock seconds of every cold run of a command."""
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + command, check=True,
+                       stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def heavy_imports():
+    """Return the heavy modules imported along with the entry points."""
+    check = IMPORT_CHECK.format(src=SRC, modules=HEAVY_MODULES)
+    result = subprocess.run([sys.executable, '-c', check], check=True,
+                            capture_output=True, text=True)
+    return result.stdout.split()
+
+
+def parse_args(argv):
+    """
+    parse arguments/options
+
+    this uses the new argparse module instead of optparse
+    see: <https://docs.python.org/2/library/argparse.html>
+    """
+    p = argparse.ArgumentParser(
+        description='LoRa survey heatmap cold start benchmark'
+    )
+    p.add_argument('-n', '--runs', dest='runs', action='store', type=int,
+                   default=10, help='cold runs of every command')
+    p.add_argument('-b', '--budget', dest='budget', action='store',
+                   type=float, default=500,
+                   help='median cold start budget in milliseconds')
+    return p.parse_args(argv)
+
+
+def main():
+    """ main entry"""
+    args = parse_args(sys.argv[1:])
+    failed = False
+    for name, command in COMMANDS.items():
+        timings = measure(command, args.runs)
+        median = statistics.median(timings) * 1000
+        over = median > args.budget
+        failed |= over
+        print(F"{name:20} median {median:7.1f} ms  min "
+              F"{min(timings) * 1000:7.1f} ms  "
+              F"{'OVER BUDGET' if over else 'ok'}")
+    heavy = heavy_imports()
+    if heavy:
+        failed = True
+        print(F"Heavy modules imported at startup: {', '.join(heavy)}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
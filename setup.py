@@ -42,8 +42,9 @@ this_directory = Path(__file__).parent
 long_description = (this_directory / "README.md").read_text()
 
 requires = [
-    'matplotlib==3.3.0',
-    'scipy==1.5.2',
+    'matplotlib>=3.6.0',
+    'scipy>=1.7.0',
+    'Pillow>=9.1.0',
     'libnl3==0.3.0',
 ]
 
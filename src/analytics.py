@@ -0,0 +1,209 @@
+"""Module providing the coverage analytics of the Heat Map Generator.
+
+The interpolated grids can be exported next to the plots, every graph as
+a .npy array indexed [row, col], with a <title>_grids.json index holding
+the graph titles, units and the affine transform from a grid node to the
+floor plan pixels: x = a * col + b * row + c, y = d * col + e * row + f.
+
+A zones file turns the grids into per-zone statistics. It is a JSON list
+of {"name", "polygon": [[x, y], ...]} in floor plan pixels, or a GeoJSON
+FeatureCollection of Polygon and MultiPolygon features named by their
+"name" property. It may hold a {"zones": [...], "levels": {...},
+"sensitivity": {...}} object instead to override, per graph key or per
+metric (rssi, snr), the levels of the area percentages and the
+sensitivity. Every zone is rasterized once onto the grid within its
+bounding box, and its statistics are NumPy reductions of the masked
+cells:
+- percent_above: the percentage of the zone at or above every level;
+- worst: the lowest value of the zone;
+- below_sensitivity: the area below the sensitivity, in square floor
+  plan pixels and in percent of the zone.
+"""
+
+import json
+import logging
+import os
+
+import numpy
+
+from coverage import COVERAGE_GRAPHS, DEFAULT_THRESHOLD
+from survey import parse_gateway_column
+
+logger = logging.getLogger()
+
+# Levels of the area percentages, by metric
+DEFAULT_LEVELS = {
+    'rssi': [-120.0, -110.0, -100.0, -90.0],
+    'snr': [-15.0, -10.0, -5.0, 0.0],
+}
+
+# Values below which the gateways cannot demodulate, by metric; -20 dB is
+# the SNR limit of SF12
+DEFAULT_SENSITIVITY = {
+    'rssi': DEFAULT_THRESHOLD,
+    'snr': -20.0,
+}
+
+
+def _metric(key):
+    parsed = parse_gateway_column(key)
+    if parsed is not None:
+        return parsed[0]
+    return key.rsplit('_', 1)[-1]
+
+
+def grid_transform(width, height, num_x, num_y):
+    """Return the affine (a, b, c, d, e, f) transform of the grid nodes to floor plan pixels."""
+    return (width / max(1, num_x - 1), 0.0, 0.0,
+            0.0, height / max(1, num_y - 1), 0.0)
+
+
+def export_grids(index, entries, transform):
+    """
+    Write every grid as a .npy array, with a JSON index.
+
+    Parameters:
+    - index (str): The path of the JSON index.
+    - entries (dict): The (path, grid, [title, unit]) of every graph key.
+    - transform (tuple): The affine transform, see grid_transform.
+
+    """
+    grids = {}
+    for key, (path, z, (title, unit)) in entries.items():
+        numpy.save(path, z)
+        grids[key] = {'file': os.path.basename(path), 'title': title,
+                      'unit': unit, 'shape': list(z.shape)}
+    with open(index, 'w', encoding='utf-8') as fh:
+        json.dump({'transform': list(transform), 'grids': grids}, fh, indent=2)
+    logger.info('Exported %d grids, index: %s', len(grids), index)
+
+
+def _polygons(geometry):
+    """Return the rings of every polygon of a GeoJSON geometry."""
+    if geometry.get('type') == 'Polygon':
+        return [geometry['coordinates']]
+    if geometry.get('type') == 'MultiPolygon':
+        return geometry['coordinates']
+    raise ValueError(F"Unsupported zone geometry: {geometry.get('type')}")
+
+
+def load_zones(path):
+    """
+    Load a zones file.
+
+    Returns:
+    - zones (list): The (name, polygons) of every zone, polygons being
+      lists of rings, the exterior first and the holes after.
+    - levels (dict): The levels overrides, by graph key or metric.
+    - sensitivity (dict): The sensitivity overrides, by graph key or metric.
+
+    """
+    with open(path, 'r', encoding='utf-8') as fh:
+        data = json.load(fh)
+    levels, sensitivity = {}, {}
+    if isinstance(data, dict) and 'zones' in data:
+        levels = data.get('levels', {})
+        sensitivity = data.get('sensitivity', {})
+        data = data['zones']
+    if isinstance(data, dict) and data.get('type') == 'FeatureCollection':
+        data = data['features']
+    zones = []
+    for index, zone in enumerate(data):
+        if zone.get('type') == 'Feature':
+            name = (zone.get('properties') or {}).get('name', str(index))
+            zones.append((name, _polygons(zone['geometry'])))
+        else:
+            zones.append((zone.get('name', str(index)), [[zone['polygon']]]))
+    logger.info('Loaded %d zones from %s', len(zones), path)
+    return zones, levels, sensitivity
+
+
+# pylint: disable=too-many-locals
+def zone_mask(polygons, transform, shape):
+    """
+    Rasterize a zone onto the grid nodes, within its bounding box.
+
+    Returns:
+    - window (tuple): The (row, col) slices of the bounding box.
+    - mask (numpy.ndarray): The nodes of the window inside the zone.
+
+    """
+    # pylint: disable=import-outside-toplevel
+    from PIL import Image, ImageDraw
+    scale = numpy.array([transform[0], transform[4]])
+    rings = [[numpy.asarray(ring, dtype=float)[:, :2] / scale for ring in polygon]
+             for polygon in polygons]
+    points = numpy.concatenate([ring for polygon in rings for ring in polygon])
+    low = numpy.clip(numpy.floor(points.min(axis=0)).astype(int), 0, None)
+    high = numpy.minimum(numpy.ceil(points.max(axis=0)).astype(int) + 1,
+                         (shape[1], shape[0]))
+    window = (slice(low[1], max(low[1], high[1])), slice(low[0], max(low[0], high[0])))
+    size = (window[1].stop - window[1].start, window[0].stop - window[0].start)
+    if not size[0] or not size[1]:
+        return window, numpy.zeros((size[1], size[0]), dtype=bool)
+    image = Image.new('1', size, 0)
+    draw = ImageDraw.Draw(image)
+    for polygon in rings:
+        for hole, ring in enumerate(polygon):
+            draw.polygon([tuple(point) for point in ring - low], fill=0 if hole else 1,
+                         outline=0 if hole else 1)
+    return window, numpy.array(image, dtype=bool)
+
+
+def _setting(overrides, defaults, key):
+    return overrides.get(key, overrides.get(_metric(key), defaults.get(_metric(key))))
+
+
+# pylint: disable=too-many-locals
+def zone_statistics(grids, zones, transform, levels=None, sensitivity=None):
+    """
+    Compute the statistics of every measurement grid over every zone.
+
+    Parameters:
+    - grids (dict): The (num_y, num_x) grid of every graph key.
+    - zones (list): The (name, polygons) of every zone, see load_zones.
+    - transform (tuple): The affine transform, see grid_transform.
+    - levels (dict): The levels overrides, by graph key or metric.
+    - sensitivity (dict): The sensitivity overrides, by graph key or metric.
+
+    Returns:
+    - statistics (dict): zone name -> graph key -> statistics.
+
+    """
+    levels = levels or {}
+    sensitivity = sensitivity or {}
+    keys = [key for key in grids if key not in COVERAGE_GRAPHS]
+    cell_area = transform[0] * transform[4]
+    shape = next(iter(grids.values())).shape if grids else (0, 0)
+    statistics = {}
+    for name, polygons in zones:
+        window, mask = zone_mask(polygons, transform, shape)
+        cells = int(mask.sum())
+        statistics[name] = {}
+        for key in keys:
+            values = grids[key][window][mask]
+            values = values[numpy.isfinite(values)]
+            entry = {'cells': cells, 'area': cells * cell_area}
+            if not values.size:
+                statistics[name][key] = entry
+                continue
+            entry['worst'] = float(values.min())
+            entry['percent_above'] = {
+                str(level): float((values >= level).mean() * 100)
+                for level in _setting(levels, DEFAULT_LEVELS, key) or []
+            }
+            limit = _setting(sensitivity, DEFAULT_SENSITIVITY, key)
+            if limit is not None:
+                below = int((values < limit).sum())
+                entry['below_sensitivity'] = {
+                    'value': limit, 'area': below * cell_area,
+                    'percent': below / len(values) * 100}
+            statistics[name][key] = entry
+    return statistics
+
+
+def write_zone_statistics(path, statistics):
+    """Write the per-zone statistics as JSON."""
+    with open(path, 'w', encoding='utf-8') as fh:
+        json.dump(statistics, fh, indent=2)
+    logger.info('Wrote the statistics of %d zones: %s', len(statistics), path)
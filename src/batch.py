@@ -0,0 +1,186 @@
+"""Module providing the batch mode of the Heat Map Generator.
+
+Renders many surveys in one long-lived process: the survey files come
+from the command line (files, directories or glob patterns) or from a
+JSON/CSV manifest, share a single render pool and decode every floor
+plan only once.
+"""
+
+import csv
+import glob
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from survey import survey_image
+
+logger = logging.getLogger()
+
+# pylint: disable=too-few-public-methods
+
+
+class ImageCache:
+    """Least recently used cache of decoded floor plans."""
+
+    def __init__(self, size=4):
+        self._size = size
+        self._images = OrderedDict()
+
+    def load(self, path, reader):
+        """Return the decoded image at path, decoding it with reader once.
+
+        A floor plan modified on disk since it was decoded is decoded
+        again, so long-lived processes pick up the new plan.
+        """
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime_ns
+        if path in self._images and self._images[path][0] == mtime:
+            self._images.move_to_end(path)
+            logger.debug('Reusing decoded image %s', path)
+            return self._images[path][1]
+        image = reader(path)
+        self._images[path] = (mtime, image)
+        self._images.move_to_end(path)
+        if len(self._images) > self._size:
+            self._images.popitem(last=False)
+        return image
+
+
+def expand_surveys(paths):
+    """
+    Expand survey arguments into a sorted list of survey files.
+
+    Parameters:
+    - paths (list): Files, directories (every *.json and *.lsv survey
+      inside) or glob patterns.
+
+    Returns:
+    - surveys (list): The matching survey file paths.
+
+    """
+    surveys = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = []
+            for pattern in ('*.json', '*.lsv'):
+                found.extend(glob.glob(os.path.join(path, pattern)))
+            surveys.extend(sorted(found))
+        elif glob.has_magic(path):
+            surveys.extend(sorted(glob.glob(path)))
+        else:
+            surveys.append(path)
+    return surveys
+
+
+def read_manifest(path):
+    """
+    Read a batch manifest.
+
+    The manifest is either a JSON list of objects or a CSV file with a
+    header, both with a mandatory survey and optional image and
+    thresholds entries. Relative paths are resolved against the
+    manifest directory.
+
+    Returns:
+    - entries (list): One dict per survey with survey, image and
+      thresholds keys.
+
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, 'r', encoding='utf-8') as fh:
+        if path.lower().endswith('.csv'):
+            rows = list(csv.DictReader(fh))
+        else:
+            rows = json.loads(fh.read())
+    entries = []
+    for row in rows:
+        entry = {}
+        for key in ('survey', 'image', 'thresholds'):
+            value = row.get(key) or None
+            if value is not None:
+                value = os.path.join(base, value)
+            entry[key] = value
+        if entry['survey'] is None:
+            raise ValueError(F"Manifest entry without survey in {path}: {row}")
+        entries.append(entry)
+    return entries
+
+
+class BatchResult:
+    """Outcome of the rendering of a single survey."""
+
+    def __init__(self, survey):
+        self.survey = survey
+        self.seconds = 0.0
+        self.status = 'ok'
+        self.errors = {}
+
+
+def _image_key(entry, image):
+    """Return the floor plan path a survey entry is rendered over, '' when unknown."""
+    path = entry['image'] or image
+    if path is None:
+        try:
+            path = survey_image(entry['survey'])
+        except (OSError, ValueError):
+            # The generator reports the unreadable surveys
+            path = None
+    return os.path.abspath(path) if path else ''
+
+
+def run_batch(entries, factory, pool=None, image=None):
+    """
+    Render every manifest entry in this process.
+
+    Parameters:
+    - entries (list): Dicts with survey, image and thresholds keys.
+    - factory (callable): Builds a HeatMapGenerator from an entry and
+      the shared ImageCache.
+    - pool (RenderPool): The worker pool shared by every survey.
+    - image (str): The floor plan of the entries without an image,
+      their survey img_path by default.
+
+    Returns:
+    - results (list): One BatchResult per entry, in input order.
+
+    """
+    images = ImageCache()
+    results = [BatchResult(entry['survey']) for entry in entries]
+    # Consecutive surveys on the same floor plan reuse the decoded image
+    keys = [_image_key(entry, image) for entry in entries]
+    order = sorted(range(len(entries)), key=keys.__getitem__)
+    for idx in order:
+        result = results[idx]
+        start = time.perf_counter()
+        try:
+            result.errors = factory(entries[idx], images).generate(pool=pool)
+            if result.errors:
+                result.status = 'failed'
+        except SystemExit as e:
+            # The generator exits when a file holds no survey points
+            result.status = 'skipped' if not e.code else 'failed'
+        # pylint: disable=broad-exception-caught
+        except Exception as e:
+            logger.error(e)
+            result.status = 'failed'
+            result.errors = {'survey': str(e)}
+        result.seconds = time.perf_counter() - start
+        logger.info('%s %s in %.2fs', result.survey, result.status,
+                    result.seconds)
+    return results
+
+
+def print_summary(results):
+    """Print the per-survey timing and failures of a batch."""
+    width = max([len(result.survey) for result in results] + [6])
+    print(F"{'survey':<{width}}  {'status':<8} {'seconds':>8}")
+    for result in results:
+        print(F"{result.survey:<{width}}  {result.status:<8} "
+              F"{result.seconds:>8.2f}")
+        for key, error in result.errors.items():
+            print(F"    {key}: {error}")
+    failed = sum(result.status == 'failed' for result in results)
+    total = sum(result.seconds for result in results)
+    print(F"{len(results)} surveys, {failed} failed, {total:.2f}s")
@@ -0,0 +1,155 @@
+"""Module providing the render cache of the Heat Map Generator.
+
+Interpolated grids and rendered plots are stored on disk under the
+SHA-256 digest of everything they depend on: the survey, floor plan and
+thresholds contents, the generator options and the tool version. An
+unchanged survey is then skipped entirely, and a colormap or contour
+change re-renders the plots without re-interpolating.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy
+
+logger = logging.getLogger()
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+# Eviction goes down to this fraction of max_bytes, so the cache
+# directory is only walked again after some more stores
+LOW_WATER = 0.9
+
+# File digests already computed by this process, by path, size and mtime
+_file_digests = {}
+
+
+def default_cache_dir():
+    """Return the per-user cache directory of the generator."""
+    root = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(root, 'lora-survey-heatmap')
+
+
+def file_digest(path):
+    """Return the SHA-256 digest of a file contents."""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_digests:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as fh:
+            for block in iter(lambda: fh.read(1024 * 1024), b''):
+                sha.update(block)
+        _file_digests[memo_key] = sha.hexdigest()
+    return _file_digests[memo_key]
+
+
+def digest(*parts):
+    """Return the SHA-256 digest of JSON serializable parts."""
+    text = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+    """Size-bounded, content-addressed store of grids and plots."""
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = os.path.abspath(directory or default_cache_dir())
+        self.max_bytes = max_bytes
+        # Size of the cache directory, walked on the first store, then
+        # tracked; the stores of other processes are only accounted for
+        # by the next walk
+        self._total = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    @staticmethod
+    def _touch(path):
+        # Eviction is least recently used by modification time
+        os.utime(path)
+
+    def _store(self, path, writer):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = F"{path}.{os.getpid()}.tmp"
+        writer(tmp)
+        replaced = os.path.getsize(path) if os.path.exists(path) else 0
+        size = os.path.getsize(tmp)
+        os.replace(tmp, path)
+        if self._total is None:
+            self.evict()
+            return
+        self._total += size - replaced
+        if self._total > self.max_bytes:
+            self.evict()
+
+    def load_grids(self, key):
+        """Return the grids stored under key, or None."""
+        path = self._path(key, '.npz')
+        if not os.path.exists(path):
+            return None
+        self._touch(path)
+        with numpy.load(path) as data:
+            grids = {name: data[name] for name in data.files}
+        logger.info('Loaded interpolated grids from cache: %s', path)
+        return grids
+
+    def store_grids(self, key, grids):
+        """Store a dict of grids under key."""
+        def writer(tmp):
+            with open(tmp, 'wb') as fh:
+                numpy.savez(fh, **grids)
+        self._store(self._path(key, '.npz'), writer)
+
+    def fetch_output(self, key, destination):
+        """
+        Restore the plot stored under key to destination.
+
+        Returns:
+        - found (bool): Whether the plot was in the cache.
+
+        """
+        path = self._path(key, '.png')
+        if not os.path.exists(path):
+            return False
+        self._touch(path)
+        unchanged = os.path.exists(destination)
+        if unchanged:
+            unchanged = file_digest(destination) == file_digest(path)
+        if not unchanged:
+            logger.info('Restoring %s from cache', destination)
+            shutil.copyfile(path, destination)
+        else:
+            logger.info('Skipping unchanged %s', destination)
+        return True
+
+    def store_output(self, key, source):
+        """Store a copy of the plot at source under key."""
+        self._store(self._path(key, '.png'),
+                    lambda tmp: shutil.copyfile(source, tmp))
+
+    def evict(self):
+        """Remove the least recently used entries above max_bytes.
+
+        Walks the cache directory, then removes entries down to LOW_WATER
+        of max_bytes when it is above max_bytes.
+        """
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes * LOW_WATER:
+                    break
+                logger.debug('Evicting %s from cache', path)
+                os.remove(path)
+                total -= size
+        self._total = total
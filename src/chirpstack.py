@@ -0,0 +1,256 @@
+"""Module providing the ChirpStack export ingestion of the Heat Map Generator.
+
+Reads the device data exported from ChirpStack after a survey directly,
+without the survey/convert.js round trip. The export is streamed one
+uplink at a time, so multi-hundred-MB exports load in bounded memory.
+Like convert.js, only the uplinks of a button press are kept: those
+carrying the rssi and snr measured by the device in their result. Every
+frame counter is aggregated in the same pass, into the mean, min and max
+of the device measurements and the mean of the gateway measurements, per
+gateway when the export names the gateways.
+
+The survey positions of the counters come from a separate file: either
+a CSV with counter, x, y and an optional label column (';' or ','
+separated, Compteur and Point are accepted as in survey/convertback.js),
+or a JSON list of points with counter, x and y, such as the
+survey_points of an earlier survey.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import math
+import sys
+from pathlib import Path
+
+import numpy
+
+from survey import (BINARY_SUFFIX, CHUNK_SIZE, GATEWAY_METRICS, SurveyData,
+                    gateway_column, iter_array, write_binary)
+
+logger = logging.getLogger()
+
+# Column name -> (measurement, statistic) of the per counter aggregates
+AGGREGATES = {
+    'sensor_rssi': ('rssi', 'mean'),
+    'sensor_snr': ('snr', 'mean'),
+    'sensor_rssi_min': ('rssi', 'min'),
+    'sensor_rssi_max': ('rssi', 'max'),
+    'sensor_snr_min': ('snr', 'min'),
+    'sensor_snr_max': ('snr', 'max'),
+    'gateway_rssi': ('gateway_rssi', 'mean'),
+    'gateway_snr': ('gateway_snr', 'mean'),
+}
+
+# Keys of the gateway id and snr in the gateway entries of the exports
+GATEWAY_IDS = ('id', 'gatewayId', 'gatewayID', 'gateway_id')
+SNR_KEYS = ('snr', 'loRaSNR')
+
+
+def _number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+def _counter(value):
+    number = _number(value)
+    if number is not None and number.is_integer():
+        return str(int(number))
+    return None
+
+
+def _first(entry, keys):
+    return next((entry[key] for key in keys if entry.get(key) is not None), None)
+
+
+def _receptions(measurement):
+    """Return the (gateway id, rssi, snr) of every gateway which heard an uplink."""
+    entries = measurement.get('gateway', measurement.get('rxInfo'))
+    if isinstance(entries, dict):
+        entries = [entries]
+    if not isinstance(entries, list):
+        return []
+    receptions = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        gateway = _first(entry, GATEWAY_IDS)
+        receptions.append((None if gateway is None else str(gateway),
+                           _number(entry.get('rssi')),
+                           _number(_first(entry, SNR_KEYS))))
+    return receptions
+
+
+def _add(stats, key, value):
+    """Add a value to the running [count, sum, min, max] of a measurement."""
+    if value is None:
+        return
+    running = stats.get(key)
+    if running is None:
+        stats[key] = [1, value, value, value]
+        return
+    running[0] += 1
+    running[1] += value
+    running[2] = min(running[2], value)
+    running[3] = max(running[3], value)
+
+
+def _statistic(running, statistic):
+    if running is None:
+        return math.nan
+    if statistic == 'mean':
+        return running[1] / running[0]
+    return running[2] if statistic == 'min' else running[3]
+
+
+def aggregate(counters, measurement):
+    """
+    Add a button press uplink to the aggregates of its frame counter.
+
+    Returns:
+    - kept (bool): Whether the uplink was a button press.
+
+    """
+    if not isinstance(measurement, dict):
+        return False
+    result = measurement.get('result')
+    # The uplinks of a button press carry the measurements of the device
+    if not isinstance(result, dict) or not (result.get('rssi') and result.get('snr')):
+        return False
+    counter = _counter(measurement.get('counter'))
+    rssi, snr = _number(result['rssi']), _number(result['snr'])
+    if counter is None or rssi is None or snr is None:
+        return False
+    stats = counters.setdefault(counter, {})
+    _add(stats, 'rssi', rssi)
+    _add(stats, 'snr', snr)
+    receptions = _receptions(measurement)
+    heard = [reception for reception in receptions if reception[1] is not None]
+    if heard:
+        # The strongest gateway stands for the uplink in gateway_rssi/snr
+        _, best_rssi, best_snr = max(heard, key=lambda reception: reception[1])
+        _add(stats, 'gateway_rssi', best_rssi)
+        _add(stats, 'gateway_snr', best_snr)
+    for gateway, gateway_rssi, gateway_snr in receptions:
+        if gateway is not None:
+            _add(stats, (gateway, 'rssi'), gateway_rssi)
+            _add(stats, (gateway, 'snr'), gateway_snr)
+    return True
+
+
+def _rows(fh):
+    """Return the position rows of a CSV or JSON file, as dicts."""
+    start = fh.read(4096)
+    fh.seek(0)
+    if start.lstrip()[:1] in ('[', '{'):
+        data = json.load(fh)
+        points = data.get('survey_points', []) if isinstance(data, dict) else data
+        return [point for point in points if isinstance(point, dict)]
+    try:
+        dialect = csv.Sniffer().sniff(start, delimiters=';,')
+    except csv.Error:
+        dialect = 'excel'
+    return [{key.strip().lower(): value for key, value in row.items() if key is not None}
+            for row in csv.DictReader(fh, dialect=dialect)]
+
+
+def load_positions(path):
+    """
+    Load the survey positions of the frame counters.
+
+    Returns:
+    - positions (dict): counter -> (x, y, label).
+
+    """
+    positions = {}
+    with open(path, 'r', encoding='utf-8-sig', errors='replace', newline='') as fh:
+        for row in _rows(fh):
+            counter = _counter(row.get('counter', row.get('compteur')))
+            x, y = _number(row.get('x')), _number(row.get('y'))
+            # Header and unplaced rows have no numeric counter or position
+            if counter is None or x is None or y is None:
+                continue
+            label = row.get('label', row.get('point')) or counter
+            positions[counter] = (x, y, label)
+    logger.info('Loaded the positions of %d counters from %s',
+                len(positions), path)
+    return positions
+
+
+# pylint: disable=too-many-locals
+def load_chirpstack(path, positions, chunk_size=CHUNK_SIZE):
+    """
+    Stream a ChirpStack device data export into a columnar survey.
+
+    Parameters:
+    - path (str): The exported JSON array of uplinks.
+    - positions (str): The CSV or JSON file of the counter positions.
+    - chunk_size (int): The read buffer size in characters.
+
+    Returns:
+    - survey (SurveyData): One point per positioned frame counter.
+
+    """
+    places = load_positions(positions)
+    counters = {}
+    uplinks = kept = 0
+    with open(path, 'r', encoding='utf-8') as fh:
+        for measurement in iter_array(fh, chunk_size):
+            uplinks += 1
+            kept += aggregate(counters, measurement)
+    located = [counter for counter in counters if counter in places]
+    logger.info('Kept %d button presses of %d uplinks, %d counters',
+                kept, uplinks, len(counters))
+    if len(located) < len(counters):
+        logger.warning('%d counters have no position in %s',
+                       len(counters) - len(located), positions)
+    gateways = sorted({key[0] for stats in counters.values()
+                       for key in stats if isinstance(key, tuple)})
+    columns = {
+        'x': numpy.array([places[counter][0] for counter in located]),
+        'y': numpy.array([places[counter][1] for counter in located]),
+    }
+    for name, (measurement, statistic) in AGGREGATES.items():
+        columns[name] = numpy.array(
+            [_statistic(counters[counter].get(measurement), statistic)
+             for counter in located])
+    for gateway in gateways:
+        for metric in GATEWAY_METRICS:
+            columns[gateway_column(metric, gateway)] = numpy.array(
+                [_statistic(counters[counter].get((gateway, metric)), 'mean')
+                 for counter in located])
+    header = {'title': Path(path).stem, 'source': 'chirpstack'}
+    labels = [places[counter][2] for counter in located]
+    return SurveyData(header, bool(located), columns, labels)
+
+
+def ingest_main(argv):
+    """Ingest a ChirpStack export into the binary survey format."""
+    p = argparse.ArgumentParser(
+        prog='lora-heatmap ingest',
+        description='Stream a ChirpStack device data export into the memory '
+        'mapped binary survey format'
+    )
+    p.add_argument('EXPORT', type=str, help='ChirpStack device data export')
+    p.add_argument('DESTINATION', type=str, nargs='?', default=None,
+                   help=F"binary survey file, defaults to EXPORT with a "
+                   F"{BINARY_SUFFIX} extension")
+    p.add_argument('--positions', dest='positions', type=str, required=True,
+                   help='CSV or JSON file of the x and y position of every '
+                   'counter')
+    args = p.parse_args(argv)
+    destination = args.DESTINATION
+    if destination is None:
+        destination = str(Path(args.EXPORT).with_suffix(BINARY_SUFFIX))
+    survey = load_chirpstack(args.EXPORT, args.positions)
+    if not survey.found:
+        logger.error("Error: No positioned button presses found in %s",
+                     args.EXPORT)
+        sys.exit(1)
+    write_binary(survey, destination)
+    print(F"Wrote {len(survey)} survey points with {len(survey.gateways)} "
+          F"gateways to {destination}")
@@ -0,0 +1,95 @@
+"""Module providing the multi-gateway coverage maps of the Heat Map Generator.
+
+A survey point may be heard by several gateways, see survey.py. A
+gateway which did not hear a point is below its sensitivity there, so
+its columns are filled with the NOT_HEARD values before interpolation:
+every gateway channel then shares the survey geometry, and all of them
+are interpolated together as the columns of one batched solve.
+
+The coverage maps are reduced from the stacked per-gateway RSSI grids:
+- best_server: the index of the strongest gateway, NaN where no gateway
+  reaches the threshold.
+- gateway_count: the number of gateways at or above the threshold.
+- redundancy: 1 where at least two gateways reach the threshold.
+The cells outside the interpolation domain stay NaN in every map.
+"""
+
+import numpy
+
+from survey import gateway_column, parse_gateway_column
+
+# Values of a gateway which did not hear a point, below the sensitivity
+# of LoRa gateways
+NOT_HEARD = {'rssi': -140.0, 'snr': -25.0}
+
+# RSSI in dBm from which a gateway counts as covering a cell
+DEFAULT_THRESHOLD = -120.0
+
+COVERAGE_GRAPHS = {
+    'best_server': ['Best Server', 'gateway'],
+    'gateway_count': ['Gateways Above Threshold', 'gateways'],
+    'redundancy': ['Redundant Coverage', 'covered by 2+ gateways'],
+}
+
+
+def gateway_graphs(gateways):
+    """Return the graphs of every gateway and the coverage graphs."""
+    graphs = {}
+    for gateway in gateways:
+        graphs[gateway_column('rssi', gateway)] = [
+            F"Received Signal Strength Indication, {gateway}", 'dBm']
+        graphs[gateway_column('snr', gateway)] = [
+            F"Signal-to-Noise Ratio, {gateway}", 'dB']
+    if gateways:
+        graphs.update(COVERAGE_GRAPHS)
+    return graphs
+
+
+def fill_not_heard(a):
+    """Fill the gateway columns of a data dict where the gateway did not hear the point."""
+    for name, values in a.items():
+        parsed = parse_gateway_column(name)
+        if parsed is not None:
+            a[name] = numpy.where(numpy.isnan(values), NOT_HEARD[parsed[0]], values)
+    return a
+
+
+def coverage_range(key, gateways):
+    """Return the (vmin, vmax) color range of a coverage graph."""
+    if key == 'best_server':
+        return 0, max(0, len(gateways) - 1)
+    if key == 'gateway_count':
+        return 0, len(gateways)
+    return 0, 1
+
+
+def coverage_maps(values, gateways, threshold=DEFAULT_THRESHOLD):
+    """
+    Reduce the per-gateway RSSI values to the coverage maps.
+
+    Parameters:
+    - values (dict): The interpolated values of every graph key, grids
+      or flattened, holding the gateway_rssi:<id> of every gateway.
+    - gateways (list): The gateway ids, in best_server index order.
+    - threshold (float): The RSSI in dBm from which a gateway covers.
+
+    Returns:
+    - maps (dict): The best_server, gateway_count and redundancy values,
+      shaped like the gateway values.
+
+    """
+    rssi = numpy.stack([values[gateway_column('rssi', gateway)] for gateway in gateways])
+    # Cells outside the interpolation domain are NaN for every gateway
+    outside = numpy.isnan(rssi).all(axis=0)
+    with numpy.errstate(invalid='ignore'):
+        count = (rssi >= threshold).sum(axis=0).astype(float)
+    best = numpy.argmax(numpy.nan_to_num(rssi, nan=-numpy.inf), axis=0).astype(float)
+    best[count == 0] = numpy.nan
+    count[outside] = numpy.nan
+    redundancy = (count >= 2).astype(float)
+    redundancy[outside] = numpy.nan
+    return {
+        'best_server': best,
+        'gateway_count': count,
+        'redundancy': redundancy,
+    }
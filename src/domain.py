@@ -0,0 +1,149 @@
+"""Module providing the interpolation domain of the Heat Map Generator.
+
+Without a domain, the four floor plan corners are added to the survey
+with the lowest value of every graph, so the interpolation has something
+to extrapolate towards. A domain replaces them: only the grid cells
+inside it are evaluated, the others are left NaN and are not drawn.
+
+A domain is the intersection of:
+- an outline, either the building derived from the floor plan drawing
+  (the walls are closed over door gaps and their inside filled) or the
+  polygons of a JSON or GeoJSON file, in the zones format of analytics.py,
+  to which the neighborhood of every survey point is added, so that no
+  measurement is masked out where the outline misses a room;
+- an extrapolation limit, the cells farther than it from every survey
+  point being left out.
+
+The outline is rasterized once at the grid step, so testing a cell is a
+lookup, and the neighborhoods and the extrapolation limit are KD-tree
+queries of the cells left to decide only.
+"""
+
+import logging
+import math
+
+import numpy
+
+from analytics import load_zones, zone_mask
+from raster import to_rgb
+
+logger = logging.getLogger()
+
+# Outline derived from the floor plan drawing
+PLAN = 'plan'
+
+# Gray level below which a floor plan pixel is drawn
+INK_LEVEL = 160
+
+# Widest gap in pixels, such as a door, closed in the drawn walls
+DOOR_GAP = 24
+
+# Radius in pixels around every survey point always inside the domain
+NEIGHBORHOOD = 64
+
+
+def _shape(width, height, step):
+    return int(height / step) + 1, int(width / step) + 1
+
+
+def plan_outline(layout, step, gap=DOOR_GAP):
+    """
+    Derive the building outline from the floor plan drawing.
+
+    Returns:
+    - mask (numpy.ndarray): The grid nodes inside the building, one
+      every step pixels.
+
+    """
+    # pylint: disable=import-outside-toplevel
+    from PIL import Image
+    from scipy import ndimage
+    gray = Image.fromarray(to_rgb(layout)).convert('L')
+    shape = _shape(gray.width, gray.height, step)
+    ink = Image.fromarray(((numpy.asarray(gray) < INK_LEVEL) * 255).astype(numpy.uint8))
+    # A cell is drawn when any of its pixels is
+    drawn = numpy.asarray(ink.resize((shape[1], shape[0]), Image.Resampling.BOX)) > 0
+    iterations = max(1, math.ceil(gap / (2 * step)))
+    # Pad so the closing does not erode the walls along the plan edges
+    padded = numpy.pad(drawn, iterations)
+    closed = ndimage.binary_closing(padded, iterations=iterations)
+    return ndimage.binary_fill_holes(closed)[iterations:-iterations, iterations:-iterations]
+
+
+def polygon_outline(path, width, height, step):
+    """
+    Rasterize the polygons of a zones file as the building outline.
+
+    Returns:
+    - mask (numpy.ndarray): The grid nodes inside any polygon, one every
+      step pixels.
+
+    """
+    zones, _, _ = load_zones(path)
+    shape = _shape(width, height, step)
+    mask = numpy.zeros(shape, dtype=bool)
+    for _, polygons in zones:
+        window, inside = zone_mask(polygons, (step, 0.0, 0.0, 0.0, step, 0.0), shape)
+        mask[window] |= inside
+    return mask
+
+
+# pylint: disable=too-few-public-methods
+class Domain:
+    """The floor plan cells a survey is interpolated over.
+
+    Parameters:
+    - outline (numpy.ndarray): The grid nodes inside the building, one
+      every step pixels, None for the whole floor plan.
+    - step (float): The outline node spacing in pixels.
+    - x, y (numpy.ndarray): The survey point coordinates.
+    - limit (float): The largest distance in pixels from a cell to the
+      nearest survey point, None for no limit.
+    - neighborhood (float): The radius in pixels around every survey
+      point added to the outline.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, outline=None, step=1, x=None, y=None, limit=None,
+                 neighborhood=NEIGHBORHOOD):
+        self._outline = outline
+        self._step = step
+        self._tree = None
+        self._limit = limit
+        self._neighborhood = neighborhood
+        if x is not None and (limit is not None or outline is not None):
+            # pylint: disable=import-outside-toplevel
+            from scipy.spatial import cKDTree
+            valid = numpy.isfinite(x) & numpy.isfinite(y)
+            self._tree = cKDTree(numpy.column_stack((x[valid], y[valid])))
+            if outline is not None:
+                outside = int((~self._on_outline(x[valid], y[valid])).sum())
+                if outside:
+                    logger.warning('%d survey points lie outside the domain outline, '
+                                   'only their neighborhood is interpolated', outside)
+
+    def _on_outline(self, x, y):
+        rows, cols = self._outline.shape
+        col = numpy.clip(numpy.rint(x / self._step).astype(int), 0, cols - 1)
+        row = numpy.clip(numpy.rint(y / self._step).astype(int), 0, rows - 1)
+        return self._outline[row, col]
+
+    def _near(self, x, y, distance):
+        """Return whether every (x, y) cell is within distance of a survey point."""
+        if not len(x):  # pylint: disable=use-implicit-booleaness-not-len
+            return numpy.zeros(0, dtype=bool)
+        nearest, _ = self._tree.query(numpy.column_stack((x, y)),
+                                      distance_upper_bound=distance * (1 + 1e-9))
+        return numpy.isfinite(nearest)
+
+    def contains(self, x, y):
+        """Return whether every (x, y) cell is inside the domain."""
+        inside = numpy.ones(len(x), dtype=bool)
+        if self._outline is not None:
+            inside = self._on_outline(x, y)
+            if self._tree is not None and self._tree.n:
+                outside = ~inside
+                inside[outside] = self._near(x[outside], y[outside], self._neighborhood)
+        if self._limit is not None and inside.any():
+            inside[inside] = self._near(x[inside], y[inside], self._limit)
+        return inside
@@ -0,0 +1,208 @@
+"""Module providing the adaptive grid of the Heat Map Generator.
+
+Instead of interpolating every node of the heatmap grid, the grid is
+covered with coarse cells which are split in four, quadtree style, only
+where the field needs it: where the bilinear interpolation of the cell
+corners misses the interpolated midpoints by more than a tolerance,
+where survey points lie, or where a contour level crosses the cell. The
+nodes of the cells left whole are filled bilinearly from their corners.
+With an interpolation domain, the cells without any node inside it are
+dropped and those across its edge are split down to single cells, so
+the nodes outside the domain are never evaluated.
+
+Only the midpoints of a cell are tested, so the tolerance is a heuristic:
+a feature narrower than a cell, between its midpoints, is filled over.
+"""
+
+import logging
+
+import numpy
+
+logger = logging.getLogger()
+
+# Span in grid nodes of the initial cells
+COARSE_SPAN = 32
+
+# Cells holding survey points are split down to this span
+POINT_SPAN = 4
+
+
+# pylint: disable=too-many-arguments,too-many-locals,too-few-public-methods
+def _bilinear(c00, c10, c01, c11, fx, fy):
+    top = c00 * (1 - fx) + c10 * fx
+    bottom = c01 * (1 - fx) + c11 * fx
+    return top * (1 - fy) + bottom * fy
+
+
+def _halves(lo, mid, hi):
+    """Return the (start, end, keep) halves of cell spans, whole when 1 wide."""
+    split = hi - lo > 1
+    return [(lo, numpy.where(split, mid, hi), numpy.ones_like(split)),
+            (mid, hi, split)]
+
+
+class _Lattice:
+    """Grid nodes evaluated on demand, those outside the domain are NaN."""
+
+    def __init__(self, evaluate, xs, ys, inside=None):
+        self._evaluate = evaluate
+        self._xs, self._ys = xs, ys
+        if inside is None:
+            self.known = numpy.zeros((len(ys), len(xs)), dtype=bool)
+        else:
+            self.known = ~inside
+        self.z = None
+
+    def sample(self, i, j):
+        """Return the values of the nodes (i, j), evaluating the new ones."""
+        unknown = ~self.known[j, i]
+        new = numpy.unique(j[unknown] * len(self._xs) + i[unknown])
+        if len(new):
+            jj, ii = numpy.divmod(new, len(self._xs))
+            values = numpy.asarray(self._evaluate(self._xs[ii], self._ys[jj]))
+            values = values.reshape(len(new), -1)
+            if self.z is None:
+                self.z = numpy.full(self.known.shape + values.shape[1:], numpy.nan)
+            self.z[jj, ii] = values
+            self.known[jj, ii] = True
+        return self.z[j, i]
+
+
+def _node_counts(mask):
+    """Return the summed area table of the nodes of a mask."""
+    table = numpy.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=numpy.int64)
+    table[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+    return table
+
+
+def _point_counts(points, xs, ys):
+    """Return the summed area table of the survey points per grid cell."""
+    counts = numpy.zeros((len(ys) - 1, len(xs) - 1), dtype=numpy.int64)
+    i = numpy.interp(points[0], xs, numpy.arange(len(xs))).astype(numpy.intp)
+    j = numpy.interp(points[1], ys, numpy.arange(len(ys))).astype(numpy.intp)
+    numpy.add.at(counts, (numpy.minimum(j, len(ys) - 2),
+                          numpy.minimum(i, len(xs) - 2)), 1)
+    table = numpy.zeros((len(ys), len(xs)), dtype=numpy.int64)
+    table[1:, 1:] = counts.cumsum(axis=0).cumsum(axis=1)
+    return table
+
+
+def _crosses(samples, levels):
+    """Return whether a level of any column lies within the cell samples."""
+    low, high = samples.min(axis=0), samples.max(axis=0)
+    crossing = numpy.zeros(len(low), dtype=bool)
+    for column, column_levels in enumerate(levels):
+        column_levels = numpy.asarray(column_levels)[None, :]
+        above = column_levels > low[:, column, None]
+        below = column_levels <= high[:, column, None]
+        crossing |= (above & below).any(axis=1)
+    return crossing
+
+
+def _fill(lattice, leaves):
+    """Bilinearly fill the nodes of the leaf cells which were not evaluated."""
+    if not leaves:
+        return
+    i0, i1, j0, j1 = (numpy.concatenate(part) for part in zip(*leaves))
+    spans = numpy.column_stack((i1 - i0, j1 - j0))
+    # Larger cells first, so the finer neighbors have the last word on
+    # shared edges
+    for span_x, span_y in sorted(set(map(tuple, spans)), reverse=True):
+        cells = (spans[:, 0] == span_x) & (spans[:, 1] == span_y)
+        ci, cj = i0[cells], j0[cells]
+        dx, dy = numpy.arange(span_x + 1), numpy.arange(span_y + 1)
+        ii, jj = numpy.broadcast_arrays(ci[:, None, None] + dx[None, None, :],
+                                        cj[:, None, None] + dy[None, :, None])
+        missing = ~lattice.known[jj, ii]
+        if not missing.any():
+            continue
+        fx = (dx / span_x)[None, None, :, None]
+        fy = (dy / span_y)[None, :, None, None]
+        corners = [lattice.z[cj + oy, ci + ox][:, None, None, :]
+                   for ox, oy in ((0, 0), (span_x, 0), (0, span_y), (span_x, span_y))]
+        values = _bilinear(*corners, fx, fy)
+        lattice.z[jj[missing], ii[missing]] = values[missing]
+
+
+def adaptive_grid(evaluate, xs, ys, max_error, points=None, levels=None,
+                  coarse=COARSE_SPAN, inside=None):
+    """
+    Interpolate a grid, refining only where the field needs it.
+
+    Parameters:
+    - evaluate (callable): Maps flattened (gx, gy) coordinates to the
+      (M, C) interpolated values of C columns.
+    - xs, ys (numpy.ndarray): The evenly spaced node coordinates.
+    - max_error (float): The largest tolerated difference between the
+      interpolated field and its bilinear fill at the cell midpoints, in
+      column units.
+    - points (tuple): The (x, y) survey point coordinates, whose cells
+      are always refined.
+    - levels (list): The contour levels of every column, whose cells
+      are always refined.
+    - coarse (int): The span in nodes of the initial cells.
+    - inside (numpy.ndarray): The (len(ys), len(xs)) nodes inside the
+      interpolation domain, at least one, None for every node.
+
+    Returns:
+    - z (numpy.ndarray): The (len(ys), len(xs), C) grid, NaN outside the
+      domain.
+
+    """
+    nx, ny = len(xs), len(ys)
+    lattice = _Lattice(evaluate, xs, ys, inside)
+    if inside is not None:
+        # Size the grid after the columns of a node inside the domain
+        jj, ii = numpy.nonzero(inside)
+        lattice.sample(ii[:1], jj[:1])
+    if nx < 2 or ny < 2:
+        jj, ii = numpy.divmod(numpy.arange(nx * ny), nx)
+        return lattice.sample(ii, jj).reshape(ny, nx, -1)
+    table = _point_counts(points, xs, ys) if points is not None else None
+    domain = _node_counts(inside) if inside is not None else None
+    starts_x, starts_y = numpy.arange(0, nx - 1, coarse), numpy.arange(0, ny - 1, coarse)
+    i0, j0 = (a.flatten() for a in numpy.meshgrid(starts_x, starts_y))
+    i1, j1 = numpy.minimum(i0 + coarse, nx - 1), numpy.minimum(j0 + coarse, ny - 1)
+    leaves = []
+    while len(i0):
+        across = numpy.zeros(len(i0), dtype=bool)
+        if domain is not None:
+            nodes = domain[j1 + 1, i1 + 1] - domain[j0, i1 + 1]
+            nodes += domain[j0, i0] - domain[j1 + 1, i0]
+            keep = nodes > 0
+            i0, i1, j0, j1, nodes = i0[keep], i1[keep], j0[keep], j1[keep], nodes[keep]
+            across = nodes < (i1 - i0 + 1) * (j1 - j0 + 1)
+        im, jm = (i0 + i1) // 2, (j0 + j1) // 2
+        corners = [lattice.sample(i, j) for i, j in ((i0, j0), (i1, j0), (i0, j1), (i1, j1))]
+        splittable = (i1 - i0 > 1) | (j1 - j0 > 1)
+        fx = ((im - i0) / (i1 - i0))[:, None]
+        fy = ((jm - j0) / (j1 - j0))[:, None]
+        samples = list(corners)
+        error = numpy.zeros(len(i0))
+        for i, j, wx, wy in ((im, j0, fx, 0), (i0, jm, 0, fy), (im, jm, fx, fy),
+                             (i1, jm, 1, fy), (im, j1, fx, 1)):
+            value = lattice.sample(i, j)
+            samples.append(value)
+            error = numpy.maximum(
+                error, numpy.abs(value - _bilinear(*corners, wx, wy)).max(axis=1))
+        # The cells across the domain edge hold NaN nodes
+        refine = (error > max_error) | across
+        if table is not None:
+            held = table[j1, i1] - table[j0, i1] - table[j1, i0] + table[j0, i0]
+            refine |= (held > 0) & (numpy.maximum(i1 - i0, j1 - j0) > POINT_SPAN)
+        if levels is not None:
+            refine |= _crosses(numpy.stack(samples), levels)
+        refine &= splittable
+        leaf = splittable & ~refine
+        leaves.append((i0[leaf], i1[leaf], j0[leaf], j1[leaf]))
+        children = []
+        for a0, a1, keep_x in _halves(i0[refine], im[refine], i1[refine]):
+            for b0, b1, keep_y in _halves(j0[refine], jm[refine], j1[refine]):
+                keep = keep_x & keep_y
+                children.append((a0[keep], a1[keep], b0[keep], b1[keep]))
+        i0, i1, j0, j1 = (numpy.concatenate(part) for part in zip(*children))
+    _fill(lattice, leaves)
+    evaluated = lattice.known if inside is None else lattice.known & inside
+    logger.info('Adaptive grid: interpolated %d of %d nodes',
+                evaluated.sum(), nx * ny)
+    return lattice.z
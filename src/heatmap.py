@@ -1,23 +1,41 @@
 """Module providing the Heat Map Generator."""
+# pylint: disable=too-many-lines
 
 import argparse
 import json
 import logging
 import os
+import re
 import sys
 from collections import defaultdict
 from pathlib import Path
 
-import matplotlib
 import numpy
-from matplotlib import cm
-from matplotlib import pyplot as pp
-from matplotlib.colors import ListedColormap
 # from matplotlib.offsetbox import AnchoredText
 # from matplotlib.patheffects import withStroke
-from matplotlib.font_manager import FontManager
-from pylab import imread
-from scipy.interpolate import Rbf
+
+from analytics import (export_grids, grid_transform, load_zones,
+                       write_zone_statistics, zone_statistics)
+from batch import expand_surveys, print_summary, read_manifest, run_batch
+from cache import DEFAULT_MAX_BYTES, RenderCache, digest, file_digest
+from chirpstack import ingest_main, load_chirpstack
+from coverage import (COVERAGE_GRAPHS, DEFAULT_THRESHOLD, coverage_maps,
+                      coverage_range, fill_not_heard, gateway_graphs)
+from domain import PLAN, Domain, plan_outline, polygon_outline
+from grid import adaptive_grid
+from incremental import update_grid
+from interpolation import INTERPOLATORS, create_interpolator
+from metrics import Metrics, reset_peak_rss, write_json, write_prometheus
+from output import (DEFAULT_OUTPUT, RASTER_DPI, output_spec, render_dpi, variant_paths,
+                    write_variants)
+from parallel import RenderPool, SharedArrays
+from preprocess import drop_outliers, merge_points
+from raster import (blend, colorbar_strip, colorize, colormap_lut,
+                    declutter, draw_points, font, to_rgb, upsample)
+from survey import BINARY_SUFFIX, gateway_column, load_survey, write_binary
+from tiles import TILE_SIZE, PlanRaster, render_pyramids
+
+__version__ = '1.0.0'
 
 FORMAT = "[%(asctime)s %(levelname)s] %(message)s"
 logging.basicConfig(level=logging.WARNING, format=FORMAT)
@@ -35,10 +53,17 @@ class HeatMapGenerator:
         'gateway_snr': ['Signal-to-Noise Ratio', 'dB'],
     }
 
-    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-arguments,too-many-locals,too-many-statements
     def __init__(
             self, image_path, survey_path, cname,
-            show_points=False, contours=False, thresholds=None):
+            show_points=False, contours=False, thresholds=None,
+            interpolator='rbf', neighbors=None, jobs=1, image_cache=None,
+            cache=None, incremental=False, tile_size=None,
+            renderer='matplotlib', grid_step=4, max_error=None,
+            metrics_callback=None, coverage_threshold=DEFAULT_THRESHOLD,
+            positions=None, export=False, zones=None, merge_radius=None,
+            outlier_threshold=None, domain=None, extrapolation=None,
+            output=None):
         self._ap_names = {}
         self._layout = None
         self._image_width = 0
@@ -48,25 +73,68 @@ class HeatMapGenerator:
         self._file_name = os.path.abspath(survey_path)
         self._path = os.path.dirname(self._file_name)
         self._title = Path(self._file_name).stem
-        self._cmap = self.get_colormap(cname)
+        self._cname = cname
+        # matplotlib is only imported when a plot is actually drawn
+        self._cmap = None
         self._contours = contours
         self._show_points = show_points
+        self._interpolator = interpolator
+        self._neighbors = neighbors
+        self._jobs = jobs
+        self._image_cache = image_cache
+        self._cache = cache
+        self._incremental = incremental
+        self._tile_size = tile_size
+        self._renderer = renderer
+        self._grid_step = grid_step
+        self._max_error = max_error
+        self._coverage_threshold = coverage_threshold
+        # With positions, the survey is a ChirpStack device data export
+        self._positions = positions
+        self._export = export
+        self._zones = zones
+        self._merge_radius = merge_radius
+        self._outlier_threshold = outlier_threshold
+        # PLAN, a polygon file or None, see domain.py
+        self._domain_source = domain
+        self._extrapolation = extrapolation
+        self._outline = None
+        if domain == PLAN and tile_size is not None:
+            logger.warning('The floor plan outline is not derived in tiled mode, '
+                           'the corners are padded instead')
+        # The files written for every graph, see output.py
+        self._variants = output or output_spec(DEFAULT_OUTPUT)
+        self._metrics_callback = metrics_callback
+        # The peak RSS is measured from here in batch mode
+        reset_peak_rss()
+        self.metrics = Metrics(self._title)
         logger.info(
-            'Initialized HeatMapGenerator; title=%s, file=%s, cname=%s', self._title,
-            self._file_name, cname)
-        with open(self._file_name, 'r', encoding='utf-8') as fh:
-            self._data = json.loads(fh.read())
-        if 'survey_points' not in self._data:
+            'Initialized HeatMapGenerator; title=%s, file=%s, cname=%s, '
+            'interpolator=%s', self._title, self._file_name, cname, interpolator)
+        with self.metrics.stage('load'):
+            if positions is not None:
+                self._survey = load_chirpstack(self._file_name, positions)
+            else:
+                self._survey = load_survey(self._file_name)
+        self.metrics.set('file', self._file_name)
+        self.metrics.set('points', len(self._survey))
+        if not self._survey.found:
             logger.error("Error: No survey points found in %s",
                          self._file_name)
             sys.exit(0)
-        logger.info('Loaded %d survey points',
-                    len(self._data['survey_points']))
+        logger.info('Loaded %d survey points', len(self._survey))
+        # Surveys heard by several gateways get a graph per gateway and
+        # the coverage graphs
+        self._gateways = self._survey.gateways
+        if self._gateways:
+            logger.info('Loaded measurements of %d gateways',
+                        len(self._gateways))
+        self.graphs = {**self.graphs, **gateway_graphs(self._gateways)}
         if image_path is None:
-            if 'img_path' not in self._data:
+            if 'img_path' not in self._survey.header:
                 logger.error("No image path found in %f", self._file_name)
                 sys.exit(1)
-            self._image_path = os.path.abspath(self._data['img_path'])
+            self._image_path = os.path.abspath(self._survey.header['img_path'])
         else:
             self._image_path = os.path.abspath(image_path)
 
@@ -77,12 +145,27 @@ class HeatMapGenerator:
                 self.thresholds = json.loads(threshold.read())
             logger.debug('Thresholds: %s', self.thresholds)
 
-        font_list = sorted(matplotlib.font_manager.get_font_names())
-        logger.debug('Available fonts: %s', font_list)
+        if logger.isEnabledFor(logging.DEBUG):
+            # pylint: disable=import-outside-toplevel
+            from matplotlib import font_manager
+            font_list = sorted(font_manager.get_font_names())
+            logger.debug('Available fonts: %s', font_list)
+
+    def __getstate__(self):
+        # Render workers receive the floor plan through shared memory
+        # and never need the raw survey.
+        state = self.__dict__.copy()
+        state['_layout'] = None
+        state['_survey'] = None
+        state['_image_cache'] = None
+        state['_cache'] = None
+        state['_metrics_callback'] = None
+        state['metrics'] = None
+        return state
 
     def get_colormap(self, cname):
         """
-        Get colormap from matplotlib.cm or custom colormap.
+        Get colormap from the matplotlib registry or custom colormap.
 
         Parameters:
         - cname (str): The name of the colormap to retrieve.
@@ -90,13 +173,23 @@ class HeatMapGenerator:
         Returns:
         - colormap: The colormap object.
 
+        Raises:
+        - ValueError: When the colormap is unknown.
+
         """
+        # pylint: disable=import-outside-toplevel
+        import matplotlib
+        from matplotlib.colors import ListedColormap
         multi_string = cname.split('//')
+        cname = multi_string[0]
+        try:
+            colormap = matplotlib.colormaps[cname]
+        except KeyError as e:
+            raise ValueError(F"Unknown colormap: {cname}") from e
         if len(multi_string) == 2:
-            cname = multi_string[0]
             steps = int(multi_string[1])
             num = 256
-            colormap = cm.get_cmap(cname, num)
+            colormap = colormap.resampled(num)
             new_colors = colormap(numpy.linspace(0, 1, num))
             rgba = numpy.array([0, 0, 0, 1])
             interval = int(num / steps) if steps > 0 else 0
@@ -104,35 +197,96 @@ class HeatMapGenerator:
                 new_colors[i] = rgba
             print(new_colors)
             return ListedColormap(new_colors)
-        return pp.get_cmap(cname)
-
-    def load_data(self):
-        """Load data from survey file."""
-        a = defaultdict(list)
-        for row in self._data['survey_points']:
-            a['x'].append(row['x'])
-            a['y'].append(row['y'])
-            a['label'].append(row['label'])
-            a['sensor_rssi'].append(row['result']['rssi'])
-            a['sensor_snr'].append(row['result']['snr'])
-            a['gateway_rssi'].append(row['result']['gateway_rssi'])
-            a['gateway_snr'].append(row['result']['gateway_snr'])
+        return colormap
+
+    def _colormap(self):
+        if self._cmap is None:
+            self._cmap = self.get_colormap(self._cname)
+        return self._cmap
+
+    def load_data(self, survey=None):
+        """Load data from survey file.
+
+        Parameters:
+        - survey (SurveyData): Another survey of the same floor plan,
+          defaults to the survey of this generator.
+
+        Returns:
+        - a (dict): The float64 column array of x, y and every measurement,
+          NaN where the measurement is missing, and the list of labels.
+        """
+        if survey is None:
+            survey = self._survey
+        a = dict(survey.columns)
+        a['label'] = list(survey.labels)
         return a
 
     def _load_image(self):
-        self._layout = imread(self._image_path)
-        self._image_width = len(self._layout[0])
-        self._image_height = len(self._layout) - 1
-        self._corners = [
-            (0, 0), (0, self._image_height),
-            (self._image_width, 0), (self._image_width, self._image_height)
-        ]
+        # pylint: disable=import-outside-toplevel
+        from matplotlib.image import imread
+        with self.metrics.stage('decode'):
+            if self._image_cache is not None:
+                self._layout = self._image_cache.load(self._image_path, imread)
+            else:
+                self._layout = imread(self._image_path)
+        self._set_image_size(len(self._layout[0]), len(self._layout) - 1)
+        self.metrics.set('image', [len(self._layout[0]), len(self._layout)])
         logger.info(
             'Loaded image with width=%d height=%d',
             self._image_width, self._image_height
         )
 
-    def generate(self):
+    def _set_image_size(self, width, height):
+        self._image_width = width
+        self._image_height = height
+        self._corners = [
+            (0, 0), (0, self._image_height),
+            (self._image_width, 0), (self._image_width, self._image_height)
+        ]
+
+    def _padded_data(self, survey=None):
+        """Return the survey data padded with the corners of the image.
+
+        The gateway columns are filled where the gateway did not hear the
+        point, and the coverage graphs of every point are added. With a
+        domain, the corners are left out.
+        """
+        a = fill_not_heard(self._preprocess(self.load_data(survey)))
+        if self._has_domain():
+            # The domain bounds the interpolation instead of the corners
+            a.update(self._coverage(a))
+            return a
+        corners = numpy.array(self._corners, dtype=float)
+        for k in a:
+            if k in ['x', 'y', 'label']:
+                continue
+            fill = numpy.nanmin(a[k]) if numpy.isfinite(a[k]).any() else numpy.nan
+            a[k] = numpy.append(a[k], [fill] * len(corners))
+        a['x'] = numpy.append(a['x'], corners[:, 0])
+        a['y'] = numpy.append(a['y'], corners[:, 1])
+        a['label'] += [None] * len(corners)
+        a.update(self._coverage(a))
+        return a
+
+    def _preprocess(self, a):
+        """Drop the outlier points and merge the close points, when requested."""
+        if self._outlier_threshold is None and self._merge_radius is None:
+            return a
+        count = len(a['x'])
+        with self.metrics.stage('preprocess'):
+            if self._outlier_threshold is not None:
+                a, dropped = drop_outliers(a, self._outlier_threshold)
+                logger.info('Dropped %d outlier points', dropped)
+            if self._merge_radius is not None:
+                a, merged = merge_points(a, self._merge_radius)
+                logger.info('Merged %d points within %s pixels of a seed point',
+                            merged, self._merge_radius)
+        self.metrics.set('points_used', len(a['x']))
+        logger.info('Interpolating %d of %d survey points (%.1f%% fewer)',
+                    len(a['x']), count, 100 * (1 - len(a['x']) / max(1, count)))
+        return a
+
+    def generate(self, pool=None):
         """Generate heatmap.
 
         This method generates a heatmap based on the loaded image and data.
@@ -141,43 +295,510 @@ class HeatMapGenerator:
         2. Loads the data using the load_data method.
         3. Appends the x and y coordinates of the corners to the data.
         4. Appends None to the 'label' field of the data.
-        5. Sets any None values in the data to 0.
-        6. Appends the minimum value of each data field to the data.
+        5. Appends the minimum valid value of each data field to the data,
+        missing values stay NaN and are left out of the interpolation.
+        6. Skips the graphs without any valid value.
         7. Calculates the number of x and y points for the heatmap
         grid based on the image dimensions.
         8. Generates the x and y coordinates for the heatmap grid using numpy.linspace.
         9. Flattens the grid coordinates.
-        10. Iterates over the graphs and plots each one using the _plot method.
-        11. Logs any errors that occur during plotting.
+        10. Interpolates every graph over the grid in one batched pass
+        using the _interpolate method.
+        11. Iterates over the graphs and plots each one using the _plot method,
+        in worker processes when a pool is given or jobs is greater than 1.
+        12. Logs any errors that occur during plotting.
 
         Note: This method assumes that the necessary data and image
         have been loaded before calling generate.
+
+        When a render cache is set, graphs whose inputs are unchanged are
+        restored from the cache, and the interpolated grids are reused
+        when only the rendering options changed.
+
+        With a tile size, the graphs are rendered tile by tile into Deep
+        Zoom pyramids instead, see _generate_tiles.
+
+        The duration of every stage is recorded in the metrics, which are
+        handed to the metrics callback once the survey is done.
+
+        Returns:
+        - errors (dict): The error message of every graph that could not
+          be created, empty when all graphs were written.
         """
+        errors = self._generate(pool)
+        self.metrics.set('errors', errors)
+        if self._metrics_callback is not None:
+            self._metrics_callback(self.metrics.as_dict())
+        return errors
+
+    # pylint: disable=too-many-branches
+    def _generate(self, pool):
+        if self._tile_size is not None:
+            return self._generate_tiles()
+        grid_key, plot_keys = None, {}
+        pending = self.graphs
+        if self._cache is not None:
+            grid_key, plot_keys = self._cache_keys()
+            pending = {
+                k: title for k, title in self.graphs.items()
+                if not all(self._cache.fetch_output(cache_key, path)
+                           for cache_key, path in self._cached_outputs(k, plot_keys[k]))
+            }
+            self.metrics.set('cached', len(self.graphs) - len(pending))
+            if not pending and not (self._export or self._zones):
+                logger.info('All plots of %s are up to date', self._title)
+                return {}
         self._load_image()
-        a = self.load_data()
-        for x, y in self._corners:
-            a['x'].append(x)
-            a['y'].append(y)
-            for k in a.keys():
-                if k in ['x', 'y', 'label']:
-                    continue
-                a['label'].append(None)
-                a[k] = [0 if x is None else x for x in a[k]]
-                a[k].append(min(a[k]))
-        num_x = int(self._image_width / 4)
+        a = self._padded_data()
+        grids = None
+        if self._cache is not None:
+            grids = self._cache.load_grids(grid_key)
+        if grids is None:
+            try:
+                with self.metrics.stage('grid'):
+                    grid = self._grid()
+                self.metrics.set('grid_cells', grid[2] * grid[3])
+                grids = self._interpolate(a, *grid)
+                grids.update(self._coverage(grids))
+            # pylint: disable=broad-exception-caught
+            except Exception as e:
+                logger.error(e)
+                logger.warning('Cannot interpolate plots: insufficient data')
+                return {k: str(e) for k in pending}
+            if self._cache is not None:
+                self._cache.store_grids(grid_key, grids)
+        self._analyze(grids)
+        grids = {k: z for k, z in grids.items() if k in pending}
+        errors = self._render_all(pool, a, grids)
+        if self._cache is not None:
+            for k in grids:
+                if k not in errors:
+                    for cache_key, path in self._cached_outputs(k, plot_keys[k]):
+                        self._cache.store_output(cache_key, path)
+        return errors
+
+    def _grid(self):
+        """Return the flattened (gx, gy) heatmap grid and its num_x, num_y size."""
+        num_x = int(self._image_width / self._grid_step)
         num_y = int(num_x / (self._image_width / self._image_height))
         x = numpy.linspace(0, self._image_width, num_x)
         y = numpy.linspace(0, self._image_height, num_y)
         gx, gy = numpy.meshgrid(x, y)
-        gx, gy = gx.flatten(), gy.flatten()
+        return gx.flatten(), gy.flatten(), num_x, num_y
+
+    def _generate_tiles(self):
+        """
+        Render every graph into a Deep Zoom tile pyramid.
+
+        The floor plan is mapped from a scratch raster next to the survey
+        and every tile is interpolated, colorized and composited on its
+        own, so the memory stays bounded by the tile size.
+
+        Returns:
+        - errors (dict): The error message of every graph that could not
+          be created, empty when all graphs were written.
+        """
+        if self._show_points or self._contours:
+            logger.warning('Points and contours are not drawn in tiled mode')
+        if self._export or self._zones:
+            logger.warning('Grids are neither exported nor analyzed in tiled mode')
+        if self._variants != output_spec(DEFAULT_OUTPUT):
+            logger.warning('The output variants are not written in tiled mode')
+        plan = PlanRaster(self._image_path, os.path.join(
+            self._path, F"{self._title}.plan.raw"))
+        try:
+            self._set_image_size(plan.width, plan.height - 1)
+            a = self._padded_data()
+            try:
+                with self.metrics.stage('fit'):
+                    keys, field = self._field(a)
+            # pylint: disable=broad-exception-caught
+            except Exception as e:
+                logger.error(e)
+                logger.warning('Cannot interpolate plots: insufficient data')
+                return {k: str(e) for k in self.graphs}
+
+            domain = self._domain(a['x'], a['y'])
+
+            def evaluate(gx, gy):
+                inside = None if domain is None else domain.contains(gx, gy)
+                z = self._evaluate_inside(field, keys, gx, gy, inside)
+                z.update(self._coverage(z))
+                return z
+
+            lut = colormap_lut(self._colormap())
+            outputs = {
+                k: (self._output_base(k), lut, *self._value_range(a, k))
+                for k in keys + self._coverage_keys() if k in self.graphs
+            }
+            try:
+                with self.metrics.stage('render'):
+                    render_pyramids(plan, outputs, evaluate,
+                                    tile_size=self._tile_size,
+                                    step=self._grid_step,
+                                    nearest=COVERAGE_GRAPHS)
+            # pylint: disable=broad-exception-caught
+            except Exception as e:
+                logger.error(e)
+                logger.warning('Cannot create tiled plots')
+                return {k: str(e) for k in outputs}
+        finally:
+            plan.close()
+        return {}
+
+    def _analyze(self, grids):
+        """Export the grids and write the per-zone statistics, when requested."""
+        if not grids or not (self._export or self._zones):
+            return
+        num_y, num_x = next(iter(grids.values())).shape
+        transform = grid_transform(self._image_width, self._image_height,
+                                   num_x, num_y)
+        base = os.path.join(self._path, self._title)
+        if self._export:
+            with self.metrics.stage('export'):
+                export_grids(F"{base}_grids.json", {
+                    k: (F"{self._output_base(k)}.npy", z, self.graphs.get(k, [k, '']))
+                    for k, z in grids.items()
+                }, transform)
+        if self._zones:
+            with self.metrics.stage('zones'):
+                zones, levels, sensitivity = load_zones(self._zones)
+                write_zone_statistics(F"{base}_zones.json", zone_statistics(
+                    grids, zones, transform, levels, sensitivity))
+
+    def _cache_keys(self):
+        """Return the grid cache key and the plot cache key of every graph."""
+        grid_key = digest(
+            'grids', __version__, file_digest(self._file_name),
+            file_digest(self._image_path), self.thresholds,
+            self._interpolator, self._neighbors, self._grid_step,
+            self._max_error, self._coverage_threshold,
+            # The adaptive grid is also refined around the contour levels
+            self._contours if self._max_error is not None else None,
+            file_digest(self._positions) if self._positions else None,
+            self._merge_radius, self._outlier_threshold,
+            self._domain_digest(), self._extrapolation
+        )
+        plot_keys = {
+            k: digest('plot', k, grid_key, self._cname, self._contours,
+                      self._show_points, self._renderer)
+            for k in self.graphs
+        }
+        return grid_key, plot_keys
+
+    def _domain_digest(self):
+        if self._domain_source is None or self._domain_source == PLAN:
+            return self._domain_source
+        return file_digest(self._domain_source)
+
+    def _outline_source(self):
+        """Return the source of the domain outline, None when it cannot be applied."""
+        if self._domain_source == PLAN and self._tile_size is not None:
+            return None
+        return self._domain_source
+
+    def _has_domain(self):
+        return self._outline_source() is not None or self._extrapolation is not None
+
+    def _domain(self, x, y):
+        """Return the interpolation domain around survey points, None without a domain."""
+        if not self._has_domain():
+            return None
+        if self._outline is None and self._outline_source() is not None:
+            if self._domain_source != PLAN:
+                self._outline = polygon_outline(self._domain_source, self._image_width,
+                                                self._image_height, self._grid_step)
+            else:
+                self._outline = plan_outline(self._layout, self._grid_step)
+        return Domain(self._outline, self._grid_step, x, y, self._extrapolation)
+
+    def _inside(self, x, y, gx, gy):
+        """Return the grid cells inside the domain of survey points, None without a domain."""
+        if not self._has_domain():
+            return None
+        with self.metrics.stage('domain'):
+            inside = self._domain(x, y).contains(gx, gy)
+        self.metrics.set('domain_cells', int(inside.sum()))
+        logger.info('Evaluating %d of %d cells inside the domain',
+                    inside.sum(), len(gx))
+        return inside
+
+    @staticmethod
+    def _evaluate_inside(evaluate, keys, gx, gy, inside):
+        """Evaluate the cells inside the domain only, the others are NaN."""
+        if inside is None:
+            return evaluate(gx, gy)
+        z = {key: numpy.full(len(gx), numpy.nan) for key in keys}
+        if inside.any():
+            for key, values in evaluate(gx[inside], gy[inside]).items():
+                z[key][inside] = values
+        return z
+
+    def _state_path(self, index=0):
+        suffix = F".{index}" if index else ''
+        return os.path.join(self._path, F"{self._title}.state{suffix}.npz")
+
+    def _output_base(self, key):
+        # Gateway ids may hold characters unfit for file names
+        name = re.sub(r'[^\w.-]', '_', key)
+        return os.path.join(self._path, F"{self._title}_{name}")
+
+    def _output_paths(self, key):
+        """Return the (variant, path) of every file written for a graph."""
+        return variant_paths(self._output_base(key), self._variants)
+
+    def _output_path(self, key):
+        return self._output_paths(key)[0][1]
+
+    def _cached_outputs(self, key, plot_key):
+        """Return the (cache key, path) of every file written for a graph."""
+        return [(digest(plot_key, variant), path)
+                for variant, path in self._output_paths(key)]
+
+    def _render_all(self, pool, a, grids):
+        """Render every graph, in worker processes with a pool or jobs."""
+        if pool is not None:
+            return self._render_parallel(pool, a, grids)
+        if self._jobs > 1:
+            with RenderPool(self._jobs) as own_pool:
+                return self._render_parallel(own_pool, a, grids)
+        return self._render(a, grids)
+
+    def _render(self, a, grids):
+        """Render every graph in this process."""
+        errors = {}
         for k, title in self.graphs.items():
+            if k not in grids:
+                continue
             try:
                 logger.info(title)
-                self._plot(a, k, title[0], title[1], gx, gy, num_x, num_y)
+                with self.metrics.stage('render', k):
+                    self._plot(a, k, title[0], title[1], grids[k])
             # pylint: disable=broad-exception-caught
             except Exception as e:
                 logger.error(e)
                 logger.warning('Cannot create %s plot: insufficient data', k)
+                errors[k] = str(e)
+        return errors
+
+    def _render_parallel(self, pool, a, grids):
+        """Render every graph in the worker processes of the pool."""
+        errors = {}
+        with SharedArrays() as shared:
+            layout_ref = shared.share(self._layout)
+            futures = {}
+            for k, title in self.graphs.items():
+                if k not in grids:
+                    continue
+                logger.info(title)
+                futures[k] = pool.submit(self, a, k, title[0], title[1],
+                                         layout_ref, shared.share(grids[k]))
+            for k, future in futures.items():
+                try:
+                    stages, worker_peak = future.result()
+                    self.metrics.extend(stages)
+                    self.metrics.worker_peak(worker_peak)
+                # pylint: disable=broad-exception-caught
+                except Exception as e:
+                    logger.error(e)
+                    logger.warning('Cannot create %s plot: insufficient data', k)
+                    errors[k] = str(e)
+        return errors
+
+    def _value_range(self, a, key):
+        """Return the (vmin, vmax) color range of a graph."""
+        if key in COVERAGE_GRAPHS:
+            return coverage_range(key, self._gateways)
+        if 'min' in self.thresholds.get(key, {}):
+            vmin = self.thresholds[key]['min']
+            logger.info('Using min threshold from thresholds: %s', vmin)
+        else:
+            vmin = float(numpy.nanmin(a[key]))
+            logger.info('Using calculated min threshold: %s', vmin)
+
+        if 'max' in self.thresholds.get(key, {}):
+            vmax = self.thresholds[key]['max']
+            logger.info('Using max threshold from thresholds: %s', vmax)
+        else:
+            vmax = float(numpy.nanmax(a[key]))
+            logger.info('Using calculated max threshold: %s', vmax)
+
+        logger.info("%s has range [%s,%s]", key, vmin, vmax)
+        return vmin, vmax
+
+    def _fit(self, a):
+        """
+        Prepare the interpolation of every graph.
+
+        Returns:
+        - uniform (dict): The constant value of the graphs without range.
+        - groups (list): The (keys, x, y, values) of the graphs measured
+          at the same points, which share one batched solve.
+
+        """
+        uniform = {}
+        keys = []
+        for key in self._channels():
+            if key not in a or numpy.isnan(a[key]).all():
+                logger.info("Skipping %s due to insufficient data", key)
+                continue
+            vmin, vmax = self._value_range(a, key)
+            # Interpolate the data only if there is something to interpolate
+            if vmin != vmax:
+                keys.append(key)
+            else:
+                # Uniform array with the same color everywhere
+                # (avoids interpolation artifacts)
+                uniform[key] = vmin
+        groups = defaultdict(list)
+        for key in keys:
+            groups[numpy.isfinite(a[key]).tobytes()].append(key)
+        fitted = []
+        for group in groups.values():
+            valid = numpy.isfinite(a[group[0]])
+            logger.info('Interpolating %s over %d points with %s',
+                        ', '.join(group), valid.sum(), self._interpolator)
+            values = numpy.column_stack([a[key][valid] for key in group])
+            fitted.append((group, a['x'][valid], a['y'][valid], values))
+        return uniform, fitted
+
+    def _field(self, a):
+        """
+        Fit the interpolators of every graph once.
+
+        Returns:
+        - keys (list): The keys of the interpolated graphs.
+        - evaluate (callable): Maps flattened (gx, gy) coordinates to a
+          dict of graph key -> interpolated values.
+
+        """
+        uniform, groups = self._fit(a)
+        fitted = [
+            (group, create_interpolator(self._interpolator, x, y,
+                                        neighbors=self._neighbors), values)
+            for group, x, y, values in groups
+        ]
+
+        def evaluate(gx, gy):
+            z = {key: numpy.full(len(gx), value) for key, value in uniform.items()}
+            for group, interpolator, values in fitted:
+                result = interpolator.evaluate(values, gx, gy)
+                for idx, key in enumerate(group):
+                    z[key] = result[:, idx]
+            return z
+
+        keys = [key for key in self._channels() if key in uniform]
+        keys += [key for group, _, _ in fitted for key in group]
+        return keys, evaluate
+
+    def _coverage_keys(self):
+        """Return the requested coverage graphs."""
+        if not self._gateways:
+            return []
+        return [key for key in self.graphs if key in COVERAGE_GRAPHS]
+
+    def _channels(self):
+        """Return the keys to interpolate, with the gateway RSSI the coverage graphs reduce."""
+        channels = [key for key in self.graphs if key not in COVERAGE_GRAPHS]
+        if self._coverage_keys():
+            channels += [gateway_column('rssi', gateway) for gateway in self._gateways
+                         if gateway_column('rssi', gateway) not in channels]
+        return channels
+
+    def _coverage(self, values):
+        """Return the requested coverage graphs reduced from the gateway RSSI values."""
+        keys = self._coverage_keys()
+        if not keys:
+            return {}
+        maps = coverage_maps(values, self._gateways, self._coverage_threshold)
+        return {key: maps[key] for key in keys}
+
+    def _colorbar_ticks(self, key):
+        """Return the (value, label) colorbar ticks of a graph, None for the default ones."""
+        if key == 'best_server':
+            return list(enumerate(self._gateways))
+        if key == 'gateway_count':
+            step = max(1, len(self._gateways) // 10)
+            return [(count, str(count)) for count in range(0, len(self._gateways) + 1, step)]
+        if key == 'redundancy':
+            return [(0, 'no'), (1, 'yes')]
+        return None
+
+    # pylint: disable=too-many-arguments
+    def _interpolate(self, a, gx, gy, num_x, num_y):
+        """
+        Interpolate every graph over the grid.
+
+        The interpolator is fitted once on the shared x/y geometry and
+        all graphs are solved together as the columns of one batched
+        right-hand side, so an extra graph costs almost nothing.
+
+        Returns:
+        - grids (dict): The (num_y, num_x) grid of every graph key.
+
+        """
+        inside = self._inside(a['x'], a['y'], gx, gy)
+        if not self._incremental:
+            with self.metrics.stage('fit'):
+                keys, evaluate = self._field(a)
+            with self.metrics.stage('evaluate'):
+                if self._max_error is not None and (inside is None or inside.any()):
+                    if inside is not None:
+                        inside = inside.reshape((num_y, num_x))
+                    return self._adaptive(a, keys, evaluate, gx[:num_x], gy[::num_x], inside)
+                z = self._evaluate_inside(evaluate, keys, gx, gy, inside)
+                return {key: values.reshape((num_y, num_x))
+                        for key, values in z.items()}
+        with self.metrics.stage('fit'):
+            uniform, groups = self._fit(a)
+        grids = {key: numpy.ones((num_y, num_x)) * value
+                 for key, value in uniform.items()}
+        with self.metrics.stage('evaluate'):
+            for index, (group, x, y, values) in enumerate(groups):
+                z = update_grid(self._state_path(index), self._interpolator,
+                                self._neighbors, x, y, values, group, gx, gy, inside)
+                for idx, key in enumerate(group):
+                    grids[key] = z[:, idx].reshape((num_y, num_x))
+        # The uniform grids are filled everywhere
+        self._clip({key: grids[key] for key in uniform}, inside)
+        return grids
+
+    @staticmethod
+    def _clip(grids, inside):
+        """Set the cells outside the domain of grids filled everywhere to NaN."""
+        if inside is not None:
+            for z in grids.values():
+                z[~inside.reshape(z.shape)] = numpy.nan
+        return grids
+
+    # pylint: disable=too-many-arguments
+    def _adaptive(self, a, keys, evaluate, x, y, inside=None):
+        """
+        Interpolate every graph over an adaptively refined grid.
+
+        The cells are refined where the bilinear fill misses the field at
+        their midpoints by more than max_error, around the survey points
+        and, with contours, where a contour level crosses them.
+
+        Returns:
+        - grids (dict): The (len(y), len(x)) grid of every graph key.
+
+        """
+        # pylint: disable=import-outside-toplevel
+        from matplotlib.ticker import MaxNLocator
+        levels = None
+        if self._contours:
+            # The levels matplotlib picks for N contours
+            levels = [MaxNLocator(self._contours + 1).tick_values(
+                *self._value_range(a, key)) for key in keys]
+
+        def columns(gx, gy):
+            z = evaluate(gx, gy)
+            return numpy.column_stack([z[key] for key in keys])
+
+        z = adaptive_grid(columns, x, y, self._max_error,
+                          points=(a['x'], a['y']), levels=levels, inside=inside)
+        return {key: z[:, :, idx] for idx, key in enumerate(keys)}
 
     # def _add_inner_title(self, ax, title, loc, size=None, **kwargs):
     #     logger.info('add_inner_title')
@@ -196,58 +817,38 @@ class HeatMapGenerator:
 
     # pylint: disable=too-many-branches
     # pylint: disable=too-many-locals
-    def _plot(self, a, key, title, unit, gx, gy, num_x, num_y):
-        if key not in a:
-            logger.info("Skipping %s due to insufficient data", key)
-            return
-        if not len(a['x']) == len(a['y']) == len(a[key]):
-            logger.info("Skipping %s because data has holes", key)
-            return
+    def _plot(self, a, key, title, unit, z):
         logger.info('Plotting: %s', key)
+        if self._renderer == 'raster':
+            self._plot_raster(a, key, title, unit, z)
+            return
+        # pylint: disable=import-outside-toplevel
+        import matplotlib
+        from matplotlib import cm
+        from matplotlib import pyplot as pp
+        from matplotlib.font_manager import FontManager
+        from PIL import Image
         pp.rcParams['figure.figsize'] = (
             self._image_width / 100, self._image_height / 100
         )
         fig, ax = pp.subplots()
         ax.set_title(title, fontname="DejaVu Sans", fontsize=10)
-        if 'min' in self.thresholds.get(key, {}):
-            vmin = self.thresholds[key]['min']
-            logger.info('Using min threshold from thresholds: %s', vmin)
-        else:
-            vmin = min(a[key])
-            logger.info('Using calculated min threshold: %s', vmin)
-
-        if 'max' in self.thresholds.get(key, {}):
-            vmax = self.thresholds[key]['max']
-            logger.info('Using max threshold from thresholds: %s', vmax)
-        else:
-            vmax = max(a[key])
-            logger.info('Using calculated max threshold: %s', vmax)
-
-        logger.info("%s has range [%s,%s]", key, vmin, vmax)
-        # Interpolate the data only if there is something to interpolate
-        if vmin != vmax:
-            rbf = Rbf(
-                a['x'], a['y'], a[key], function='linear'
-            )
-            z = rbf(gx, gy)
-            z = z.reshape((num_y, num_x))
-        else:
-            # Uniform array with the same color everywhere
-            # (avoids interpolation artifacts)
-            z = numpy.ones((num_y, num_x)) * vmin
+        vmin, vmax = self._value_range(a, key)
         # Render the interpolated data to the plot
         ax.axis('off')
 
         # begin color mapping
         norm = matplotlib.colors.Normalize(vmin=vmin, vmax=vmax, clip=True)
-        mapper = cm.ScalarMappable(norm=norm, cmap=self._cmap)
+        mapper = cm.ScalarMappable(norm=norm, cmap=self._colormap())
         # end color mapping
 
         image = ax.imshow(
             z,
             extent=(0, self._image_width, self._image_height, 0),
             alpha=0.4, zorder=100,
-            cmap=self._cmap, vmin=vmin, vmax=vmax
+            cmap=self._colormap(), vmin=vmin, vmax=vmax,
+            # The coverage graphs are counts and gateway indices
+            interpolation='nearest' if key in COVERAGE_GRAPHS else None
         )
 
         # Draw contours if requested and meaningful in this plot
@@ -269,44 +870,114 @@ class HeatMapGenerator:
         # Print only one ytick label when there is only one value to be shown
         if vmin == vmax:
             cbar.set_ticks([vmin])
+        ticks = self._colorbar_ticks(key)
+        if ticks is not None:
+            cbar.set_ticks([value for value, _ in ticks])
+            cbar.set_ticklabels([label for _, label in ticks])
 
         # Draw floor plan itself to the lowest layer with full opacity
         ax.imshow(self._layout, interpolation='bicubic', zorder=1, alpha=1)
 
         if self._show_points:
             labelsize = FontManager.get_default_size() * 0.4
+            x, y = numpy.asarray(a['x']), numpy.asarray(a['y'])
+            points = numpy.ones(len(x), dtype=bool)
+            for cx, cy in self._corners:
+                points &= (x != cx) | (y != cy)
+            x, y = x[points], y[points]
+            labels = [label for label, keep in zip(a['label'], points) if keep]
             # begin plotting points
-            for idx in range(0, len(a['x'])):
-                if (a['x'][idx], a['y'][idx]) in self._corners:
-                    continue
-                ax.plot(
-                    a['x'][idx], a['y'][idx], zorder=200,
-                    marker='o', markeredgecolor='black', markeredgewidth=0.2,
-                    markerfacecolor=mapper.to_rgba(a[key][idx]), markersize=8
-                )
-                ax.text(
-                    a['x'][idx], a['y'][idx] - 13,
-                    a['label'][idx], fontsize=labelsize,
-                    horizontalalignment='center'
-                )
+            ax.scatter(x, y, s=64, zorder=200,
+                       c=mapper.to_rgba(numpy.asarray(a[key])[points]),
+                       edgecolors='black', linewidths=0.2)
+            # Label boxes in floor plan pixels: a character is about 0.6 em
+            # wide, and the axes keep the aspect ratio of the floor plan
+            extent = ax.get_window_extent()
+            scale = max(self._image_width / extent.width,
+                        self._image_height / extent.height)
+            em = labelsize * fig.dpi / 72 * scale
+            longest = max((len(str(label)) for label in labels), default=0)
+            keep = declutter(x, y, longest * em * 0.6, em)
+            for px, py, label in zip(x[keep], y[keep],
+                                     (label for label, kept in zip(labels, keep) if kept)):
+                ax.text(px, py - 13, label, fontsize=labelsize,
+                        horizontalalignment='center')
             # end plotting points
 
-        filename = os.path.join(self._path, F"{self._title}_{key}.png")
-        logger.info('Writing plot to: %s', filename)
-        pp.savefig(filename, dpi=300)
+        # Draw once at the highest resolution, every variant is resized
+        # from the same pixels
+        dpi = render_dpi(self._variants)
+        with self.metrics.stage('write', key):
+            fig.set_dpi(dpi)
+            fig.canvas.draw()
+            image = Image.fromarray(numpy.array(fig.canvas.buffer_rgba()))
+            write_variants(image, dpi, self._output_paths(key))
         pp.close('all')
 
+    # pylint: disable=too-many-arguments,too-many-locals
+    def _plot_raster(self, a, key, title, unit, z):
+        """
+        Composite a graph straight onto the floor plan pixels.
 
-def parse_args(argv):
-    """
-    parse arguments/options
+        The grid is upsampled to the native floor plan resolution, mapped
+        through the colormap lookup table and alpha blended in NumPy,
+        and the colorbar is a cached side strip.
+        """
+        # pylint: disable=import-outside-toplevel
+        from PIL import Image, ImageDraw
+        if self._contours:
+            logger.warning('Contours are not drawn by the raster renderer')
+        vmin, vmax = self._value_range(a, key)
+        lut = colormap_lut(self._colormap())
+        base = to_rgb(self._layout)
+        height, width = base.shape[:2]
+        num_y, num_x = z.shape
+        step = (self._image_width / max(1, num_x - 1),
+                self._image_height / max(1, num_y - 1))
+        values = upsample(z, (0, 0), (width, height), step,
+                          nearest=key in COVERAGE_GRAPHS)
+        plot = Image.fromarray(blend(base, colorize(values, lut, vmin, vmax), 0.4))
 
-    this uses the new argparse module instead of optparse
-    see: <https://docs.python.org/2/library/argparse.html>
-    """
-    p = argparse.ArgumentParser(description='LoRa survey heatmap generator')
-    p.add_argument('-v', '--verbose', dest='verbose', action='count', default=0,
-                   help='verbose output. specify twice for debug-level output.')
+        if self._show_points:
+            x, y = numpy.asarray(a['x']), numpy.asarray(a['y'])
+            points = numpy.ones(len(x), dtype=bool)
+            for cx, cy in self._corners:
+                points &= (x != cx) | (y != cy)
+            draw_points(plot, x[points], y[points],
+                        colorize(numpy.asarray(a[key])[points], lut, vmin, vmax),
+                        [label for label, keep in zip(a['label'], points) if keep],
+                        radius=max(3, width / 300))
+
+        strip = colorbar_strip(lut, vmin, vmax, unit, height,
+                               ticks=self._colorbar_ticks(key))
+        band = max(16, height // 30)
+        canvas = Image.new('RGB', (width + strip.shape[1], height + band), 'white')
+        canvas.paste(plot, (0, band))
+        canvas.paste(Image.fromarray(strip), (width, band))
+        ImageDraw.Draw(canvas).text((width / 2, band / 2), title, fill='black',
+                                    font=font(band * 2 // 3), anchor='mm')
+
+        # The canvas is at a fixed resolution, so every variant has the
+        # same size whatever the others, and the default one is not resized
+        with self.metrics.stage('write', key):
+            write_variants(canvas, RASTER_DPI, self._output_paths(key))
+
+
+def add_cache_arguments(p):
+    """Add the render cache options to an argument parser."""
+    p.add_argument('--no-cache', dest='no_cache', action='store_true',
+                   help='always interpolate and render, ignoring the cache')
+    p.add_argument('--cache-dir', dest='cache_dir', action='store', type=str,
+                   default=None,
+                   help='render cache directory, defaults to '
+                   '~/.cache/lora-survey-heatmap')
+    p.add_argument('--cache-size', dest='cache_size', action='store',
+                   type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                   help='render cache size limit in MB')
+
+
+def add_render_arguments(p):
+    """Add the interpolation and rendering options to an argument parser."""
     p.add_argument('-c', '--colormap', type=str, dest='CNAME', action='store',
                    default="RdYlBu_r",
                    help='If specified, a valid matplotlib colormap name.')
@@ -315,17 +986,160 @@ def parse_args(argv):
                    help='If specified, N contour lines will be added to the graphs')
     p.add_argument('-p', '--picture', dest='IMAGE', type=str, action='store',
                    default=None, help='Path to background image')
-    p.add_argument(
-        'FILE', type=str, help='Filename for survey'
-    )
     p.add_argument('-s', '--show-points', dest='show_points', action='count',
                    default=0, help='show measurement points in file')
     p.add_argument('-t', '--thresholds', dest='thresholds', action='store',
                    type=str, help='thresholds JSON file path')
+    p.add_argument('-i', '--interpolator', dest='interpolator', action='store',
+                   choices=sorted(INTERPOLATORS), default='rbf',
+                   help='interpolation backend; rbf-local, idw and '
+                   'linear-delaunay scale to large surveys')
+    p.add_argument('-k', '--neighbors', dest='neighbors', action='store',
+                   type=int, default=None,
+                   help='neighborhood size for the rbf-local and idw backends')
+    p.add_argument('-j', '--jobs', dest='jobs', action='store', type=int,
+                   default=1, help='render the graphs in N worker processes')
+    p.add_argument('-r', '--renderer', dest='renderer', action='store',
+                   choices=['matplotlib', 'raster'], default='matplotlib',
+                   help='raster composites the graphs straight onto the floor '
+                   'plan pixels, an order of magnitude faster than matplotlib')
+    p.add_argument('--grid-step', dest='grid_step', action='store',
+                   type=float, default=4,
+                   help='distance in pixels between two interpolated grid nodes')
+    p.add_argument('--output', dest='output', action='store',
+                   type=output_spec, default=DEFAULT_OUTPUT,
+                   help='comma separated files written for every graph from '
+                   'one rendering: FORMAT:DPI with FORMAT png, png-fast, webp or jpeg, '
+                   'and thumb:SIZE for a PNG thumbnail of SIZE pixels')
+    p.add_argument('--domain', dest='domain', action='store', type=str,
+                   default=None,
+                   help=F"interpolate inside the building outline only, "
+                   F"'{PLAN}' derives it from the floor plan drawing, or a "
+                   F"JSON or GeoJSON polygon file, instead of padding the "
+                   F"floor plan corners")
+    p.add_argument('--extrapolation', dest='extrapolation', action='store',
+                   type=float, default=None,
+                   help='leave out the cells farther than EXTRAPOLATION '
+                   'pixels from every survey point, instead of padding the '
+                   'floor plan corners')
+    p.add_argument('--merge-radius', dest='merge_radius', action='store',
+                   type=float, default=None,
+                   help='merge the survey points within MERGE_RADIUS pixels of a seed '
+                   'point before interpolation, weighted by their RSSI spread')
+    p.add_argument('--outliers', dest='outlier_threshold', action='store',
+                   type=float, default=None,
+                   help='drop the survey points straying from their neighbors '
+                   'by more than this robust z-score, e.g. 3.5')
+
+
+def parse_args(argv):
+    """
+    parse arguments/options
+
+    this uses the new argparse module instead of optparse
+    see: <https://docs.python.org/2/library/argparse.html>
+    """
+    p = argparse.ArgumentParser(description='LoRa survey heatmap generator')
+    p.add_argument('-v', '--verbose', dest='verbose', action='count', default=0,
+                   help='verbose output. specify twice for debug-level output.')
+    add_render_arguments(p)
+    p.add_argument(
+        'FILE', type=str, nargs='*',
+        help='Filename for survey; several files, directories or glob '
+        'patterns render in batch'
+    )
+    p.add_argument('-m', '--manifest', dest='manifest', action='store',
+                   type=str, default=None,
+                   help='JSON or CSV manifest listing survey, image and '
+                   'thresholds to render in batch')
+    add_cache_arguments(p)
+    p.add_argument('--incremental', dest='incremental', action='store_true',
+                   help='keep the interpolation state next to the survey and '
+                   'only re-interpolate the cells around changed points')
+    p.add_argument('--max-error', dest='max_error', action='store',
+                   type=float, default=None,
+                   help='interpolate an adaptive grid, refined where a '
+                   'bilinear fill misses the cell midpoints by more than '
+                   'MAX_ERROR (dB or dBm); a heuristic, a few nodes may be '
+                   'off by more')
+    p.add_argument('--positions', dest='positions', action='store',
+                   type=str, default=None,
+                   help='read the survey FILE as a ChirpStack device data '
+                   'export, placing its button presses at the counter '
+                   'positions of this CSV or JSON file')
+    p.add_argument('--coverage-threshold', dest='coverage_threshold',
+                   action='store', type=float, default=DEFAULT_THRESHOLD,
+                   help='RSSI in dBm from which a gateway counts in the '
+                   'gateway count and redundancy maps of multi-gateway '
+                   'surveys')
+    p.add_argument('--export-grids', dest='export', action='store_true',
+                   help='also write the interpolated grids as .npy arrays, '
+                   'with a JSON index of their pixel transform')
+    p.add_argument('--zones', dest='zones', action='store', type=str,
+                   default=None,
+                   help='JSON or GeoJSON file of floor plan zones, writes '
+                   'the coverage statistics of every zone')
+    p.add_argument('--metrics', dest='metrics', action='store', type=str,
+                   default=None,
+                   help='write the duration of every stage, the survey and '
+                   'grid sizes and the peak RSS of every survey to a JSON file')
+    p.add_argument('--prometheus', dest='prometheus', action='store',
+                   type=str, default=None,
+                   help='write the same metrics to a Prometheus text file, '
+                   'e.g. for the node exporter textfile collector')
+    p.add_argument('--tiles', dest='tiles', action='store_true',
+                   help='render Deep Zoom tile pyramids instead of one PNG '
+                   'per graph, for very large floor plans')
+    p.add_argument('--tile-size', dest='tile_size', action='store', type=int,
+                   default=TILE_SIZE, help='tile size in pixels')
     args = p.parse_args(argv)
+    if not args.FILE and args.manifest is None:
+        p.error('a survey FILE or a --manifest is required')
     return args
 
 
+def render_options(args):
+    """Return the generator options of the add_render_arguments options."""
+    return {
+        'show_points': args.show_points > 0,
+        'contours': args.N,
+        'thresholds': args.thresholds,
+        'interpolator': args.interpolator,
+        'neighbors': args.neighbors,
+        'jobs': args.jobs,
+        'renderer': args.renderer,
+        'grid_step': args.grid_step,
+        'merge_radius': args.merge_radius,
+        'outlier_threshold': args.outlier_threshold,
+        'domain': args.domain,
+        'extrapolation': args.extrapolation,
+        'output': args.output,
+    }
+
+
+def create_generator(args, entry, image_cache=None, cache=None,
+                     metrics_callback=None):
+    """Create the HeatMapGenerator of a survey entry from the arguments."""
+    options = render_options(args)
+    options['thresholds'] = entry['thresholds'] or args.thresholds
+    return HeatMapGenerator(
+        image_path=entry['image'] or args.IMAGE,
+        survey_path=entry['survey'],
+        cname=args.CNAME,
+        image_cache=image_cache,
+        cache=cache,
+        incremental=args.incremental,
+        tile_size=args.tile_size if args.tiles else None,
+        max_error=args.max_error,
+        metrics_callback=metrics_callback,
+        coverage_threshold=args.coverage_threshold,
+        positions=args.positions,
+        export=args.export,
+        zones=args.zones,
+        **options
+    )
+
+
 def set_log_info():
     """set logger level to INFO"""
     set_log_level_format(logging.INFO,
@@ -355,8 +1169,67 @@ def set_log_level_format(level, formatstring):
     logger.setLevel(level)
 
 
+def write_metrics(args, reports):
+    """Write the metrics of the surveys to the requested files."""
+    if args.metrics is not None:
+        write_json(args.metrics, reports)
+    if args.prometheus is not None:
+        write_prometheus(args.prometheus, reports)
+
+
+def convert_main(argv):
+    """Convert JSON surveys to the binary survey format."""
+    p = argparse.ArgumentParser(
+        prog='lora-heatmap convert',
+        description='Convert a JSON survey to the memory mapped binary '
+        'survey format'
+    )
+    p.add_argument('SOURCE', type=str, help='JSON survey file')
+    p.add_argument('DESTINATION', type=str, nargs='?', default=None,
+                   help=F"binary survey file, defaults to SOURCE with a "
+                   F"{BINARY_SUFFIX} extension")
+    args = p.parse_args(argv)
+    destination = args.DESTINATION
+    if destination is None:
+        destination = str(Path(args.SOURCE).with_suffix(BINARY_SUFFIX))
+    survey = load_survey(args.SOURCE)
+    if not survey.found:
+        logger.error("Error: No survey points found in %s", args.SOURCE)
+        sys.exit(1)
+    write_binary(survey, destination)
+    print(F"Wrote {len(survey)} survey points to {destination} "
+          F"({os.path.getsize(args.SOURCE)} -> "
+          F"{os.path.getsize(destination)} bytes)")
+
+
+def serve_main(argv):
+    """Run the render service, see service.py."""
+    # The service builds on this module, it is only imported when used
+    # pylint: disable=import-outside-toplevel,cyclic-import
+    from service import main as service_main
+    service_main(argv)
+
+
+def series_main(argv):
+    """Compare a series of surveys, see series.py."""
+    # pylint: disable=import-outside-toplevel,cyclic-import
+    from series import main as series_main_
+    series_main_(argv)
+
+
+SUBCOMMANDS = {
+    'convert': convert_main,
+    'ingest': ingest_main,
+    'serve': serve_main,
+    'series': series_main,
+}
+
+
 def main():
     """ main entry """
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+        return
     args = parse_args(sys.argv[1:])
 
     # set logging level
@@ -366,14 +1239,36 @@ def main():
         set_log_info()
 
     print(args)
-    HeatMapGenerator(
-        image_path=args.IMAGE,
-        survey_path=args.FILE,
-        cname=args.CNAME,
-        show_points=args.show_points > 0,
-        contours=args.N,
-        thresholds=args.thresholds
-    ).generate()
+    if args.manifest is not None:
+        entries = read_manifest(args.manifest)
+    else:
+        entries = [{'survey': survey, 'image': None, 'thresholds': None}
+                   for survey in expand_surveys(args.FILE)]
+    cache = None
+    if not args.no_cache:
+        cache = RenderCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    reports = []
+    if len(entries) == 1 and args.manifest is None:
+        create_generator(args, entries[0], cache=cache,
+                         metrics_callback=reports.append).generate()
+        write_metrics(args, reports)
+        return
+
+    pool = RenderPool(args.jobs) if args.jobs > 1 else None
+    try:
+        results = run_batch(
+            entries,
+            lambda entry, images: create_generator(args, entry, images, cache,
+                                                   reports.append),
+            pool=pool, image=args.IMAGE
+        )
+    finally:
+        if pool is not None:
+            pool.close()
+    print_summary(results)
+    write_metrics(args, reports)
+    if any(result.status == 'failed' for result in results):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,119 @@
+"""Module providing the incremental interpolation of the Heat Map Generator.
+
+The fitted survey points and the interpolated grid are kept next to the
+survey. When points are appended, moved or deleted, only the grid cells
+whose k nearest neighbors changed are evaluated again: for the local
+backends a cell value only depends on its k nearest survey points, so a
+cell is unaffected as long as no changed point lies closer than its
+previous k-th neighbor. With an interpolation domain, the cells outside
+it are not evaluated, and are evaluated once they come inside it.
+"""
+
+import json
+import logging
+import os
+from collections import Counter
+
+import numpy
+
+from interpolation import INTERPOLATORS, create_interpolator
+
+logger = logging.getLogger()
+
+SUPPORTED = ('idw', 'rbf-local')
+
+
+def _neighbors(method, neighbors, count):
+    return min(neighbors or INTERPOLATORS[method].default_neighbors, count)
+
+
+def _load(path):
+    if not os.path.exists(path):
+        return None
+    with numpy.load(path) as data:
+        state = {name: data[name] for name in data.files}
+    state['meta'] = json.loads(str(state['meta']))
+    return state
+
+
+def _changed_points(old_points, new_points):
+    """Return the locations of the points present in only one of the sets."""
+    old_rows = Counter(map(tuple, old_points))
+    new_rows = Counter(map(tuple, new_points))
+    changed = (old_rows - new_rows) + (new_rows - old_rows)
+    return numpy.array([row[:2] for row in changed.elements()]).reshape(-1, 2)
+
+
+# pylint: disable=too-many-arguments,too-many-locals,import-outside-toplevel
+def update_grid(path, method, neighbors, x, y, values, keys, gx, gy, inside=None):
+    """
+    Interpolate the values over the grid, reusing the state at path.
+
+    Parameters:
+    - path (str): The state file kept next to the survey.
+    - method (str): The interpolator, only the SUPPORTED local
+      backends are updated incrementally.
+    - neighbors (int): Neighborhood size of the interpolator.
+    - x, y (list): The coordinates of the survey points.
+    - values (numpy.ndarray): The (N, C) values of the C keys.
+    - keys (list): The names of the value columns.
+    - gx, gy (numpy.ndarray): The flattened grid coordinates.
+    - inside (numpy.ndarray): The grid cells inside the interpolation
+      domain, None for every cell.
+
+    Returns:
+    - z (numpy.ndarray): The (M, C) interpolated grid, NaN outside the
+      domain.
+
+    """
+    from scipy.spatial import cKDTree
+    points = numpy.column_stack((x, y)).astype(float)
+    rows = numpy.column_stack((points, values))
+    interpolator = create_interpolator(method, x, y, neighbors=neighbors)
+    if inside is None:
+        inside = numpy.ones(len(gx), dtype=bool)
+    if method not in SUPPORTED:
+        logger.info('Incremental mode needs one of %s, interpolating %s',
+                    ', '.join(SUPPORTED), method)
+        z = numpy.full((len(gx), len(keys)), numpy.nan)
+        if inside.any():
+            z[inside] = interpolator.evaluate(values, gx[inside], gy[inside]).reshape(-1, len(keys))
+        return z
+
+    k = _neighbors(method, neighbors, len(points))
+    meta = {'method': method, 'k': k, 'keys': list(keys)}
+    state = _load(path)
+    grid = numpy.column_stack((gx, gy))
+    tree = cKDTree(points)
+    reusable = state is not None and state['meta'] == meta
+    if reusable:
+        reusable = numpy.array_equal(state['grid'], grid)
+    if not reusable:
+        logger.info('Interpolating the full grid of %d cells', inside.sum())
+        # The cells never evaluated have a NaN k-th neighbor distance
+        z = numpy.full((len(grid), len(keys)), numpy.nan)
+        kdist = numpy.full(len(grid), numpy.nan)
+        affected = inside
+    else:
+        z, kdist = state['z'], state['kdist']
+        # The cells which came inside the domain
+        affected = inside & numpy.isnan(kdist)
+        changed = _changed_points(state['rows'], rows)
+        if len(changed) and not numpy.isnan(kdist).all():
+            distance, _ = cKDTree(changed).query(
+                grid, distance_upper_bound=numpy.nanmax(kdist) * (1 + 1e-9))
+            stale = distance <= kdist * (1 + 1e-9)
+            # The stale cells outside the domain are evaluated once inside
+            kdist[stale & ~inside] = numpy.nan
+            affected = affected | (stale & inside)
+            logger.info('%d changed points, re-interpolating %d of %d cells',
+                        len(changed), affected.sum(), len(grid))
+        elif not affected.any():
+            logger.info('Survey points unchanged, reusing the grid')
+    if affected.any():
+        z[affected] = interpolator.evaluate(
+            values, gx[affected], gy[affected]).reshape(-1, len(keys))
+        kdist[affected] = tree.query(grid[affected], k=[k])[0][:, 0]
+    numpy.savez(path, meta=json.dumps(meta), rows=rows, grid=grid,
+                z=z, kdist=kdist)
+    return numpy.where(inside[:, None], z, numpy.nan)
@@ -0,0 +1,214 @@
+"""Module providing the interpolation backends of the Heat Map Generator.
+
+Every backend fits the survey geometry (the x/y coordinates) once and
+then evaluates any number of value channels over a grid in a single
+batched pass: ``values`` is an (N,) vector or an (N, C) matrix holding
+one column per metric, and the result is (M,) or (M, C) accordingly.
+"""
+
+import logging
+import warnings
+
+import numpy
+
+logger = logging.getLogger()
+
+# Grid cells evaluated per block by the dense backend, bounds the
+# temporary grid-to-point distance matrix to CHUNK_SIZE * N floats.
+CHUNK_SIZE = 4096
+
+# scipy is imported by the backends themselves, so that the command
+# line starts without it.
+# pylint: disable=too-few-public-methods,import-outside-toplevel
+
+
+def _as_matrix(values):
+    values = numpy.asarray(values, dtype=float)
+    return values.reshape(len(values), -1), values.ndim == 1
+
+
+def _as_result(z, flat):
+    return z[:, 0] if flat else z
+
+
+class RbfInterpolator:
+    """Global linear radial basis function, as historically used by _plot.
+
+    The N x N distance matrix is LU-factored once; every channel is then
+    a right-hand side of the same factorization. Exact, but O(N^3) to fit
+    and O(N*M) to evaluate, use it for small surveys only. Survey points
+    sharing their coordinates make the matrix singular, which raises
+    LinAlgError as scipy.interpolate.Rbf did.
+    """
+
+    default_neighbors = None
+
+    # pylint: disable=unused-argument
+    def __init__(self, x, y, neighbors=None):
+        from scipy.linalg import LinAlgWarning, lu_factor
+        self._points = numpy.column_stack((x, y))
+        # lu_factor only warns about a singular matrix
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', LinAlgWarning)
+            self._lu = lu_factor(self._distances(self._points))
+        # Pivots lost in the rounding of the largest one are singular too
+        pivots = numpy.abs(numpy.diag(self._lu[0]))
+        if not pivots.min() > numpy.spacing(pivots.max()) * len(pivots):
+            raise numpy.linalg.LinAlgError('Singular matrix')
+
+    def _distances(self, grid):
+        return numpy.hypot(
+            grid[:, 0, None] - self._points[None, :, 0],
+            grid[:, 1, None] - self._points[None, :, 1]
+        )
+
+    def evaluate(self, values, gx, gy):
+        """Evaluate the (N,) or (N, C) values over the (gx, gy) grid."""
+        from scipy.linalg import lu_solve
+        values, flat = _as_matrix(values)
+        nodes = lu_solve(self._lu, values)
+        if not numpy.isfinite(nodes).all():
+            raise numpy.linalg.LinAlgError('The radial basis function weights are not finite')
+        grid = numpy.column_stack((gx, gy))
+        z = numpy.empty((len(grid), values.shape[1]))
+        for start in range(0, len(grid), CHUNK_SIZE):
+            stop = start + CHUNK_SIZE
+            z[start:stop] = self._distances(grid[start:stop]) @ nodes
+        return _as_result(z, flat)
+
+
+class LocalRbfInterpolator:
+    """Linear radial basis function limited to the k nearest survey points.
+
+    Every grid cell only solves the small system of its neighborhood,
+    which keeps fit and evaluation cost near-linear in the point count.
+    """
+
+    default_neighbors = 16
+
+    def __init__(self, x, y, neighbors=None):
+        self._points = numpy.column_stack((x, y))
+        self._k = min(neighbors or self.default_neighbors, len(self._points))
+        self._rbf = None
+        self._values = None
+
+    def evaluate(self, values, gx, gy):
+        """Evaluate the (N,) or (N, C) values over the (gx, gy) grid."""
+        from scipy.interpolate import RBFInterpolator
+        values, flat = _as_matrix(values)
+        # The tiles evaluate the same values once per tile: the
+        # RBFInterpolator and its KD-tree are only built again when the
+        # values change. It solves every neighborhood once for all columns.
+        if self._rbf is None or not numpy.array_equal(values, self._values):
+            self._rbf = RBFInterpolator(self._points, values,
+                                        neighbors=self._k, kernel='linear')
+            self._values = values
+        return _as_result(self._rbf(numpy.column_stack((gx, gy))), flat)
+
+
+class IdwInterpolator:
+    """Inverse distance weighting over the k nearest survey points.
+
+    The neighbors are looked up in a KD-tree, so the cost is
+    O(N log N) to build and O(M k log N) to evaluate.
+    """
+
+    default_neighbors = 8
+    power = 2
+
+    def __init__(self, x, y, neighbors=None):
+        from scipy.spatial import cKDTree
+        self._tree = cKDTree(numpy.column_stack((x, y)))
+        self._k = min(neighbors or self.default_neighbors, self._tree.n)
+
+    def weights(self, gx, gy):
+        """Return the (M, k) neighbor indices and normalized weights."""
+        dist, idx = self._tree.query(numpy.column_stack((gx, gy)), k=self._k)
+        dist, idx = dist.reshape(len(dist), -1), idx.reshape(len(idx), -1)
+        with numpy.errstate(divide='ignore'):
+            weights = 1.0 / dist ** self.power
+        # A grid cell sitting exactly on a survey point takes its value
+        exact = numpy.isinf(weights)
+        hits = exact.any(axis=1)
+        weights[hits] = exact[hits]
+        return idx, weights / weights.sum(axis=1, keepdims=True)
+
+    def evaluate(self, values, gx, gy):
+        """Evaluate the (N,) or (N, C) values over the (gx, gy) grid."""
+        values, flat = _as_matrix(values)
+        idx, weights = self.weights(gx, gy)
+        z = numpy.einsum('mk,mkc->mc', weights, values[idx])
+        return _as_result(z, flat)
+
+
+class DelaunayInterpolator:
+    """Piecewise linear interpolation over the Delaunay triangulation.
+
+    Cells outside the convex hull of the survey take the value of the
+    nearest survey point.
+    """
+
+    default_neighbors = None
+
+    # pylint: disable=unused-argument
+    def __init__(self, x, y, neighbors=None):
+        from scipy.spatial import Delaunay, cKDTree
+        points = numpy.column_stack((x, y))
+        self._triangulation = Delaunay(points)
+        self._tree = cKDTree(points)
+
+    def weights(self, gx, gy):
+        """Return the (M, 3) vertex indices and barycentric weights."""
+        grid = numpy.column_stack((gx, gy))
+        simplex = self._triangulation.find_simplex(grid)
+        inside = simplex >= 0
+        transform = self._triangulation.transform[simplex[inside]]
+        partial = numpy.einsum(
+            'mij,mj->mi', transform[:, :2], grid[inside] - transform[:, 2])
+        idx = numpy.zeros((len(grid), 3), dtype=int)
+        weights = numpy.zeros((len(grid), 3))
+        idx[inside] = self._triangulation.simplices[simplex[inside]]
+        weights[inside] = numpy.column_stack(
+            (partial, 1 - partial.sum(axis=1)))
+        if not inside.all():
+            _, idx[~inside, 0] = self._tree.query(grid[~inside])
+            weights[~inside, 0] = 1
+        return idx, weights
+
+    def evaluate(self, values, gx, gy):
+        """Evaluate the (N,) or (N, C) values over the (gx, gy) grid."""
+        values, flat = _as_matrix(values)
+        idx, weights = self.weights(gx, gy)
+        z = numpy.einsum('mk,mkc->mc', weights, values[idx])
+        return _as_result(z, flat)
+
+
+INTERPOLATORS = {
+    'rbf': RbfInterpolator,
+    'rbf-local': LocalRbfInterpolator,
+    'idw': IdwInterpolator,
+    'linear-delaunay': DelaunayInterpolator,
+}
+
+
+def create_interpolator(method, x, y, neighbors=None):
+    """
+    Create an interpolator over the given survey point geometry.
+
+    Parameters:
+    - method (str): One of the keys of INTERPOLATORS.
+    - x (list): The x coordinates of the survey points.
+    - y (list): The y coordinates of the survey points.
+    - neighbors (int): Neighborhood size for the local backends.
+
+    Returns:
+    - interpolator: An object whose evaluate(values, gx, gy) method
+      interpolates one or several value channels over a grid.
+
+    """
+    if method not in INTERPOLATORS:
+        raise ValueError(F"Unknown interpolator: {method}")
+    logger.debug('Creating %s interpolator over %d points', method, len(x))
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    return INTERPOLATORS[method](x, y, neighbors=neighbors)
@@ -0,0 +1,184 @@
+"""Module providing the stage metrics of the Heat Map Generator.
+
+Every HeatMapGenerator records how long each stage of a survey took
+(survey load, image decode, grid build, interpolation fit and evaluate,
+and the render and write of every graph), along with the point and grid
+sizes and the peak RSS. On Linux, the high-water mark of the process is
+reset at the start of every survey, and of every graph in the render
+workers of --jobs, so the peak RSS is that of the survey even in batch
+mode; elsewhere it is the high-water mark over the process lifetime. The
+metrics of a run can be written as JSON, as a Prometheus text file for
+the node exporter textfile collector, or handed to a Python callback.
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+logger = logging.getLogger()
+
+PROMETHEUS_PREFIX = 'heatmap'
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of this process to its current one, True if it was."""
+    try:
+        # Linux only, 5 resets the high-water mark of the process
+        with open('/proc/self/clear_refs', 'w', encoding='ascii') as fh:
+            fh.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss_bytes():
+    """Return the peak resident set size of this process since its last reset, None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Metrics:
+    """Stage durations and sizes of one survey.
+
+    Attributes:
+        survey (str): The survey title.
+        stages (list): One {'stage', 'key', 'seconds'} record per timed
+            stage, key is None for the stages shared by every graph.
+        values (dict): The point count, grid cells and other sizes.
+    """
+
+    def __init__(self, survey):
+        self.survey = survey
+        self.stages = []
+        self.values = {}
+        self._nested = []
+        self._worker_peak = None
+
+    @contextmanager
+    def stage(self, name, key=None):
+        """Time a block as a stage.
+
+        Nested stages are subtracted from the enclosing one, so every
+        second is only counted once.
+        """
+        self._nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+            self.record(name, elapsed - nested, key)
+
+    def record(self, name, seconds, key=None):
+        """Add the duration of a stage."""
+        self.stages.append({'stage': name, 'key': key, 'seconds': seconds})
+
+    def extend(self, stages):
+        """Add stage records measured elsewhere, e.g. in a render worker."""
+        self.stages.extend(stages)
+
+    def worker_peak(self, peak):
+        """Account for the peak RSS reported by a render worker."""
+        if peak is not None:
+            self._worker_peak = max(peak, self._worker_peak or 0)
+
+    def set(self, name, value):
+        """Set a size of the survey, e.g. its point count."""
+        self.values[name] = value
+
+    def as_dict(self):
+        """Return the metrics as a JSON serializable dict."""
+        return {
+            'survey': self.survey,
+            'seconds': sum(record['seconds'] for record in self.stages),
+            'stages': list(self.stages),
+            **self.values,
+            'peak_rss_bytes': peak_rss_bytes(),
+            'worker_peak_rss_bytes': self._worker_peak,
+        }
+
+
+def _write_atomic(path, text):
+    tmp_path = F"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as fh:
+        fh.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_json(path, reports):
+    """Write the metrics dicts of a run as JSON."""
+    _write_atomic(path, json.dumps({'surveys': reports}, indent=2))
+    logger.info('Wrote metrics: %s', path)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(F'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+# Per survey gauges, named after their entry in the metrics dict
+GAUGES = {
+    'seconds': 'Total duration of the survey stages.',
+    'points': 'Number of survey points.',
+    'points_used': 'Number of survey points left after the outlier and merge preprocessing.',
+    'grid_cells': 'Number of interpolated grid cells.',
+    'errors': 'Number of graphs that could not be created.',
+    'peak_rss_bytes': 'Peak resident set size of the generating process during the survey.',
+    'worker_peak_rss_bytes': 'Largest peak resident set size of the render workers '
+                             'during the survey.',
+}
+
+
+def _survey_labels(report, **labels):
+    # The title is the file stem, the surveys of a batch may share it
+    return _labels(survey=report['survey'], file=report.get('file', ''), **labels)
+
+
+def prometheus_text(reports):
+    """Return the metrics dicts of a run in the Prometheus text format."""
+    lines = [
+        F"# HELP {PROMETHEUS_PREFIX}_stage_seconds Duration of a stage of the heatmap generation.",
+        F"# TYPE {PROMETHEUS_PREFIX}_stage_seconds gauge",
+    ]
+    for report in reports:
+        totals = {}
+        for record in report['stages']:
+            labels = (record['stage'], record['key'] or '')
+            totals[labels] = totals.get(labels, 0) + record['seconds']
+        for (stage, key), seconds in totals.items():
+            lines.append(F"{PROMETHEUS_PREFIX}_stage_seconds"
+                         F"{_survey_labels(report, stage=stage, key=key)} {seconds:.6f}")
+    for name, description in GAUGES.items():
+        lines.append(F"# HELP {PROMETHEUS_PREFIX}_survey_{name} {description}")
+        lines.append(F"# TYPE {PROMETHEUS_PREFIX}_survey_{name} gauge")
+        for report in reports:
+            value = report.get(name)
+            if isinstance(value, dict):
+                value = len(value)
+            if value is not None:
+                lines.append(F"{PROMETHEUS_PREFIX}_survey_{name}"
+                             F"{_survey_labels(report)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path, reports):
+    """Write the metrics dicts of a run as a Prometheus text file."""
+    _write_atomic(path, prometheus_text(reports))
+    logger.info('Wrote Prometheus metrics: %s', path)
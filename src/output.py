@@ -0,0 +1,117 @@
+"""Module providing the output variants of the Heat Map Generator.
+
+An output spec such as png:300,webp:72,thumb:256 lists the files written
+for every graph: a format and its resolution in dpi, or the longest side
+in pixels of a thumbnail. The graph is composited once, at the highest
+resolution requested, and every variant is resized from that image and
+encoded in a thread pool, the Pillow encoders releasing the GIL.
+
+The matplotlib renderer draws the floor plan pixels as figure inches of
+BASE_DPI pixels, png:300 at three times the floor plan size. The raster
+renderer composites at the floor plan size, labelled RASTER_DPI, the
+default resolution, so the default png is written as composited and the
+other variants are resized from it, whatever the others requested.
+
+PNG files keep the default Pillow compression, png-fast trades about a
+quarter larger files for a faster encoding.
+"""
+
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+DEFAULT_OUTPUT = 'png:300'
+BASE_DPI = 100
+# The resolution of the raster renderer canvas, that of the default variant
+RASTER_DPI = 300
+
+# Format -> (Pillow format, file suffix, default value, save options)
+FORMATS = {
+    'png': ('PNG', '.png', 300, {}),
+    'png-fast': ('PNG', '.png', 300, {'compress_level': 1}),
+    'webp': ('WEBP', '.webp', 300, {'quality': 85}),
+    'jpeg': ('JPEG', '.jpg', 300, {'quality': 90}),
+    'jpg': ('JPEG', '.jpg', 300, {'quality': 90}),
+    'thumb': ('PNG', '_thumb.png', 256, {}),
+}
+
+OutputVariant = namedtuple('OutputVariant', 'fmt value')
+
+
+def output_spec(spec):
+    """
+    Parse an output spec.
+
+    Returns:
+    - variants (list): The OutputVariant of every entry.
+
+    """
+    variants = []
+    for entry in spec.split(','):
+        fmt, _, value = entry.strip().lower().partition(':')
+        if fmt not in FORMATS:
+            raise ValueError(F"Unknown output format: {fmt}")
+        value = int(value) if value else FORMATS[fmt][2]
+        if value <= 0:
+            raise ValueError(F"Invalid {fmt} resolution: {value}")
+        variants.append(OutputVariant(fmt, value))
+    return variants
+
+
+def render_dpi(variants):
+    """Return the dpi the graphs are composited at for the variants."""
+    return max((variant.value for variant in variants if variant.fmt != 'thumb'),
+               default=BASE_DPI)
+
+
+def variant_paths(base, variants):
+    """Return the (variant, path) of every variant, the paths made unique."""
+    paths = []
+    for variant in variants:
+        suffix = FORMATS[variant.fmt][1]
+        path = F"{base}{suffix}"
+        if path in [existing for _, existing in paths]:
+            stem, dot, extension = suffix.rpartition('.')
+            path = F"{base}{stem}_{variant.value}{dot}{extension}"
+        paths.append((variant, path))
+    return paths
+
+
+def _write(image, dpi, variant, path):
+    # pylint: disable=import-outside-toplevel
+    from PIL import Image
+    pil_format, _, _, options = FORMATS[variant.fmt]
+    if variant.fmt == 'thumb':
+        scale = variant.value / max(image.size)
+        dpi = dpi * scale
+    else:
+        scale = variant.value / dpi
+        dpi = variant.value
+    if scale != 1:
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.Resampling.LANCZOS)
+    if pil_format == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    logger.info('Writing plot to: %s', path)
+    image.save(path, pil_format, dpi=(dpi, dpi), **options)
+
+
+def write_variants(image, dpi, outputs):
+    """
+    Write every variant of a composited graph.
+
+    Parameters:
+    - image (PIL.Image.Image): The graph, composited at dpi.
+    - dpi (float): The resolution of the image.
+    - outputs (list): The (variant, path) of every file to write.
+
+    """
+    if len(outputs) == 1:
+        _write(image, dpi, *outputs[0])
+        return
+    with ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+        for future in [executor.submit(_write, image, dpi, variant, path)
+                       for variant, path in outputs]:
+            future.result()
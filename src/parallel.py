@@ -0,0 +1,129 @@
+"""Module providing the parallel renderer of the Heat Map Generator.
+
+Each graph is rendered by a worker process running the non-interactive
+Agg backend. The floor plan and the interpolated grids are handed to the
+workers through shared memory blocks, only their names, shapes and
+dtypes are pickled.
+"""
+
+import gc
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy
+
+from metrics import Metrics, peak_rss_bytes, reset_peak_rss
+
+logger = logging.getLogger()
+
+
+class SharedArrays:
+    """Copy numpy arrays into shared memory blocks owned by this process."""
+
+    def __init__(self):
+        self._blocks = {}
+
+    def share(self, array):
+        """
+        Copy an array into a new shared memory block.
+
+        Returns:
+        - ref (tuple): The (name, shape, dtype) used by attach().
+
+        """
+        array = numpy.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True,
+                                           size=max(array.nbytes, 1))
+        numpy.ndarray(array.shape, dtype=array.dtype,
+                      buffer=block.buf)[...] = array
+        self._blocks[block.name] = block
+        return block.name, array.shape, array.dtype.str
+
+    def release(self, ref):
+        """Free the shared memory block of a single array."""
+        block = self._blocks.pop(ref[0], None)
+        if block is not None:
+            block.close()
+            block.unlink()
+
+    def close(self):
+        """Free every shared memory block."""
+        for name in list(self._blocks):
+            self.release((name,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach(ref):
+    """
+    Attach to an array shared by SharedArrays.share.
+
+    Returns:
+    - (block, array): The shared memory block, to be closed once the
+      array is no longer used, and the numpy view on it.
+
+    """
+    name, shape, dtype = ref
+    block = shared_memory.SharedMemory(name=name)
+    return block, numpy.ndarray(shape, dtype=numpy.dtype(dtype),
+                                buffer=block.buf)
+
+
+def _init_worker():
+    # pylint: disable=import-outside-toplevel
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+# pylint: disable=too-many-arguments,protected-access
+def _render(generator, a, key, title, unit, layout_ref, z_ref):
+    layout_block, layout = attach(layout_ref)
+    z_block, z = attach(z_ref)
+    try:
+        generator._layout = layout
+        reset_peak_rss()
+        generator.metrics = Metrics(generator._title)
+        with generator.metrics.stage('render', key):
+            generator._plot(a, key, title, unit, z)
+    finally:
+        generator._layout = None
+        del layout, z
+        # Drop lingering matplotlib references to the views before
+        # closing, the buffers cannot be unmapped while exported.
+        gc.collect()
+        for block in (layout_block, z_block):
+            try:
+                block.close()
+            except BufferError:
+                logger.debug('Shared block %s still referenced', block.name)
+    return generator.metrics.stages, peak_rss_bytes()
+
+
+class RenderPool:
+    """Pool of worker processes rendering graphs with the Agg backend."""
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self._executor = ProcessPoolExecutor(max_workers=jobs,
+                                             initializer=_init_worker)
+
+    # pylint: disable=too-many-arguments
+    def submit(self, generator, a, key, title, unit, layout_ref, z_ref):
+        """Render one graph in a worker, returns a future of its stage metrics and peak RSS."""
+        return self._executor.submit(_render, generator, a, key, title,
+                                     unit, layout_ref, z_ref)
+
+    def close(self):
+        """Wait for the pending renders and stop the workers."""
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,153 @@
+"""Module providing the survey point preprocessing of the Heat Map Generator.
+
+Repeated button presses at nearly the same spot make the global RBF
+system ill-conditioned and larger than needed. Before interpolation the
+survey points can be:
+- filtered: a point whose measurements stray from the median of its
+  nearest neighbors by more than a robust z-score (based on the median
+  absolute deviation of all the residuals) is dropped;
+- merged: in survey order, every point not merged yet seeds a cluster
+  absorbing the points within the radius of it that are not merged yet
+  either. A cluster becomes one point at its weighted mean, which stays
+  within the radius of the seed, however dense the survey. A press
+  weighs 1 / (1 + spread), the spread being its sensor_rssi_max -
+  sensor_rssi_min, so steady presses count more; the *_min and *_max
+  columns keep the min and max.
+
+Both use a KD-tree and run in O(N log N) for a bounded density.
+"""
+
+import logging
+import warnings
+
+import numpy
+
+logger = logging.getLogger()
+
+# Measurements compared with their neighbors to find the outliers
+OUTLIER_KEYS = ('sensor_rssi', 'sensor_snr', 'gateway_rssi', 'gateway_snr')
+OUTLIER_NEIGHBORS = 8
+
+# Scales the median absolute deviation to the standard deviation of a
+# normal distribution
+MAD_SCALE = 0.6745
+
+
+def _select(a, keep):
+    """Return the points of a data dict where keep is set."""
+    selected = {k: v[keep] for k, v in a.items() if k != 'label'}
+    selected['label'] = [label for label, kept in zip(a['label'], keep) if kept]
+    return selected
+
+
+def drop_outliers(a, threshold, neighbors=OUTLIER_NEIGHBORS):
+    """
+    Drop the points whose measurements stray from their neighbors.
+
+    Parameters:
+    - a (dict): The survey data, see HeatMapGenerator.load_data.
+    - threshold (float): The robust z-score above which a point is dropped.
+    - neighbors (int): The neighbors a point is compared with.
+
+    Returns:
+    - a (dict): The survey data without the outliers.
+    - dropped (int): The number of dropped points.
+
+    """
+    # pylint: disable=import-outside-toplevel
+    from scipy.spatial import cKDTree
+    count = len(a['x'])
+    if count <= neighbors:
+        return a, 0
+    xy = numpy.column_stack((a['x'], a['y']))
+    _, nearest = cKDTree(xy).query(xy, k=neighbors + 1)
+    outliers = numpy.zeros(count, dtype=bool)
+    with warnings.catch_warnings():
+        # Points without a measurement have an all-NaN neighborhood
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for key in OUTLIER_KEYS:
+            if key not in a:
+                continue
+            values = a[key]
+            residual = values - numpy.nanmedian(values[nearest[:, 1:]], axis=1)
+            center = numpy.nanmedian(residual)
+            mad = numpy.nanmedian(numpy.abs(residual - center))
+            if numpy.isnan(mad) or mad <= 0:
+                continue
+            outliers |= numpy.abs(MAD_SCALE * (residual - center) / mad) > threshold
+    if not outliers.any():
+        return a, 0
+    return _select(a, ~outliers), int(outliers.sum())
+
+
+# pylint: disable=too-many-locals
+def merge_points(a, radius):
+    """
+    Merge the points within a radius of a seed point into their weighted mean.
+
+    Parameters:
+    - a (dict): The survey data, see HeatMapGenerator.load_data.
+    - radius (float): The merge radius in floor plan pixels.
+
+    Returns:
+    - a (dict): The survey data with one point per cluster, labelled
+      after its seed.
+    - merged (int): The number of points merged away.
+
+    """
+    # pylint: disable=import-outside-toplevel
+    from scipy.sparse import coo_matrix
+    from scipy.spatial import cKDTree
+    count = len(a['x'])
+    pairs = cKDTree(numpy.column_stack((a['x'], a['y']))).query_pairs(
+        radius, output_type='ndarray')
+    if not len(pairs):  # pylint: disable=use-implicit-booleaness-not-len
+        return a, 0
+    graph = coo_matrix((numpy.ones(2 * len(pairs)),
+                        (numpy.concatenate((pairs[:, 0], pairs[:, 1])),
+                         numpy.concatenate((pairs[:, 1], pairs[:, 0])))),
+                       shape=(count, count)).tocsr()
+    # Greedy clustering around seeds; chaining the pairs instead would
+    # merge a line of close points into one, far from most of them
+    cluster = numpy.full(count, -1)
+    clusters = 0
+    indptr, indices = graph.indptr.tolist(), graph.indices
+    for seed in range(count):
+        if cluster[seed] >= 0:
+            continue
+        cluster[seed] = clusters
+        if indptr[seed] != indptr[seed + 1]:
+            neighbors = indices[indptr[seed]:indptr[seed + 1]]
+            cluster[neighbors[cluster[neighbors] < 0]] = clusters
+        clusters += 1
+    spread = numpy.zeros(count)
+    if 'sensor_rssi_max' in a and 'sensor_rssi_min' in a:
+        spread = numpy.nan_to_num(a['sensor_rssi_max'] - a['sensor_rssi_min'])
+    weights = 1 / (1 + numpy.abs(spread))
+
+    def weighted_mean(values):
+        valid = numpy.isfinite(values)
+        total = numpy.bincount(cluster, numpy.where(valid, values * weights, 0), clusters)
+        weight = numpy.bincount(cluster, numpy.where(valid, weights, 0), clusters)
+        return numpy.divide(total, weight, out=numpy.full(clusters, numpy.nan),
+                            where=weight > 0)
+
+    def extreme(values, ufunc, start):
+        result = numpy.full(clusters, start)
+        ufunc.at(result, cluster, values)
+        result[numpy.isinf(result)] = numpy.nan
+        return result
+
+    merged = {}
+    for key, values in a.items():
+        if key == 'label':
+            continue
+        if key.endswith('_min'):
+            merged[key] = extreme(values, numpy.fmin, numpy.inf)
+        elif key.endswith('_max'):
+            merged[key] = extreme(values, numpy.fmax, -numpy.inf)
+        else:
+            merged[key] = weighted_mean(values)
+    _, first = numpy.unique(cluster, return_index=True)
+    merged['label'] = [a['label'][index] for index in first]
+    return merged, count - clusters
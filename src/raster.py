@@ -0,0 +1,243 @@
+"""Module providing the raster helpers of the Heat Map Generator.
+
+Vectorized colormapping and alpha compositing of interpolated grids over
+floor plan pixels, without going through matplotlib figures.
+"""
+
+import numpy
+
+LUT_SIZE = 256
+
+# Colorbar strips already drawn, keyed by their lookup table and labels
+_strips = {}
+
+
+def colormap_lut(cmap, size=LUT_SIZE):
+    """Return the (size, 4) uint8 RGBA lookup table of a colormap."""
+    return numpy.round(cmap(numpy.linspace(0, 1, size)) * 255).astype(numpy.uint8)
+
+
+def colorize(z, lut, vmin, vmax):
+    """
+    Map a grid of values to RGBA pixels through a lookup table.
+
+    Values are clipped to [vmin, vmax]; NaN values are fully transparent.
+
+    Returns:
+    - rgba (numpy.ndarray): The uint8 RGBA pixels, shaped like z plus 4.
+
+    """
+    scale = (len(lut) - 1) / (vmax - vmin) if vmax != vmin else 0
+    with numpy.errstate(invalid='ignore'):
+        index = numpy.clip((z - vmin) * scale, 0, len(lut) - 1)
+    missing = numpy.isnan(index)
+    index[missing] = 0
+    rgba = lut[index.astype(numpy.intp)]
+    rgba[missing, 3] = 0
+    return rgba
+
+
+def to_rgb(image):
+    """Convert a decoded floor plan (float or uint8, gray or RGB(A)) to uint8 RGB."""
+    image = numpy.asarray(image)
+    if image.dtype != numpy.uint8:
+        image = numpy.round(numpy.clip(image, 0, 1) * 255).astype(numpy.uint8)
+    if image.ndim == 2:
+        image = numpy.repeat(image[:, :, None], 3, axis=2)
+    return image[:, :, :3]
+
+
+def blend(base, overlay, alpha):
+    """
+    Alpha-blend RGBA overlay pixels over RGB base pixels.
+
+    Parameters:
+    - base (numpy.ndarray): The (h, w, 3) uint8 floor plan pixels.
+    - overlay (numpy.ndarray): The (h, w, 4) uint8 heat layer pixels.
+    - alpha (float): The opacity of the heat layer.
+
+    Returns:
+    - rgb (numpy.ndarray): The (h, w, 3) uint8 composited pixels.
+
+    """
+    weight = overlay[:, :, 3:4] * (alpha / 255.0)
+    out = base * (1 - weight) + overlay[:, :, :3] * weight
+    return numpy.round(out).astype(numpy.uint8)
+
+
+def upsample(nodes, origin, size, step, nearest=False):
+    """
+    Bilinearly upsample a lattice of grid nodes to pixels.
+
+    Parameters:
+    - nodes (numpy.ndarray): The (ny, nx, ...) values of lattice nodes
+      spaced by step pixels.
+    - origin (tuple): The (x, y) pixel offset of the first output pixel
+      from nodes[0, 0].
+    - size (tuple): The (width, height) of the output in pixels.
+    - step (float): The pixel distance between two nodes, or the
+      (x, y) distances when they differ.
+    - nearest (bool): Take the value of the nearest node instead, for
+      categorical values.
+
+    Returns:
+    - pixels (numpy.ndarray): The (height, width, ...) values.
+
+    """
+    step_x, step_y = (step, step) if numpy.isscalar(step) else step
+    if nodes.shape[0] < 2 or nodes.shape[1] < 2:
+        pad = [(0, max(0, 2 - nodes.shape[0])), (0, max(0, 2 - nodes.shape[1]))]
+        nodes = numpy.pad(nodes, pad + [(0, 0)] * (nodes.ndim - 2), mode='edge')
+    trailing = (1,) * (nodes.ndim - 2)
+
+    def axis(start, length, count, step):
+        u = (start + numpy.arange(length)) / step
+        i = numpy.clip(numpy.floor(u).astype(numpy.intp), 0, count - 2)
+        return i, (u - i).reshape((-1,) + trailing)
+
+    ix, fx = axis(origin[0], size[0], nodes.shape[1], step_x)
+    iy, fy = axis(origin[1], size[1], nodes.shape[0], step_y)
+    if nearest:
+        return nodes[iy + (fy.reshape(-1) >= 0.5)][:, ix + (fx.reshape(-1) >= 0.5)]
+    rows = nodes[:, ix] * (1 - fx) + nodes[:, ix + 1] * fx
+    fy = fy[:, None]
+    return rows[iy] * (1 - fy) + rows[iy + 1] * fy
+
+
+# PIL and SciPy are only imported by the drawing helpers, the NumPy
+# helpers are also used without them.
+# pylint: disable=import-outside-toplevel
+def font(size):
+    """Return the default PIL font at a pixel size when supported."""
+    from PIL import ImageFont
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+def _ticks(vmin, vmax, count=5):
+    if vmin == vmax:
+        return [vmin]
+    return list(numpy.linspace(vmin, vmax, count))
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def colorbar_strip(lut, vmin, vmax, unit, height, width=None, ticks=None):
+    """
+    Return the colorbar drawn as a vertical side strip.
+
+    Strips are cached, so the graphs of a batch sharing a colormap and a
+    range draw their colorbar only once.
+
+    Parameters:
+    - lut (numpy.ndarray): The RGBA lookup table of the colormap.
+    - vmin, vmax (float): The color range.
+    - unit (str): The label of the colorbar.
+    - height (int): The strip height in pixels.
+    - width (int): The strip width in pixels, relative to the height
+      by default.
+    - ticks (list): The (value, label) ticks, evenly spaced values by
+      default.
+
+    Returns:
+    - strip (numpy.ndarray): The (height, width, 3) uint8 pixels.
+
+    """
+    from PIL import Image, ImageDraw
+    width = width or max(60, height // 8)
+    if ticks is None:
+        ticks = [(tick, F"{tick:g}") for tick in _ticks(vmin, vmax)]
+    key = (lut.tobytes(), vmin, vmax, unit, height, width, tuple(ticks))
+    if key in _strips:
+        return _strips[key]
+    size = max(8, height // 50)
+    margin = 2 * size
+    bar_width = max(8, width // 5)
+    top, bottom = margin, height - margin
+    image = Image.new('RGB', (width, height), 'white')
+    # The highest value at the top
+    index = numpy.linspace(len(lut) - 1, 0, max(1, bottom - top))
+    column = lut[numpy.round(index).astype(numpy.intp), :3]
+    image.paste(Image.fromarray(numpy.repeat(column[:, None], bar_width, axis=1)),
+                (size, top))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((size, top, size + bar_width - 1, bottom - 1), outline='black')
+    label_font = font(size)
+    for tick, text in ticks:
+        fraction = (tick - vmin) / (vmax - vmin) if vmax != vmin else 0.5
+        y = bottom - fraction * (bottom - top)
+        draw.line((size + bar_width, y, size + bar_width + size // 2, y), fill='black')
+        draw.text((size + bar_width + size, y), text, fill='black',
+                  font=label_font, anchor='lm')
+    if unit:
+        left, upper, right, lower = draw.textbbox((0, 0), unit, font=label_font)
+        label = Image.new('RGB', (right - left, lower - upper), 'white')
+        ImageDraw.Draw(label).text((-left, -upper), unit, fill='black',
+                                   font=label_font)
+        label = label.rotate(90, expand=True)
+        image.paste(label, (width - label.width - size // 2,
+                            (top + bottom - label.height) // 2))
+    strip = numpy.asarray(image)
+    _strips[key] = strip
+    return strip
+
+
+def declutter(x, y, width, height):
+    """
+    Pick the point labels that can be drawn without overlapping.
+
+    Every label is a width x height box centered on its point. The labels
+    are taken in order, one being dropped when its box overlaps the box of
+    a label already taken.
+
+    Returns:
+    - keep (numpy.ndarray): Whether every label is drawn.
+
+    """
+    from scipy.spatial import cKDTree
+    keep = numpy.ones(len(x), dtype=bool)
+    if len(x) < 2 or width <= 0 or height <= 0:
+        return keep
+    # Scaled to square boxes, two boxes overlap when the Chebyshev
+    # distance of their centers is below the width
+    centers = numpy.column_stack((x, numpy.asarray(y) * (width / height)))
+    pairs = cKDTree(centers).query_pairs(width * (1 - 1e-9), p=numpy.inf,
+                                         output_type='ndarray')
+    # Sorted by their first label, which is final by the time it is reached
+    for first, second in pairs[numpy.lexsort((pairs[:, 1], pairs[:, 0]))].tolist():
+        if keep[first]:
+            keep[second] = False
+    return keep
+
+
+# pylint: disable=too-many-arguments
+def draw_points(image, x, y, colors, labels, radius):
+    """
+    Draw the survey points and their labels over an image.
+
+    Parameters:
+    - image (PIL.Image.Image): The image to draw on.
+    - x, y (numpy.ndarray): The point coordinates in pixels.
+    - colors (numpy.ndarray): The (N, 4) uint8 RGBA marker colors,
+      transparent markers are drawn hollow.
+    - labels (list): The label of every point, None for no label. The
+      labels overlapping a previous one are left out.
+    - radius (float): The marker radius in pixels.
+
+    """
+    from PIL import ImageDraw
+    draw = ImageDraw.Draw(image)
+    label_font = font(max(8, int(radius * 1.5)))
+    longest = max((str(label) for label in labels if label is not None),
+                  key=len, default='')
+    left, upper, right, lower = draw.textbbox((0, 0), longest, font=label_font)
+    keep = declutter(x, y, right - left, lower - upper)
+    labels = [label if kept else None for label, kept in zip(labels, keep)]
+    for px, py, color, label in zip(x, y, colors, labels):
+        fill = tuple(int(c) for c in color[:3]) if color[3] else None
+        draw.ellipse((px - radius, py - radius, px + radius, py + radius),
+                     fill=fill, outline='black')
+        if label is not None:
+            draw.text((px, py - 2 * radius), str(label), fill='black',
+                      font=label_font, anchor='md')
@@ -0,0 +1,327 @@
+"""Module providing the survey series comparison of the Heat Map Generator.
+
+`lora-heatmap series` compares surveys of the same floor plan taken over
+time, e.g. every quarter. All surveys are interpolated onto one shared
+grid, and the surveys measured at the same points share the fit of their
+interpolator: their channels are solved together as the columns of one
+batched right-hand side.
+
+The grids of every survey are kept in a stacked array file, by survey
+contents digest, so adding a survey to the series only interpolates the
+new one. From the stack are rendered:
+- a delta map of every survey against the previous one, or against the
+  first with --baseline first, on a range symmetric around no change;
+- the per-cell min, median and max of every channel over the series.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+from pathlib import Path
+
+import numpy
+
+from cache import digest, file_digest
+from coverage import COVERAGE_GRAPHS, gateway_graphs
+from heatmap import (HeatMapGenerator, __version__, add_render_arguments,
+                     render_options, set_log_debug, set_log_info)
+from interpolation import create_interpolator
+from survey import load_survey, parse_gateway_column
+
+logger = logging.getLogger()
+
+STORE_NAME = 'series.npz'
+BASELINES = ('previous', 'first')
+STATISTICS = ('min', 'median', 'max')
+
+
+def load_stack(path, options):
+    """
+    Load the grids of a stacked array file.
+
+    Returns:
+    - grids (dict): survey digest -> {key: grid}, empty when the file is
+      missing or was interpolated with other options.
+
+    """
+    if not os.path.exists(path):
+        return {}
+    with numpy.load(path) as data:
+        meta = json.loads(str(data['meta']))
+        if meta['options'] != options:
+            logger.info('Ignoring %s, interpolated with other options', path)
+            return {}
+        stacks = {key: data[F"grid_{index}"] for index, key in enumerate(meta['keys'])}
+    grids = {}
+    for index, survey_digest in enumerate(meta['digests']):
+        grids[survey_digest] = {key: stack[index] for key, stack in stacks.items()
+                                if not numpy.isnan(stack[index]).all()}
+    logger.info('Loaded the grids of %d surveys from %s', len(grids), path)
+    return grids
+
+
+def save_stack(path, options, names, digests, stacks):
+    """
+    Write the grids of a series as a stacked array file.
+
+    Parameters:
+    - options (str): The digest of the interpolation options.
+    - names (list): The survey names, in series order.
+    - digests (list): The survey contents digests, in series order.
+    - stacks (dict): key -> (surveys, num_y, num_x) grids, NaN for the
+      surveys without the key.
+
+    """
+    meta = {'options': options, 'names': names, 'digests': digests,
+            'keys': list(stacks)}
+    arrays = {F"grid_{index}": stack for index, stack in enumerate(stacks.values())}
+    tmp_path = F"{path}.tmp"
+    with open(tmp_path, 'wb') as fh:
+        numpy.savez(fh, meta=json.dumps(meta), **arrays)
+    os.replace(tmp_path, path)
+    logger.info('Wrote the grids of %d surveys to %s', len(digests), path)
+
+
+def _names(paths):
+    """Return the survey names, the file stems made unique."""
+    stems = [Path(path).stem for path in paths]
+    if len(set(stems)) == len(stems):
+        return stems
+    return [F"{index}_{stem}" for index, stem in enumerate(stems)]
+
+
+def _input_title(key):
+    """Return the [title, unit] of a survey channel."""
+    parsed = parse_gateway_column(key)
+    if parsed is not None:
+        return gateway_graphs([parsed[1]])[key]
+    return HeatMapGenerator.graphs[key]
+
+
+# pylint: disable=too-many-instance-attributes
+class SeriesGenerator(HeatMapGenerator):
+    """Class SeriesGenerator for comparing the surveys of one floor plan over time.
+
+    The floor plan, points and title options are those of the last
+    survey; the outputs are written as series_<graph>.png.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, image_path, survey_paths, cname, output_dir=None,
+                 store=None, baseline='previous', **kwargs):
+        super().__init__(image_path, survey_paths[-1], cname, **kwargs)
+        self._survey_paths = [os.path.abspath(path) for path in survey_paths]
+        self._names = _names(survey_paths)
+        if output_dir is not None:
+            self._path = os.path.abspath(output_dir)
+        self._title = 'series'
+        self._store = store or os.path.join(self._path, STORE_NAME)
+        self._baseline = baseline
+        self._ranges = {}
+
+    def _options_key(self):
+        """Return the digest of everything the grids depend on but the surveys."""
+        return digest('series', __version__, file_digest(self._image_path),
+                      self.thresholds, self._interpolator, self._neighbors,
+                      self._grid_step, self._merge_radius,
+                      self._outlier_threshold, self._domain_digest(),
+                      self._extrapolation)
+
+    def _input_graphs(self, survey):
+        """Return the channels of a survey, coverage maps aside."""
+        graphs = {**HeatMapGenerator.graphs, **gateway_graphs(survey.gateways)}
+        return {k: title for k, title in graphs.items() if k not in COVERAGE_GRAPHS}
+
+    # pylint: disable=too-many-locals
+    def _generate(self, pool):
+        self._load_image()
+        with self.metrics.stage('grid'):
+            grid = self._grid()
+        self.metrics.set('grid_cells', grid[2] * grid[3])
+        options = self._options_key()
+        digests = [file_digest(path) for path in self._survey_paths]
+        stored = load_stack(self._store, options)
+        pending = [index for index, survey_digest in enumerate(digests)
+                   if survey_digest not in stored]
+        self.metrics.set('cached', len(digests) - len(pending))
+        logger.info('Interpolating %d of %d surveys', len(pending), len(digests))
+        try:
+            grids = self._interpolate_series(pending, *grid)
+        # pylint: disable=broad-exception-caught
+        except Exception as e:
+            logger.error(e)
+            logger.warning('Cannot interpolate the series: insufficient data')
+            return {'series': str(e)}
+        series = [grids[index] if index in grids else stored[survey_digest]
+                  for index, survey_digest in enumerate(digests)]
+        keys = []
+        for survey_grids in series:
+            keys += [key for key in survey_grids if key not in keys]
+        empty = numpy.full((grid[3], grid[2]), numpy.nan)
+        stacks = {key: numpy.stack([survey_grids.get(key, empty) for survey_grids in series])
+                  for key in keys}
+        save_stack(self._store, options, self._names, digests, stacks)
+
+        outputs = self._outputs(stacks)
+        self.graphs = {k: title for k, (title, _) in outputs.items()}
+        a = self._padded_data()
+        # The points carry no value of the series graphs, they are only
+        # drawn where they are
+        for k in outputs:
+            a[k] = numpy.full(len(a['x']), numpy.nan)
+        return self._render_all(pool, a, {k: z for k, (_, z) in outputs.items()})
+
+    # pylint: disable=too-many-arguments,too-many-locals
+    def _interpolate_series(self, pending, gx, gy, num_x, num_y):
+        """
+        Interpolate the surveys over the shared grid.
+
+        The channels of every survey are grouped by the points they were
+        measured at, in any order, and every group of points is fitted
+        once for all the surveys sharing it.
+
+        Returns:
+        - grids (dict): survey index -> {key: (num_y, num_x) grid}.
+
+        """
+        grids = {}
+        geometries = {}
+        with self.metrics.stage('fit'):
+            for index in pending:
+                survey = self._survey
+                if index < len(self._survey_paths) - 1:
+                    survey = load_survey(self._survey_paths[index])
+                if not survey.found:
+                    raise ValueError(F"No survey points found in {self._survey_paths[index]}")
+                self.graphs = self._input_graphs(survey)
+                a = self._padded_data(survey)
+                uniform, groups = self._fit(a)
+                grids[index] = {key: numpy.full((num_y, num_x), value)
+                                for key, value in uniform.items()}
+                if uniform:
+                    self._clip(grids[index], self._inside(a['x'], a['y'], gx, gy))
+                for group, x, y, values in groups:
+                    order = numpy.lexsort((y, x))
+                    x, y = x[order], y[order]
+                    points = numpy.column_stack((x, y)).tobytes()
+                    if points not in geometries:
+                        geometries[points] = (x, y, [])
+                    geometries[points][2].append((index, group, values[order]))
+            fitted = [
+                (x, y, create_interpolator(self._interpolator, x, y,
+                                           neighbors=self._neighbors), members)
+                for x, y, members in geometries.values()
+            ]
+        logger.info('Interpolating %d surveys with %d fits', len(pending), len(fitted))
+        with self.metrics.stage('evaluate'):
+            for x, y, interpolator, members in fitted:
+                columns = numpy.column_stack([values for _, _, values in members])
+                inside = self._inside(x, y, gx, gy)
+                if inside is None:
+                    z = interpolator.evaluate(columns, gx, gy)
+                else:
+                    z = numpy.full((len(gx), columns.shape[1]), numpy.nan)
+                    if inside.any():
+                        z[inside] = interpolator.evaluate(columns, gx[inside], gy[inside])
+                column = 0
+                for index, group, _ in members:
+                    for key in group:
+                        grids[index][key] = z[:, column].reshape((num_y, num_x))
+                        column += 1
+        return grids
+
+    def _outputs(self, stacks):
+        """
+        Compute the delta maps and the statistics over time of every channel.
+
+        Returns:
+        - outputs (dict): graph key -> ([title, unit], grid), their color
+          ranges are set in _ranges.
+
+        """
+        outputs = {}
+        for key, stack in stacks.items():
+            title, unit = _input_title(key)
+            present = [index for index in range(len(stack))
+                       if not numpy.isnan(stack[index]).all()]
+            deltas = {}
+            for previous, index in zip(present, present[1:]):
+                base = present[0] if self._baseline == 'first' else previous
+                deltas[F"{key}_delta_{self._names[index]}_vs_{self._names[base]}"] = (
+                    [F"Change in {title}, {self._names[index]} vs {self._names[base]}", unit],
+                    stack[index] - stack[base])
+            if deltas:
+                # Every delta map of a channel shares one scale, centered
+                # on no change
+                extent = max(float(numpy.nanmax(numpy.abs(z))) for _, z in deltas.values()) or 1.0
+                for k in deltas:
+                    self._ranges[k] = (-extent, extent)
+                outputs.update(deltas)
+            vmin = self.thresholds.get(key, {}).get('min', float(numpy.nanmin(stack)))
+            vmax = self.thresholds.get(key, {}).get('max', float(numpy.nanmax(stack)))
+            span = F"{self._names[present[0]]} to {self._names[present[-1]]}"
+            for statistic, reduce in zip(STATISTICS, (numpy.nanmin, numpy.nanmedian, numpy.nanmax)):
+                outputs[F"{key}_{statistic}"] = (
+                    [F"{statistic.capitalize()} {title}, {span}", unit],
+                    reduce(stack[present], axis=0))
+                self._ranges[F"{key}_{statistic}"] = (vmin, vmax)
+        return outputs
+
+    def _value_range(self, a, key):
+        if key in self._ranges:
+            return self._ranges[key]
+        return super()._value_range(a, key)
+
+
+def parse_args(argv):
+    """Parse the series arguments."""
+    p = argparse.ArgumentParser(
+        prog='lora-heatmap series',
+        description='Compare surveys of the same floor plan over time: delta '
+        'maps and the per-cell min, median and max over the series'
+    )
+    p.add_argument('-v', '--verbose', dest='verbose', action='count', default=0,
+                   help='verbose output. specify twice for debug-level output.')
+    add_render_arguments(p)
+    p.add_argument('SURVEY', type=str, nargs='+',
+                   help='surveys of the same floor plan, oldest first')
+    p.add_argument('-o', '--output-dir', dest='output_dir', action='store',
+                   type=str, default=None,
+                   help='directory of the series graphs, defaults to the '
+                   'directory of the last survey')
+    p.add_argument('--store', dest='store', action='store', type=str,
+                   default=None,
+                   help=F"stacked array file of the interpolated surveys, "
+                   F"defaults to {STORE_NAME} in the output directory")
+    p.add_argument('--baseline', dest='baseline', action='store',
+                   choices=BASELINES, default='previous',
+                   help='compare every survey with the previous or the first one')
+    args = p.parse_args(argv)
+    if len(args.SURVEY) < 2:
+        p.error('a series needs at least two surveys')
+    return args
+
+
+def main(argv):
+    """Render the delta maps and statistics of a survey series."""
+    args = parse_args(argv)
+    if args.verbose > 1:
+        set_log_debug()
+    elif args.verbose:
+        set_log_info()
+    output_dir = args.output_dir or os.path.dirname(os.path.abspath(args.SURVEY[-1]))
+    os.makedirs(output_dir, exist_ok=True)
+    generator = SeriesGenerator(
+        args.IMAGE, args.SURVEY, args.CNAME,
+        output_dir=output_dir,
+        store=args.store,
+        baseline=args.baseline,
+        **render_options(args)
+    )
+    errors = generator.generate()
+    if errors:
+        sys.exit(1)
+    print(F"Wrote {len(generator.graphs)} series graphs of {len(args.SURVEY)} "
+          F"surveys to {output_dir}")
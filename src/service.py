@@ -0,0 +1,402 @@
+"""Module providing the render service of the Heat Map Generator.
+
+``lora-heatmap serve`` keeps warm render workers behind a small asyncio
+HTTP server, so a heatmap no longer pays for the interpreter startup,
+the matplotlib and scipy imports, the floor plan decode and the
+colormap construction. Every worker keeps the floor plans and colormaps
+it used last in least recently used caches. Once every worker is busy
+and the queue is full, requests are rejected with 503 and a Retry-After
+header instead of piling up.
+
+Endpoints:
+- POST /render/<graph>?plan=<plan>: render one graph of the survey JSON
+  posted as the request body, returns the PNG. The plan and the optional
+  thresholds parameter reference files of the plans directory.
+- GET /health: the worker, queue and request counters as JSON.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from batch import ImageCache
+from cache import RenderCache
+from coverage import COVERAGE_GRAPHS, DEFAULT_THRESHOLD
+from heatmap import (HeatMapGenerator, add_cache_arguments, set_log_debug,
+                     set_log_info)
+from interpolation import INTERPOLATORS
+from survey import parse_gateway_column
+
+logger = logging.getLogger()
+
+RENDERERS = ('matplotlib', 'raster')
+
+# Seconds a client may take to send its request
+READ_TIMEOUT = 30
+
+DEFAULT_MAX_BODY = 64 * 1024 * 1024
+
+# State of the current worker process, set up by _init_worker
+_worker = {}
+
+
+class HttpError(Exception):
+    """An error answered to the client with an HTTP status."""
+
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+def _init_worker(cache, plan_cache_size, colormap_cache_size):
+    # Import everything a render needs once, before the first request
+    # pylint: disable=import-outside-toplevel,unused-import
+    import matplotlib
+    matplotlib.use('Agg')
+    import scipy.interpolate
+    import scipy.linalg
+    import scipy.spatial
+    from matplotlib import pyplot
+    _worker['images'] = ImageCache(plan_cache_size)
+    _worker['colormaps'] = OrderedDict()
+    _worker['colormap_cache_size'] = colormap_cache_size
+    _worker['cache'] = RenderCache(*cache) if cache is not None else None
+
+
+def _warm():
+    return os.getpid()
+
+
+def _colormap(generator, cname):
+    """Return the colormap of the worker cache, building it once."""
+    colormaps = _worker['colormaps']
+    if cname in colormaps:
+        colormaps.move_to_end(cname)
+        return colormaps[cname]
+    colormaps[cname] = generator.get_colormap(cname)
+    if len(colormaps) > _worker['colormap_cache_size']:
+        colormaps.popitem(last=False)
+    return colormaps[cname]
+
+
+# pylint: disable=protected-access
+def render(job):
+    """
+    Render one graph of a survey in a worker process.
+
+    Parameters:
+    - job (dict): The survey JSON bytes, the plan and thresholds paths,
+      the graph key and the generator options.
+
+    Returns:
+    - (png, metrics): The PNG bytes and the metrics dict of the survey.
+
+    Raises:
+    - ValueError: When the survey or the graph cannot be rendered.
+
+    """
+    options = job['options']
+    with tempfile.TemporaryDirectory(prefix='heatmap-serve-') as directory:
+        survey_path = os.path.join(directory, 'survey.json')
+        with open(survey_path, 'wb') as fh:
+            fh.write(job['survey'])
+        try:
+            generator = HeatMapGenerator(
+                job['plan'], survey_path, options['colormap'],
+                show_points=options['show_points'],
+                contours=options['contours'],
+                thresholds=job['thresholds'],
+                interpolator=options['interpolator'],
+                neighbors=options['neighbors'],
+                image_cache=_worker['images'],
+                cache=_worker['cache'],
+                renderer=options['renderer'],
+                grid_step=options['grid_step'],
+                max_error=options['max_error'],
+                coverage_threshold=options['coverage_threshold'],
+                merge_radius=options['merge_radius'],
+                outlier_threshold=options['outlier_threshold'],
+                extrapolation=options['extrapolation']
+            )
+        except SystemExit as e:
+            # The generator exits when the survey holds no points
+            raise ValueError('No survey points found') from e
+        if job['graph'] not in generator.graphs:
+            raise ValueError(F"No {job['graph']} graph for this survey")
+        generator.graphs = {job['graph']: generator.graphs[job['graph']]}
+        generator._cmap = _colormap(generator, options['colormap'])
+        errors = generator.generate()
+        if errors:
+            raise ValueError(errors[job['graph']])
+        # Graphs without any valid value are skipped
+        if not os.path.exists(generator._output_path(job['graph'])):
+            raise ValueError(F"No {job['graph']} values in the survey")
+        with open(generator._output_path(job['graph']), 'rb') as fh:
+            return fh.read(), generator.metrics.as_dict()
+
+
+def _flag(value):
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def parse_options(query):
+    """Return the generator options of the render query parameters."""
+    def value(name, default, convert=str):
+        if name not in query:
+            return default
+        try:
+            return convert(query[name][-1])
+        except ValueError as e:
+            raise HttpError(400, F"Invalid {name}: {query[name][-1]}") from e
+
+    options = {
+        'colormap': value('colormap', 'RdYlBu_r'),
+        'renderer': value('renderer', 'matplotlib'),
+        'interpolator': value('interpolator', 'rbf'),
+        'neighbors': value('neighbors', None, int),
+        'contours': value('contours', None, int),
+        'show_points': value('points', False, _flag),
+        'grid_step': value('grid_step', 4, float),
+        'max_error': value('max_error', None, float),
+        'coverage_threshold': value('coverage_threshold', DEFAULT_THRESHOLD, float),
+        'merge_radius': value('merge_radius', None, float),
+        'outlier_threshold': value('outliers', None, float),
+        'extrapolation': value('extrapolation', None, float),
+    }
+    if options['renderer'] not in RENDERERS:
+        raise HttpError(400, F"Unknown renderer: {options['renderer']}")
+    if options['interpolator'] not in INTERPOLATORS:
+        raise HttpError(400, F"Unknown interpolator: {options['interpolator']}")
+    if options['grid_step'] <= 0:
+        raise HttpError(400, 'grid_step must be positive')
+    return options
+
+
+class HeatmapService:
+    """HTTP front end of a pool of warm render workers.
+
+    Parameters:
+    - plans (str): The directory the plan and thresholds references of
+      the requests are resolved in.
+    - jobs (int): The number of render worker processes.
+    - queue (int): The number of requests waiting for a worker beyond
+      which new requests are rejected with 503.
+    - max_body (int): The largest accepted survey in bytes.
+    - cache (tuple): The (directory, max_bytes) of the render cache
+      shared by the workers, None to disable it.
+    - plan_cache_size (int): The decoded floor plans kept per worker.
+    - colormap_cache_size (int): The colormaps kept per worker.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, plans, jobs=1, queue=8, max_body=DEFAULT_MAX_BODY,
+                 cache=None, plan_cache_size=8, colormap_cache_size=16):
+        self._plans = os.path.realpath(plans)
+        self._jobs = jobs
+        self._queue = queue
+        self._max_body = max_body
+        self._executor = ProcessPoolExecutor(
+            jobs, initializer=_init_worker,
+            initargs=(cache, plan_cache_size, colormap_cache_size))
+        self.in_flight = 0
+        self.counters = {'rendered': 0, 'failed': 0, 'rejected': 0}
+
+    def warm_up(self):
+        """Start the workers and their imports before the first request."""
+        for future in [self._executor.submit(_warm) for _ in range(self._jobs)]:
+            future.result()
+
+    def close(self):
+        """Stop the workers."""
+        self._executor.shutdown()
+
+    def resolve(self, reference):
+        """Return the path of a file referenced by a request."""
+        path = os.path.realpath(os.path.join(self._plans, reference))
+        if os.path.commonpath([path, self._plans]) != self._plans or not os.path.isfile(path):
+            raise HttpError(404, F"Unknown file: {reference}")
+        return path
+
+    def health(self):
+        """Return the worker, queue and request counters."""
+        return {'jobs': self._jobs, 'queue': self._queue,
+                'in_flight': self.in_flight, **self.counters}
+
+    async def _read_request(self, reader):
+        """Return the method, target, headers and body of a request."""
+        line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+        parts = line.decode('latin-1').split()
+        if len(parts) != 3:
+            raise HttpError(400, 'Malformed request line')
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError as e:
+            raise HttpError(400, 'Invalid Content-Length') from e
+        if length > self._max_body:
+            raise HttpError(413, F"Surveys are limited to {self._max_body} bytes")
+        body = await asyncio.wait_for(reader.readexactly(length), READ_TIMEOUT)
+        return parts[0], parts[1], headers, body
+
+    async def _dispatch(self, method, target, body):
+        """Answer a request, returns its status, content type and content."""
+        url = urlsplit(target)
+        if url.path == '/health':
+            return 200, 'application/json', json.dumps(self.health()).encode()
+        if not url.path.startswith('/render/'):
+            raise HttpError(404, F"Unknown path: {url.path}")
+        if method != 'POST':
+            raise HttpError(405, 'Post the survey JSON to render it')
+        graph = unquote(url.path[len('/render/'):])
+        known = graph in HeatMapGenerator.graphs or graph in COVERAGE_GRAPHS
+        if not known and parse_gateway_column(graph) is None:
+            raise HttpError(404, F"Unknown graph: {graph}")
+        query = parse_qs(url.query)
+        if 'plan' not in query:
+            raise HttpError(400, 'The plan parameter is required')
+        job = {
+            'survey': body,
+            'graph': graph,
+            'plan': self.resolve(query['plan'][-1]),
+            'thresholds': self.resolve(query['thresholds'][-1]) if 'thresholds' in query else None,
+            'options': parse_options(query),
+        }
+        # Backpressure: never queue more than the workers can catch up with
+        if self.in_flight >= self._jobs + self._queue:
+            self.counters['rejected'] += 1
+            raise HttpError(503, 'All workers are busy', {'Retry-After': '1'})
+        self.in_flight += 1
+        try:
+            png, metrics = await asyncio.get_running_loop().run_in_executor(
+                self._executor, render, job)
+        except ValueError as e:
+            self.counters['failed'] += 1
+            raise HttpError(422, str(e)) from e
+        finally:
+            self.in_flight -= 1
+        self.counters['rendered'] += 1
+        logger.info('Rendered %s in %.2fs', graph, metrics['seconds'])
+        return 200, 'image/png', png
+
+    async def handle(self, reader, writer):
+        """Answer one HTTP request of a client connection."""
+        headers = {}
+        try:
+            method, target, _, body = await self._read_request(reader)
+            status, content_type, content = await self._dispatch(method, target, body)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        except HttpError as e:
+            status, content_type, content = e.status, 'text/plain', str(e).encode()
+            headers = e.headers
+        # pylint: disable=broad-exception-caught
+        except Exception as e:
+            logger.error(e)
+            status, content_type, content = 500, 'text/plain', str(e).encode()
+        head = [F"HTTP/1.1 {status} {HTTPStatus(status).phrase}",
+                F"Content-Type: {content_type}",
+                F"Content-Length: {len(content)}",
+                'Connection: close']
+        head += [F"{name}: {value}" for name, value in headers.items()]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + content)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def serve(self, host, port):
+        """Serve requests until cancelled or terminated."""
+        server = await asyncio.start_server(self.handle, host, port)
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, asyncio.current_task().cancel)
+        except NotImplementedError:
+            # No signal handlers on Windows
+            pass
+        logger.warning('Serving heatmaps on http://%s:%d', host, port)
+        async with server:
+            try:
+                await server.serve_forever()
+            except asyncio.CancelledError:
+                logger.warning('Stopped serving heatmaps')
+
+
+def parse_args(argv):
+    """
+    parse arguments/options
+
+    this uses the new argparse module instead of optparse
+    see: <https://docs.python.org/2/library/argparse.html>
+    """
+    p = argparse.ArgumentParser(
+        prog='lora-heatmap serve',
+        description='LoRa survey heatmap render service'
+    )
+    p.add_argument('-v', '--verbose', dest='verbose', action='count', default=0,
+                   help='verbose output. specify twice for debug-level output.')
+    p.add_argument('--host', dest='host', action='store', type=str,
+                   default='127.0.0.1', help='address to listen on')
+    p.add_argument('--port', dest='port', action='store', type=int,
+                   default=8080, help='port to listen on')
+    p.add_argument('--plans', dest='plans', action='store', type=str,
+                   default='.',
+                   help='directory of the floor plans and thresholds files '
+                   'the requests may reference')
+    p.add_argument('-j', '--jobs', dest='jobs', action='store', type=int,
+                   default=os.cpu_count() or 1,
+                   help='render worker processes')
+    p.add_argument('-q', '--queue', dest='queue', action='store', type=int,
+                   default=8,
+                   help='requests waiting for a worker before new ones are '
+                   'rejected with 503')
+    p.add_argument('--max-body', dest='max_body', action='store', type=int,
+                   default=DEFAULT_MAX_BODY // (1024 * 1024),
+                   help='largest accepted survey in MB')
+    p.add_argument('--plan-cache', dest='plan_cache', action='store', type=int,
+                   default=8, help='decoded floor plans kept per worker')
+    p.add_argument('--colormap-cache', dest='colormap_cache', action='store',
+                   type=int, default=16, help='colormaps kept per worker')
+    add_cache_arguments(p)
+    return p.parse_args(argv)
+
+
+def main(argv):
+    """ main entry"""
+    args = parse_args(argv)
+    if args.verbose > 1:
+        set_log_debug()
+    elif args.verbose == 1:
+        set_log_info()
+    cache = None
+    if not args.no_cache:
+        cache = (args.cache_dir, args.cache_size * 1024 * 1024)
+    service = HeatmapService(
+        args.plans, jobs=max(1, args.jobs), queue=args.queue,
+        max_body=args.max_body * 1024 * 1024, cache=cache,
+        plan_cache_size=args.plan_cache,
+        colormap_cache_size=args.colormap_cache
+    )
+    try:
+        service.warm_up()
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
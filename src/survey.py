@@ -0,0 +1,392 @@
+"""Module providing the survey loader of the Heat Map Generator.
+
+The survey JSON is parsed incrementally: the ``survey_points`` array is
+decoded one point at a time from a bounded read buffer, validated, and
+appended straight into typed, contiguous float64 column arrays. Missing
+or null measurements are stored as NaN and reported by a validity mask
+instead of being replaced with 0.
+
+The measurements of every gateway which heard a point may be listed
+under ``result.gateways``, keyed by gateway id; they are stored in one
+gateway_rssi:<id> and one gateway_snr:<id> column per gateway, NaN
+where the gateway did not hear the point.
+
+Surveys can also be stored in a compact columnar binary format (.lsv):
+
+    magic     8 bytes, BINARY_MAGIC
+    length    little-endian uint64, size of the JSON header
+    header    UTF-8 JSON: survey header, point count, and the byte
+              offset of every column and of the labels block
+    columns   raw little-endian float64 blocks, 64-byte aligned
+    labels    UTF-8 JSON list of the point labels
+
+Binary surveys are memory mapped, so they open almost instantly and
+several processes share the same pages.
+"""
+
+import json
+import logging
+import math
+import re
+import struct
+from array import array
+
+import numpy
+
+logger = logging.getLogger()
+
+CHUNK_SIZE = 1024 * 1024
+
+BINARY_MAGIC = b'LSURVEY1'
+BINARY_SUFFIX = '.lsv'
+_ALIGNMENT = 64
+_PREAMBLE = len(BINARY_MAGIC) + 8
+
+_WHITESPACE = re.compile(r'[ \t\r\n]*')
+
+# Column name -> key in the result of a survey point
+COLUMNS = {
+    'sensor_rssi': 'rssi',
+    'sensor_snr': 'snr',
+    'sensor_rssi_min': 'rssi_min',
+    'sensor_rssi_max': 'rssi_max',
+    'sensor_snr_min': 'snr_min',
+    'sensor_snr_max': 'snr_max',
+    'gateway_rssi': 'gateway_rssi',
+    'gateway_snr': 'gateway_snr',
+}
+
+# Measurements of every gateway in result.gateways
+GATEWAY_METRICS = ('rssi', 'snr')
+
+
+def gateway_column(metric, gateway):
+    """Return the column name of a measurement of one gateway."""
+    return F"gateway_{metric}:{gateway}"
+
+
+def parse_gateway_column(name):
+    """Return the (metric, gateway) of a gateway column, None for others."""
+    prefix, separator, gateway = name.partition(':')
+    metric = prefix[len('gateway_'):]
+    if not separator or not prefix.startswith('gateway_') or metric not in GATEWAY_METRICS:
+        return None
+    return metric, gateway
+
+
+class SurveyError(ValueError):
+    """Raised when a survey file does not follow the survey schema."""
+
+
+class SurveyData:
+    """Columnar survey points.
+
+    Attributes:
+        header (dict): The top-level survey entries except the points,
+            e.g. title and img_path.
+        found (bool): Whether the file holds a survey_points array.
+        columns (dict): The float64 array of x, y and every COLUMNS key,
+            NaN where the measurement is missing.
+        labels (list): The label of every point.
+    """
+
+    def __init__(self, header, found, columns, labels):
+        self.header = header
+        self.found = found
+        self.columns = columns
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def valid(self, name):
+        """Return the validity mask of a column."""
+        return ~numpy.isnan(self.columns[name])
+
+    @property
+    def gateways(self):
+        """The ids of the gateways with their own columns, sorted."""
+        return sorted({parsed[1] for parsed in map(parse_gateway_column, self.columns)
+                       if parsed is not None})
+
+
+class _Reader:
+    """Incremental JSON value reader over a text file."""
+
+    def __init__(self, fh, chunk_size):
+        self._fh = fh
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            return False
+        chunk = self._fh.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        # Drop the consumed prefix so the buffer stays bounded
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character, '' at the end."""
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf) or not self._fill():
+                return self._buf[self._pos:self._pos + 1]
+
+    def expect(self, char):
+        """Consume the next non-whitespace character, which must be char."""
+        if self.peek() != char:
+            raise SurveyError(F"Expected '{char}' at offset {self._pos}")
+        self._pos += 1
+
+    def value(self):
+        """Decode the next JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError as e:
+                if self._fill():
+                    continue
+                raise SurveyError(F"Invalid survey JSON: {e}") from e
+            # A number may continue in the next chunk
+            if end == len(self._buf) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+
+def _append(column, name, value, index):
+    try:
+        column.append(value)
+    except TypeError as e:
+        if value is not None:
+            raise SurveyError(F"Survey point {index}: {name} must be a "
+                              F"number, got {value!r}") from e
+        column.append(math.nan)
+
+
+def _pad(column, length):
+    if len(column) < length:
+        column.extend([math.nan] * (length - len(column)))
+
+
+def _append_gateways(data, gateways, index, names):
+    """Append the measurements of every gateway which heard a point."""
+    if not isinstance(gateways, dict):
+        raise SurveyError(F"Survey point {index}: gateways must be an object")
+    for gateway, result in gateways.items():
+        if not isinstance(result, dict):
+            raise SurveyError(F"Survey point {index}: gateway {gateway} "
+                              F"must be an object")
+        for metric in GATEWAY_METRICS:
+            name = gateway_column(metric, gateway)
+            if names is not None and name not in names:
+                continue
+            # A gateway first heard now did not hear the previous points
+            column = data.setdefault(name, array('d'))
+            _pad(column, index)
+            _append(column, name, result.get(metric), index)
+
+
+def iter_survey(fh, chunk_size=CHUNK_SIZE):
+    """
+    Stream a survey file.
+
+    Yields ('header', key, value) for every top-level entry and
+    ('point', index, point) for every element of survey_points, one at
+    a time.
+    """
+    reader = _Reader(fh, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == 'survey_points':
+            yield 'header', key, None
+            reader.expect('[')
+            index = 0
+            if reader.peek() != ']':
+                while True:
+                    yield 'point', index, reader.value()
+                    index += 1
+                    if reader.peek() != ',':
+                        break
+                    reader.expect(',')
+            reader.expect(']')
+        else:
+            yield 'header', key, reader.value()
+        if reader.peek() != ',':
+            break
+        reader.expect(',')
+    reader.expect('}')
+
+
+def iter_array(fh, chunk_size=CHUNK_SIZE):
+    """Stream the elements of a file holding a top-level JSON array."""
+    reader = _Reader(fh, chunk_size)
+    reader.expect('[')
+    if reader.peek() == ']':
+        return
+    while True:
+        yield reader.value()
+        if reader.peek() != ',':
+            break
+        reader.expect(',')
+    reader.expect(']')
+
+
+def _aligned(offset):
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+def is_binary(path):
+    """Return whether path holds a binary survey."""
+    with open(path, 'rb') as fh:
+        return fh.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def write_binary(survey, path):
+    """
+    Write a survey in the columnar binary format.
+
+    Parameters:
+    - survey (SurveyData): The survey to write.
+    - path (str): The destination file.
+
+    """
+    labels = json.dumps(survey.labels).encode('utf-8')
+    layout = {}
+    offset = 0
+    for name, values in survey.columns.items():
+        layout[name] = offset
+        offset = _aligned(offset + values.nbytes)
+    meta = {
+        'header': survey.header,
+        'count': len(survey),
+        'columns': layout,
+        'labels': [offset, len(labels)],
+    }
+    meta = json.dumps(meta).encode('utf-8')
+    start = _aligned(_PREAMBLE + len(meta))
+    with open(path, 'wb') as fh:
+        fh.write(BINARY_MAGIC + struct.pack('<Q', len(meta)) + meta)
+        for name, values in survey.columns.items():
+            fh.seek(start + layout[name])
+            fh.write(numpy.ascontiguousarray(values, dtype='<f8').tobytes())
+        fh.seek(start + offset)
+        fh.write(labels)
+
+
+def _load_binary(path, columns):
+    mapped = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+    length = struct.unpack('<Q', bytes(mapped[len(BINARY_MAGIC):_PREAMBLE]))[0]
+    meta = json.loads(bytes(mapped[_PREAMBLE:_PREAMBLE + length]).decode('utf-8'))
+    start = _aligned(_PREAMBLE + length)
+    count = meta['count']
+    names = [name for name in meta['columns'] if name not in ('x', 'y')]
+    if columns is not None:
+        names = [name for name in names if name in columns]
+    names = ['x', 'y'] + names
+    data = {}
+    for name in names:
+        offset = start + meta['columns'][name]
+        data[name] = mapped[offset:offset + 8 * count].view('<f8')
+    offset, size = meta['labels']
+    labels = json.loads(
+        bytes(mapped[start + offset:start + offset + size]).decode('utf-8'))
+    logger.debug('Mapped %d survey points from %s', count, path)
+    return SurveyData(meta['header'], True, data, labels)
+
+
+def survey_image(path, chunk_size=CHUNK_SIZE):
+    """
+    Return the img_path of a survey without loading its points.
+
+    The JSON survey is only streamed up to its img_path entry, which
+    usually comes before the points.
+
+    Returns:
+    - img_path (str): The floor plan of the survey, None when it has none.
+
+    """
+    if is_binary(path):
+        mapped = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+        length = struct.unpack('<Q', bytes(mapped[len(BINARY_MAGIC):_PREAMBLE]))[0]
+        meta = json.loads(bytes(mapped[_PREAMBLE:_PREAMBLE + length]).decode('utf-8'))
+        return meta['header'].get('img_path')
+    with open(path, 'r', encoding='utf-8') as fh:
+        for kind, key, value in iter_survey(fh, chunk_size):
+            if kind == 'header' and key == 'img_path':
+                return value
+    return None
+
+
+# pylint: disable=too-many-branches
+def load_survey(path, columns=None, chunk_size=CHUNK_SIZE):
+    """
+    Load a survey file into column arrays.
+
+    Binary surveys are memory mapped, JSON surveys are streamed.
+
+    Parameters:
+    - path (str): The survey JSON or binary file.
+    - columns (list): The COLUMNS and gateway columns to load, all of
+      them by default; x and y are always loaded.
+    - chunk_size (int): The read buffer size in characters.
+
+    Returns:
+    - survey (SurveyData): The columnar survey.
+
+    """
+    if is_binary(path):
+        return _load_binary(path, columns)
+    names = list(COLUMNS) if columns is None else [name for name in columns if name in COLUMNS]
+    data = {name: array('d') for name in ['x', 'y'] + names}
+    gateways = {}
+    labels = []
+    header = {}
+    found = False
+    with open(path, 'r', encoding='utf-8') as fh:
+        for kind, key, value in iter_survey(fh, chunk_size):
+            if kind == 'header':
+                if key == 'survey_points':
+                    found = True
+                else:
+                    header[key] = value
+                continue
+            if not isinstance(value, dict):
+                raise SurveyError(F"Survey point {key} must be an object")
+            result = value.get('result', {})
+            if not isinstance(result, dict):
+                raise SurveyError(F"Survey point {key}: result must be an object")
+            for name in ('x', 'y'):
+                if name not in value:
+                    raise SurveyError(F"Survey point {key}: missing {name}")
+                _append(data[name], name, value[name], key)
+            for name in names:
+                _append(data[name], name, result.get(COLUMNS[name]), key)
+            if result.get('gateways') is not None:
+                _append_gateways(gateways, result['gateways'], key, columns)
+            labels.append(value.get('label'))
+    for name in sorted(gateways):
+        _pad(gateways[name], len(labels))
+        data[name] = gateways[name]
+    columns = {
+        name: numpy.frombuffer(values, dtype=numpy.float64) if values
+        else numpy.empty(0)
+        for name, values in data.items()
+    }
+    if numpy.isnan(columns['x']).any() or numpy.isnan(columns['y']).any():
+        raise SurveyError(F"Survey points without coordinates in {path}")
+    logger.debug('Streamed %d survey points from %s', len(labels), path)
+    return SurveyData(header, found, columns, labels)
@@ -4,27 +4,118 @@ import sys
 import argparse
 import logging
 import json
+import math
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
+import numpy
+
+from batch import expand_surveys
 from heatmap import HeatMapGenerator
+from survey import load_survey
 
 FORMAT = "[%(asctime)s %(levelname)s] %(message)s"
 logging.basicConfig(level=logging.WARNING, format=FORMAT)
 logger = logging.getLogger()
 
+# Fixed histogram bins shared by every survey, in dB or dBm, so the
+# sketches of several surveys merge by adding their counts
+SKETCH_RANGE = (-200.0, 100.0)
+SKETCH_RESOLUTION = 0.1
+SKETCH_BINS = int(round((SKETCH_RANGE[1] - SKETCH_RANGE[0]) / SKETCH_RESOLUTION))
+
 # pylint: disable=too-few-public-methods
 
 
+class Summary:
+    """Mergeable summary of the valid values of one column.
+
+    Attributes:
+        count (int): The number of valid values.
+        low (float): The smallest value.
+        high (float): The largest value.
+        counts (numpy.ndarray): The histogram over SKETCH_RANGE, None
+            when percentiles are not needed.
+
+    """
+
+    def __init__(self, histogram=False):
+        self.count = 0
+        self.low = math.inf
+        self.high = -math.inf
+        self.counts = numpy.zeros(SKETCH_BINS, dtype=numpy.int64) if histogram else None
+
+    def add(self, values):
+        """Fold an array of values, NaN values are ignored."""
+        values = values[~numpy.isnan(values)]
+        if values.size == 0:
+            return
+        self.count += len(values)
+        self.low = min(self.low, float(values.min()))
+        self.high = max(self.high, float(values.max()))
+        if self.counts is not None:
+            index = numpy.floor((values - SKETCH_RANGE[0]) / SKETCH_RESOLUTION)
+            index = numpy.clip(index, 0, SKETCH_BINS - 1).astype(numpy.intp)
+            self.counts += numpy.bincount(index, minlength=SKETCH_BINS)
+
+    def merge(self, other):
+        """Fold the summary of another survey."""
+        self.count += other.count
+        self.low = min(self.low, other.low)
+        self.high = max(self.high, other.high)
+        if self.counts is not None:
+            self.counts += other.counts
+
+    def percentile(self, q):
+        """Return the q-th percentile, within the sketch resolution."""
+        rank = q / 100 * (self.count - 1)
+        index = numpy.searchsorted(numpy.cumsum(self.counts), rank, side='right')
+        value = SKETCH_RANGE[0] + (index + 0.5) * SKETCH_RESOLUTION
+        return round(min(max(value, self.low), self.high), 6)
+
+
+def summarize(path, keys, histogram=False):
+    """Summarize the keys of a survey, None when it has no survey points.
+
+    Only the needed columns are read, and the survey is released before
+    the next one is loaded.
+
+    Args:
+        path (str): The survey file.
+        keys (list): The columns to summarize.
+        histogram (bool): Whether to sketch the values for percentiles.
+
+    Returns:
+        dict: The Summary of every key.
+
+    """
+    survey = load_survey(path, columns=keys)
+    if not survey.found:
+        logger.warning('No survey points found in %s, skipping', path)
+        return None
+    summaries = {}
+    for key in keys:
+        summaries[key] = Summary(histogram)
+        summaries[key].add(survey.columns[key])
+    logger.debug('Summarized %d survey points from %s', len(survey), path)
+    return summaries
+
+
 class ThresholdGenerator:
     """Class ThresholdGenerator for HeatMap Generator.
 
     This class is responsible for generating thresholds for the
     HeatMap Generator.
-    It provides a method to generate thresholds based on a list
-    of titles.
+    It streams the surveys one at a time, possibly in worker processes,
+    and folds their mergeable summaries, so thousands of surveys are
+    reduced in bounded memory.
 
     Attributes:
-        None
+        jobs (int): The number of worker processes.
+        percentile (float): When set, the thresholds are the percentile
+            and 100 - percentile values instead of the min and max, so
+            outliers do not stretch the color scale.
 
     Methods:
         generate(titles): Generates thresholds based on the
@@ -32,38 +123,54 @@ class ThresholdGenerator:
 
     """
 
+    def __init__(self, jobs=1, percentile=None):
+        self.jobs = jobs
+        self.percentile = percentile
+
     def generate(self, titles):
         """Generate thresholds based on the given list of titles.
 
         Args:
-            titles (list): A list of titles.
+            titles (list): Survey files, directories or glob patterns.
 
         Returns:
-            None
+            dict: The min and max threshold of every graph.
 
         """
         logger.info('Generating thresholds')
+        keys = list(HeatMapGenerator.graphs)
+        reduce = partial(summarize, keys=keys,
+                         histogram=self.percentile is not None)
+        surveys = expand_surveys(titles)
+        totals = {key: Summary(self.percentile is not None) for key in keys}
+        if self.jobs > 1:
+            with ProcessPoolExecutor(self.jobs) as pool:
+                self._fold(totals, pool.map(reduce, surveys, chunksize=8))
+        else:
+            self._fold(totals, map(reduce, surveys))
+
         res = defaultdict(dict)
-        items = [HeatMapGenerator(image_path=None,
-                                  survey_path=title,
-                                  cname=None,
-                                  show_points=False,
-                                  contours=5,
-                                  thresholds=None)
-                 .load_data() for title in titles]
-
-        for key in HeatMapGenerator.graphs:
-            res[key]['min'] = min(
-                min(value for value in x[key] if value is not None)
-                for x in items
-            )
-            res[key]['max'] = max(
-                max(value for value in x[key] if value is not None)
-                for x in items
-            )
+        for key, total in totals.items():
+            if not total.count:
+                logger.warning('No valid %s values, skipping', key)
+                continue
+            if self.percentile is None:
+                res[key]['min'], res[key]['max'] = total.low, total.high
+            else:
+                res[key]['min'] = total.percentile(self.percentile)
+                res[key]['max'] = total.percentile(100 - self.percentile)
         with open('thresholds.json', 'w', encoding="utf-8") as fh:
             fh.write(json.dumps(res))
         logger.info('Wrote: thresholds.json')
+        return res
+
+    @staticmethod
+    def _fold(totals, results):
+        for summaries in results:
+            if summaries is None:
+                continue
+            for key, summary in summaries.items():
+                totals[key].merge(summary)
 
 
 def parse_args(argv):
@@ -82,9 +189,16 @@ def parse_args(argv):
                    default=0,
                    help='verbose output.')
     p.add_argument(
-        'TITLE', type=str, help='Title for survey (and data filename)',
+        'TITLE', type=str, help='Title for survey (and data filename); '
+        'directories and glob patterns are expanded',
         nargs='+'
     )
+    p.add_argument('-j', '--jobs', dest='jobs', action='store', type=int,
+                   default=1, help='read the surveys in N worker processes')
+    p.add_argument('-p', '--percentile', dest='percentile', action='store',
+                   type=float, default=None,
+                   help='use the P and 100-P percentiles as thresholds, e.g. '
+                   '1 for p1/p99, so outliers do not stretch the color scale')
     args = p.parse_args(argv)
     return args
 
@@ -127,7 +241,7 @@ def main():
     elif args.verbose == 1:
         set_log_info()
 
-    ThresholdGenerator().generate(args.TITLE)
+    ThresholdGenerator(args.jobs, args.percentile).generate(args.TITLE)
 
 
 if __name__ == '__main__':
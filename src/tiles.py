@@ -0,0 +1,233 @@
+"""Module providing the tiled renderer of the Heat Map Generator.
+
+Very large floor plans are rendered tile by tile into Deep Zoom (DZI)
+pyramids: every tile of the full resolution level is interpolated on its
+own lattice of grid nodes, colorized, and composited over the matching
+floor plan pixels, read back from a raw copy of the plan. The lower
+levels are then built by downsampling four tiles at a time, so the peak
+memory is bounded by the tile size, not by the plan size.
+
+The raw copy is decoded by Pillow straight into a file mapping, and the
+pages it wrote are dropped from the process as the encoded plan is read,
+so even the decoding does not hold the plan in memory. Progressive JPEG
+plans are the exception, libjpeg buffers their whole coefficients, and
+so are the Pillow versions that decode into memory of their own, such
+as mode 1 plans before Pillow 11; the decoded plan is then copied.
+"""
+
+import logging
+import math
+import mmap
+import os
+
+import numpy
+
+from raster import blend, colorize, upsample
+
+logger = logging.getLogger()
+
+TILE_SIZE = 256
+
+DZI = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+       '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+       'Format="png" Overlap="0" TileSize="{tile_size}">\n'
+       '  <Size Width="{width}" Height="{height}"/>\n'
+       '</Image>\n')
+
+
+# Encoded bytes Pillow decodes at once, a block is decoded between two
+# releases of the decoded pages
+_BLOCK = 16 * 1024
+
+# pylint: disable=import-outside-toplevel,too-many-locals
+
+
+def _pixel_size(mode):
+    """Return the bytes of a pixel in the Pillow memory layout of a mode."""
+    if mode in ('L', 'P'):
+        return 1
+    if mode.startswith('I;16'):
+        return 2
+    return 4
+
+
+def _mapped(buffer, mode, size):
+    """Return the Pillow image of a mode over raw pixels in its memory layout."""
+    from PIL import Image
+    args = (mode, _pixel_size(mode) * size[0], 1)
+    # pylint: disable=protected-access,c-extension-no-member
+    return Image.new(mode, (0, 0))._new(Image.core.map_buffer(buffer, size, 'raw', 0, args))
+
+
+class _Releasing:
+    """Encoded plan file dropping the decoded pages of a mapping as it is read."""
+
+    def __init__(self, fh, mapping):
+        self._fh = fh
+        self._mapping = mapping
+
+    def read(self, size=-1):
+        """Read from the file, after releasing the pages decoded so far."""
+        if hasattr(mmap, 'MADV_DONTNEED'):
+            # The pages stay in the page cache, they are only unmapped
+            self._mapping.madvise(mmap.MADV_DONTNEED)
+        return self._fh.read(size)
+
+    def __getattr__(self, name):
+        return getattr(self._fh, name)
+
+
+# pylint: disable=too-many-instance-attributes
+class PlanRaster:
+    """Floor plan decoded once into a raw scratch file, read back by bands of rows."""
+
+    def __init__(self, image_path, scratch_path):
+        from PIL import Image
+        self._scratch_path = scratch_path
+        # Site plans are trusted local files, allow very large ones
+        Image.MAX_IMAGE_PIXELS = None
+        with open(image_path, 'rb') as fh, open(scratch_path, 'w+b') as scratch:
+            with Image.open(fh) as image:
+                self.width, self.height = image.size
+                # Mode 1 pixels are stored as bytes of 0 or 255, like L
+                self._mode = 'L' if image.mode == '1' else image.mode
+                self._stride = _pixel_size(self._mode) * self.width
+                scratch.truncate(self._stride * self.height)
+                with mmap.mmap(scratch.fileno(), self._stride * self.height) as mapping:
+                    image.fp = _Releasing(image.fp, mapping)
+                    image.decodermaxblock = _BLOCK
+                    # Pillow decodes into the image memory it finds
+                    mapped = _mapped(mapping, self._mode, image.size).im
+                    image.im = mapped
+                    try:
+                        image.load()
+                        if image.im is not mapped:
+                            # Older Pillow replaces image memory of another
+                            # mode, such as L for a mode 1 plan, and decodes
+                            # in memory
+                            logger.warning('Decoding floor plan %s in memory', image_path)
+                            decoded = image.convert('L') if image.mode == '1' else image
+                            mapped.paste(decoded.im, (0, 0) + image.size)
+                        self._palette = image.getpalette() if image.mode == 'P' else None
+                    finally:
+                        # The mapping cannot close while an image exports it
+                        image.im = mapped = decoded = None
+        self._file = open(scratch_path, 'rb')  # pylint: disable=consider-using-with
+        self._band = None
+        logger.info('Decoded floor plan %s (%dx%d) to %s', image_path,
+                    self.width, self.height, scratch_path)
+
+    def read(self, x0, y0, x1, y1):
+        """Return the RGB pixels of the [x0, x1) x [y0, y1) window."""
+        # The tiles of a row share one band of full width rows
+        if self._band is None or self._band[0] != (y0, y1):
+            self._band = None
+            self._file.seek(y0 * self._stride)
+            rows = numpy.frombuffer(self._file.read((y1 - y0) * self._stride),
+                                    dtype=numpy.uint8)
+            self._band = ((y0, y1), rows.reshape(y1 - y0, self.width, -1))
+        window = self._band[1][:, x0:x1]
+        if self._mode in ('RGB', 'RGBA', 'RGBX'):
+            return numpy.array(window[:, :, :3])
+        window = _mapped(numpy.ascontiguousarray(window), self._mode, (x1 - x0, y1 - y0))
+        if self._palette is not None:
+            window.putpalette(self._palette)
+        return numpy.asarray(window.convert('RGB'))
+
+    def close(self):
+        """Close and delete the scratch raster."""
+        self._band = None
+        self._file.close()
+        os.remove(self._scratch_path)
+
+
+def _level_size(width, height, max_level, level):
+    scale = 2 ** (max_level - level)
+    return math.ceil(width / scale), math.ceil(height / scale)
+
+
+def _tile_path(base, level, col, row):
+    return os.path.join(F"{base}_files", str(level), F"{col}_{row}.png")
+
+
+def _downsample_level(base, level, size, tile_size):
+    """Build the tiles of a level from the four children of each tile."""
+    from PIL import Image
+    width, height = size
+    os.makedirs(os.path.join(F"{base}_files", str(level)), exist_ok=True)
+    for row in range(math.ceil(height / tile_size)):
+        for col in range(math.ceil(width / tile_size)):
+            canvas_size = (min(2 * tile_size, 2 * width - 2 * col * tile_size),
+                           min(2 * tile_size, 2 * height - 2 * row * tile_size))
+            canvas = Image.new('RGB', canvas_size)
+            for dy in (0, 1):
+                for dx in (0, 1):
+                    path = _tile_path(base, level + 1, 2 * col + dx,
+                                      2 * row + dy)
+                    if os.path.exists(path):
+                        with Image.open(path) as child:
+                            canvas.paste(child, (dx * tile_size,
+                                                 dy * tile_size))
+            tile = canvas.resize((math.ceil(canvas_size[0] / 2),
+                                  math.ceil(canvas_size[1] / 2)), Image.Resampling.BOX)
+            tile.save(_tile_path(base, level, col, row))
+
+
+# pylint: disable=too-many-arguments
+def render_pyramids(plan, outputs, evaluate, tile_size=TILE_SIZE, step=4,
+                    alpha=0.4, nearest=()):
+    """
+    Render Deep Zoom pyramids of several graphs over a floor plan.
+
+    Parameters:
+    - plan (PlanRaster): The floor plan pixels.
+    - outputs (dict): graph key -> (base, lut, vmin, vmax); the pyramid
+      is written to base.dzi and base_files/.
+    - evaluate (callable): Maps flattened (gx, gy) pixel coordinates to
+      a dict of graph key -> interpolated values.
+    - tile_size (int): The tile size in pixels.
+    - step (float): The pixel distance between two grid nodes.
+    - alpha (float): The opacity of the heat layer.
+    - nearest (list): The graph keys upsampled from the nearest node,
+      for categorical values.
+
+    """
+    from PIL import Image
+    width, height = plan.width, plan.height
+    max_level = math.ceil(math.log2(max(width, height, 2)))
+    for base, _, _, _ in outputs.values():
+        os.makedirs(os.path.join(F"{base}_files", str(max_level)),
+                    exist_ok=True)
+    rows, cols = math.ceil(height / tile_size), math.ceil(width / tile_size)
+    logger.info('Rendering %d tiles of %d pixels per graph', rows * cols,
+                tile_size)
+    for row in range(rows):
+        for col in range(cols):
+            x0, y0 = col * tile_size, row * tile_size
+            x1, y1 = min(width, x0 + tile_size), min(height, y0 + tile_size)
+            # Global lattice nodes around the tile, so tiles join seamlessly
+            i0, j0 = int(x0 // step), int(y0 // step)
+            i1, j1 = int((x1 - 1) // step) + 1, int((y1 - 1) // step) + 1
+            node_x = numpy.arange(i0, i1 + 1) * step
+            node_y = numpy.arange(j0, j1 + 1) * step
+            gx, gy = numpy.meshgrid(node_x, node_y)
+            z = evaluate(gx.flatten(), gy.flatten())
+            base_pixels = plan.read(x0, y0, x1, y1)
+            for key, (base, lut, vmin, vmax) in outputs.items():
+                values = upsample(z[key].reshape(gx.shape),
+                                  (x0 - node_x[0], y0 - node_y[0]),
+                                  (x1 - x0, y1 - y0), step,
+                                  nearest=key in nearest)
+                pixels = blend(base_pixels, colorize(values, lut, vmin, vmax),
+                               alpha)
+                Image.fromarray(pixels).save(
+                    _tile_path(base, max_level, col, row))
+    for base, _, _, _ in outputs.values():
+        for level in range(max_level - 1, -1, -1):
+            _downsample_level(
+                base, level, _level_size(width, height, max_level, level),
+                tile_size)
+        with open(F"{base}.dzi", 'w', encoding='utf-8') as fh:
+            fh.write(DZI.format(tile_size=tile_size, width=width,
+                                height=height))
+        logger.info('Wrote tile pyramid: %s.dzi', base)
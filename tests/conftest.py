@@ -0,0 +1,6 @@
+"""Test configuration: the modules are imported from src, like heatmap.py does."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
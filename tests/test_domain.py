@@ -0,0 +1,39 @@
+"""Tests of the interpolation domain."""
+
+import json
+import logging
+import os
+
+import numpy
+from matplotlib.image import imread
+
+from domain import Domain, plan_outline
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data')
+
+
+def _points():
+    with open(os.path.join(DATA, 'Sample.json'), encoding='utf-8') as fh:
+        points = json.load(fh)['survey_points']
+    return (numpy.array([p['x'] for p in points], dtype=float),
+            numpy.array([p['y'] for p in points], dtype=float))
+
+
+def test_sample_plan_domain_contains_every_point(caplog):
+    x, y = _points()
+    outline = plan_outline(imread(os.path.join(DATA, 'MapSample.jpg')), 4)
+    with caplog.at_level(logging.WARNING):
+        domain = Domain(outline, 4, x, y)
+    assert outline[235 // 4, 150 // 4] == 0
+    assert domain.contains(x, y).all()
+    # Around the 'Table water' point of the left wing the outline misses
+    angle = numpy.linspace(0, 2 * numpy.pi, 16)
+    assert domain.contains(150 + 48 * numpy.cos(angle), 235 + 48 * numpy.sin(angle)).all()
+    assert 'outside the domain outline' in caplog.text
+
+
+def test_outline_outside_neighborhood_is_left_out():
+    outline = numpy.zeros((26, 26), dtype=bool)
+    domain = Domain(outline, 4, numpy.array([20.0]), numpy.array([20.0]), neighborhood=10)
+    inside = domain.contains(numpy.array([20.0, 28.0, 40.0]), numpy.array([20.0, 20.0, 40.0]))
+    assert inside.tolist() == [True, True, False]
@@ -0,0 +1,52 @@
+"""Tests of the adaptive grid."""
+
+import numpy
+import pytest
+
+from grid import adaptive_grid
+from interpolation import IdwInterpolator
+
+
+@pytest.mark.parametrize('max_error', [0.5, 2.0])
+def test_adaptive_grid_error_against_full_grid(max_error):
+    rng = numpy.random.default_rng(0)
+    x, y = rng.uniform(0, 1280, 200), rng.uniform(0, 720, 200)
+    values = rng.uniform(-110, -60, 200)
+    interpolator = IdwInterpolator(x, y)
+    xs, ys = numpy.linspace(0, 1280, 320), numpy.linspace(0, 720, 180)
+    gx, gy = numpy.meshgrid(xs, ys)
+    full = interpolator.evaluate(values, gx.ravel(), gy.ravel()).reshape(gx.shape)
+    evaluated = []
+
+    def evaluate(cx, cy):
+        evaluated.append(len(cx))
+        return interpolator.evaluate(values, cx, cy)[:, None]
+
+    z = adaptive_grid(evaluate, xs, ys, max_error, points=(x, y))[:, :, 0]
+    error = numpy.abs(z - full)
+    assert sum(evaluated) < full.size
+    # The tolerance is only tested at the cell midpoints
+    assert (error > max_error).mean() < 0.01
+    assert error.max() < 4 * max_error
+    assert error.mean() < max_error / 4
+
+
+def test_adaptive_grid_skips_nodes_outside_domain():
+    rng = numpy.random.default_rng(1)
+    x, y = rng.uniform(0, 640, 50), rng.uniform(0, 360, 50)
+    values = rng.uniform(-110, -60, 50)
+    interpolator = IdwInterpolator(x, y)
+    xs, ys = numpy.linspace(0, 640, 161), numpy.linspace(0, 360, 91)
+    gx, gy = numpy.meshgrid(xs, ys)
+    inside = numpy.hypot(gx - 320, gy - 180) < 150
+    evaluated = []
+
+    def evaluate(cx, cy):
+        evaluated.append(numpy.hypot(cx - 320, cy - 180))
+        return interpolator.evaluate(values, cx, cy)[:, None]
+
+    z = adaptive_grid(evaluate, xs, ys, 0.5, points=(x, y), inside=inside)[:, :, 0]
+    assert numpy.concatenate(evaluated).max() < 150
+    assert numpy.isnan(z[~inside]).all()
+    full = interpolator.evaluate(values, gx[inside], gy[inside])
+    assert (numpy.abs(z[inside] - full) > 0.5).mean() < 0.01
@@ -0,0 +1,96 @@
+"""Tests of the Heat Map Generator."""
+
+import os
+import shutil
+
+import pytest
+
+from cache import RenderCache
+from heatmap import HeatMapGenerator
+from output import output_spec
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data')
+
+
+class RecordingCache(RenderCache):
+    """Render cache recording whether every grid lookup was a hit."""
+
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.hits = []
+
+    def load_grids(self, key):
+        grids = super().load_grids(key)
+        self.hits.append(grids is not None)
+        return grids
+
+
+@pytest.fixture(name='survey')
+def fixture_survey(tmp_path):
+    for name in ('Sample.json', 'MapSample.jpg'):
+        shutil.copy(os.path.join(DATA, name), tmp_path / name)
+    return tmp_path
+
+
+def _generate(survey, cache, **kwargs):
+    HeatMapGenerator(str(survey / 'MapSample.jpg'), str(survey / 'Sample.json'),
+                     'RdYlBu_r', cache=cache, renderer='raster',
+                     interpolator='idw', **kwargs).generate()
+
+
+def test_adaptive_grid_cache_depends_on_contours(survey):
+    cache = RecordingCache(str(survey / 'cache'))
+    _generate(survey, cache, max_error=0.5)
+    _generate(survey, cache, max_error=0.5, contours=8)
+    assert cache.hits == [False, False]
+
+
+def test_uniform_grid_cache_shared_across_contours(survey):
+    cache = RecordingCache(str(survey / 'cache'))
+    _generate(survey, cache)
+    _generate(survey, cache, contours=8)
+    assert cache.hits == [False, True]
+
+
+def test_tiled_plan_domain_keeps_corners(survey):
+    generator = HeatMapGenerator(str(survey / 'MapSample.jpg'), str(survey / 'Sample.json'),
+                                 'RdYlBu_r', tile_size=256, domain='plan')
+    a = generator._padded_data()  # pylint: disable=protected-access
+    assert (0, 0) in zip(a['x'], a['y'])
+
+
+def test_raster_variant_size_independent_of_other_variants(survey):
+    # pylint: disable=import-outside-toplevel
+    from PIL import Image
+    sizes = []
+    for spec in ('webp:72', 'png:300,webp:72'):
+        _generate(survey, None, output=output_spec(spec))
+        with Image.open(survey / 'Sample_sensor_rssi.webp') as image:
+            sizes.append(image.size)
+    assert sizes[0] == sizes[1]
+    # The 720 pixels of the floor plan and its 24 pixels title band are
+    # composited at 300 dpi
+    assert sizes[0][1] == round(72 / 300 * (720 + 24))
+
+
+def test_raster_default_output_not_resized(survey, monkeypatch):
+    # pylint: disable=import-outside-toplevel
+    from PIL import Image
+
+    def resize(*args, **kwargs):
+        raise AssertionError('The default output is resized')
+
+    monkeypatch.setattr(Image.Image, 'resize', resize)
+    _generate(survey, None)
+    with Image.open(survey / 'Sample_sensor_rssi.png') as image:
+        assert image.size[1] == 720 + 24
+
+
+def test_stepped_and_unknown_colormaps(survey):
+    generator = HeatMapGenerator(str(survey / 'MapSample.jpg'), str(survey / 'Sample.json'),
+                                 'RdYlBu_r')
+    colormap = generator.get_colormap('RdYlBu_r//4')
+    assert colormap.N == 256
+    assert tuple(colormap(0)) == (0, 0, 0, 1)
+    with pytest.raises(ValueError):
+        generator.get_colormap('unknown')
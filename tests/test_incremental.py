@@ -0,0 +1,31 @@
+"""Tests of the incremental interpolation."""
+
+import numpy
+
+from incremental import update_grid
+from interpolation import IdwInterpolator
+
+
+def test_update_grid_evaluates_cells_inside_domain(tmp_path, monkeypatch):
+    evaluated = []
+    evaluate = IdwInterpolator.evaluate
+
+    def counting(self, values, gx, gy):
+        evaluated.append(len(gx))
+        return evaluate(self, values, gx, gy)
+
+    monkeypatch.setattr(IdwInterpolator, 'evaluate', counting)
+    x, y = numpy.array([10.0, 50, 90, 30]), numpy.array([10.0, 80, 20, 60])
+    values = numpy.array([[-80.0], [-90], [-70], [-100]])
+    gx, gy = (a.ravel() for a in numpy.meshgrid(numpy.arange(0, 101.0, 4), numpy.arange(0, 101.0, 4)))
+    path = str(tmp_path / 'state.npz')
+    left = gx < 50
+    z = update_grid(path, 'idw', None, x, y, values, ['rssi'], gx, gy, left)
+    assert evaluated == [left.sum()]
+    assert numpy.isnan(z[~left]).all()
+    full = evaluate(IdwInterpolator(x, y), values, gx, gy)
+    numpy.testing.assert_allclose(z[left], full[left])
+    # The cells coming inside the domain are evaluated, the others reused
+    z = update_grid(path, 'idw', None, x, y, values, ['rssi'], gx, gy, None)
+    assert evaluated[1:] == [(~left).sum()]
+    numpy.testing.assert_allclose(z, full)
@@ -0,0 +1,19 @@
+"""Tests of the interpolation backends."""
+
+import numpy
+import pytest
+
+from interpolation import RbfInterpolator
+
+
+def test_rbf_duplicate_points_raise():
+    x, y = numpy.array([0, 10, 20, 0, 5.0]), numpy.array([0, 0, 10, 0, 5.0])
+    with pytest.raises(numpy.linalg.LinAlgError):
+        RbfInterpolator(x, y)
+
+
+def test_rbf_interpolates_survey_points():
+    x, y = numpy.array([0, 10, 20, 0, 5.0]), numpy.array([0, 0, 10, 10, 5.0])
+    values = numpy.array([-80, -70, -90, -60, -75.0])
+    z = RbfInterpolator(x, y).evaluate(values, x, y)
+    numpy.testing.assert_allclose(z, values)
@@ -0,0 +1,32 @@
+"""Tests of the stage metrics."""
+
+import os
+
+import pytest
+
+from metrics import Metrics, peak_rss_bytes, prometheus_text, reset_peak_rss
+
+
+def _report(path):
+    metrics = Metrics(os.path.splitext(os.path.basename(path))[0])
+    metrics.record('load', 0.5)
+    metrics.set('file', path)
+    metrics.set('points', 17)
+    return metrics.as_dict()
+
+
+def test_prometheus_series_unique_across_surveys_of_a_title():
+    text = prometheus_text([_report('/f1/survey.json'), _report('/f2/survey.json')])
+    series = [line.rpartition(' ')[0] for line in text.splitlines() if not line.startswith('#')]
+    assert len(series) == len(set(series))
+    assert 'heatmap_survey_points{survey="survey",file="/f2/survey.json"} 17' in text
+
+
+@pytest.mark.skipif(not reset_peak_rss(), reason='needs /proc/self/clear_refs')
+def test_reset_peak_rss():
+    block = bytearray(256 * 1024 * 1024)
+    block[::4096] = b'x' * len(range(0, len(block), 4096))
+    del block
+    peak = peak_rss_bytes()
+    assert reset_peak_rss()
+    assert peak_rss_bytes() < peak - 128 * 1024 * 1024
@@ -0,0 +1,31 @@
+"""Tests of the survey point preprocessing."""
+
+import numpy
+
+from preprocess import merge_points
+
+
+def _survey(x, y):
+    return {'x': numpy.asarray(x, dtype=float), 'y': numpy.asarray(y, dtype=float),
+            'sensor_rssi': numpy.asarray(x, dtype=float),
+            'label': [str(index) for index in range(len(x))]}
+
+
+def test_merge_chain_stays_within_radius():
+    # Every point is 4 pixels from the next, a 96 pixels long chain
+    x = numpy.arange(0, 100, 4.0)
+    merged, count = merge_points(_survey(x, numpy.zeros_like(x)), 5)
+    assert len(merged['x']) + count == len(x)
+    assert len(merged['x']) >= len(x) / 3
+    for mx, label in zip(merged['x'], merged['label']):
+        assert abs(mx - x[int(label)]) <= 5
+    # Every point is merged into a point within twice the radius
+    assert numpy.abs(x[:, None] - merged['x'][None, :]).min(axis=1).max() <= 10
+
+
+def test_merge_close_presses():
+    merged, count = merge_points(_survey([0, 1, 2, 100, 101], [0, 1, 0, 50, 50]), 5)
+    assert count == 3
+    numpy.testing.assert_allclose(merged['x'], [1, 100.5])
+    numpy.testing.assert_allclose(merged['y'], [1 / 3, 50])
+    assert merged['label'] == ['0', '3']
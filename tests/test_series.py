@@ -0,0 +1,27 @@
+"""Tests of the survey series."""
+
+import json
+import os
+import shutil
+
+from series import SeriesGenerator
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data')
+
+
+def test_series_uniform_channel_with_domain(tmp_path):
+    shutil.copy(os.path.join(DATA, 'MapSample.jpg'), tmp_path / 'MapSample.jpg')
+    with open(os.path.join(DATA, 'Sample.json'), encoding='utf-8') as fh:
+        survey = json.load(fh)
+    paths = []
+    for quarter, snr in (('Q1', 5), ('Q2', 6)):
+        # The SNR of every point is the same, a uniform grid
+        for point in survey['survey_points']:
+            point['result']['snr'] = snr
+        path = tmp_path / F"{quarter}.json"
+        path.write_text(json.dumps(survey))
+        paths.append(str(path))
+    generator = SeriesGenerator(str(tmp_path / 'MapSample.jpg'), paths, 'RdYlBu_r',
+                                renderer='raster', interpolator='idw', extrapolation=150)
+    assert not generator.generate()
+    assert (tmp_path / 'series_sensor_snr_median.png').exists()
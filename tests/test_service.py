@@ -0,0 +1,104 @@
+"""Tests of the render service, served on an ephemeral localhost port."""
+
+import asyncio
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+
+import pytest
+
+from service import HeatmapService
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data')
+
+
+@pytest.fixture(name='port')
+def fixture_port(tmp_path):
+    plans = tmp_path / 'plans'
+    plans.mkdir()
+    shutil.copy(os.path.join(DATA, 'MapSample.jpg'), plans / 'MapSample.jpg')
+    (tmp_path / 'secret.json').write_text('{}')
+    # One worker and no queue: a request is rejected while another renders
+    service = HeatmapService(str(plans), jobs=1, queue=0)
+    service.warm_up()
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(service.handle, '127.0.0.1', 0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        yield server.sockets[0].getsockname()[1]
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+        service.close()
+
+
+def _request(port, method, target, body=None):
+    connection = HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        connection.request(method, target, body)
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        connection.close()
+
+
+def _survey():
+    with open(os.path.join(DATA, 'Sample.json'), 'rb') as fh:
+        return fh.read()
+
+
+def _health(port):
+    return json.loads(_request(port, 'GET', '/health')[2])
+
+
+def test_render_and_health(port):
+    status, headers, body = _request(
+        port, 'POST', '/render/sensor_rssi?plan=MapSample.jpg&renderer=raster', _survey())
+    assert status == 200
+    assert headers['Content-Type'] == 'image/png'
+    assert body.startswith(b'\x89PNG')
+    assert _health(port)['rendered'] == 1
+
+
+@pytest.mark.parametrize('target', [
+    '/unknown', '/render/unknown?plan=MapSample.jpg',
+    '/render/sensor_rssi?plan=missing.jpg', '/render/sensor_rssi?plan=../secret.json',
+])
+def test_not_found(port, target):
+    assert _request(port, 'POST', target, _survey())[0] == 404
+
+
+@pytest.mark.parametrize('graph, survey', [
+    ('sensor_rssi', b'{"survey_points": []}'),
+    # A coverage graph of a survey without gateways
+    ('best_server', None),
+], ids=['no points', 'no graph'])
+def test_unprocessable(port, graph, survey):
+    status, _, body = _request(port, 'POST', F"/render/{graph}?plan=MapSample.jpg",
+                               survey or _survey())
+    assert status == 422
+    assert body
+    assert _health(port)['failed'] == 1
+
+
+def test_busy_workers_reject(port):
+    with ThreadPoolExecutor(1) as executor:
+        rendering = executor.submit(_request, port, 'POST',
+                                    '/render/sensor_rssi?plan=MapSample.jpg', _survey())
+        while _health(port)['in_flight'] == 0:
+            assert not rendering.done()
+            time.sleep(0.01)
+        status, headers, _ = _request(port, 'POST', '/render/sensor_snr?plan=MapSample.jpg',
+                                      _survey())
+        assert rendering.result()[0] == 200
+    assert status == 503
+    assert headers['Retry-After'] == '1'
+    assert _health(port)['rejected'] == 1
@@ -0,0 +1,100 @@
+"""Tests of the tiled renderer floor plan raster."""
+
+import os
+import subprocess
+import sys
+
+import numpy
+import pytest
+from PIL import Image
+
+import tiles
+from tiles import PlanRaster
+
+
+def _plan(width, height):
+    y, x = numpy.mgrid[0:height, 0:width]
+    return numpy.stack([(x // 7) % 256, (y // 5) % 256, ((x + y) // 11) % 256],
+                       axis=-1).astype(numpy.uint8)
+
+
+def _read_all(plan, tile_size):
+    return numpy.concatenate([
+        numpy.concatenate([
+            plan.read(x, y, min(plan.width, x + tile_size), min(plan.height, y + tile_size))
+            for x in range(0, plan.width, tile_size)], axis=1)
+        for y in range(0, plan.height, tile_size)])
+
+
+@pytest.mark.parametrize('mode, name', [
+    ('RGB', 'plan.png'), ('RGBA', 'plan.png'), ('P', 'plan.png'), ('L', 'plan.png'),
+    ('1', 'plan.png'), ('LA', 'plan.png'), ('I;16', 'plan.png'), ('RGB', 'plan.jpg'),
+    ('CMYK', 'plan.jpg'),
+])
+def test_read_matches_decoded_plan(tmp_path, mode, name):
+    path = str(tmp_path / name)
+    Image.fromarray(_plan(517, 300)).convert(mode).save(path)
+    plan = PlanRaster(path, str(tmp_path / 'plan.raw'))
+    try:
+        assert (plan.width, plan.height) == (517, 300)
+        with Image.open(path) as image:
+            expected = numpy.asarray(image.convert('RGB'))
+        numpy.testing.assert_array_equal(_read_all(plan, 128), expected)
+    finally:
+        plan.close()
+    assert not (tmp_path / 'plan.raw').exists()
+
+
+def test_read_when_pillow_decodes_in_memory(tmp_path, monkeypatch):
+    # Older Pillow versions replace the mapped image memory before decoding
+    from PIL import ImageFile
+
+    def load_prepare(self):
+        # pylint: disable=c-extension-no-member
+        self.im = Image.core.new(self.mode, self.size)
+
+    monkeypatch.setattr(ImageFile.ImageFile, 'load_prepare', load_prepare)
+    path = str(tmp_path / 'plan.png')
+    Image.fromarray(_plan(517, 300)).convert('1').save(path)
+    plan = PlanRaster(path, str(tmp_path / 'plan.raw'))
+    try:
+        with Image.open(path) as image:
+            expected = numpy.asarray(image.convert('RGB'))
+        numpy.testing.assert_array_equal(_read_all(plan, 128), expected)
+    finally:
+        plan.close()
+
+
+# ru_maxrss is inherited through exec, the high-water mark of the
+# process memory is not
+PEAK_SCRIPT = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+import numpy
+from PIL import Image
+from tiles import PlanRaster
+
+def peak():
+    with open('/proc/self/status') as fh:
+        return next(int(line.split()[1]) * 1024 for line in fh if line.startswith('VmHWM'))
+
+before = peak()
+plan = PlanRaster(sys.argv[2], sys.argv[3])
+for y in range(0, plan.height, 256):
+    for x in range(0, plan.width, 256):
+        plan.read(x, y, min(plan.width, x + 256), min(plan.height, y + 256))
+plan.close()
+print(peak() - before)
+'''
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/status'), reason='needs /proc')
+def test_peak_memory_bounded_by_band(tmp_path):
+    width, height = 6000, 4000
+    path = str(tmp_path / 'plan.png')
+    Image.fromarray(_plan(width, height)).save(path)
+    output = subprocess.run(
+        [sys.executable, '-c', PEAK_SCRIPT, os.path.dirname(tiles.__file__), path, str(tmp_path / 'plan.raw')],
+        check=True, capture_output=True, text=True).stdout
+    # The decoded plan is 72 MB, a band of 256 rows less than 11 MB
+    assert int(output) < width * height